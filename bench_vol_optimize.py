@@ -0,0 +1,267 @@
+################################################################
+# Scale benchmarks for vol_snap_optimize.py and vol_guarantee.py
+# (c)NetApp Professional Services Germany
+#
+# Summary: runs the scripts' helpers against the local fake ONTAP
+#          server (fake_ontap.py) and reports wall time, REST call
+#          count and bytes transferred per scenario
+#
+#          python bench_vol_optimize.py --latency 0.002 --json bench.json
+#
+################################################################
+
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import fake_ontap
+import ontap_session
+import vol_guarantee
+import vol_snap_optimize
+from volume_lookup import VolumeTable
+
+SVM = "svm1"
+
+
+class Scenario:
+  """One benchmark: builds fake clusters, then times a run against them.
+     expected(volumes) returns the result statuses a correct run ends with """
+
+  def __init__(self, name: str, description: str, setup, run, expected):
+    self.name = name
+    self.description = description
+    self.setup = setup
+    self.run = run
+    self.expected = expected
+
+
+def reset_state():
+  """Forget everything the scripts cached in a previous scenario """
+  vol_snap_optimize._volumes = VolumeTable()
+  vol_snap_optimize._snapshot_indexes.clear()
+  vol_snap_optimize._catalog = None
+  vol_snap_optimize._journal = None
+  vol_snap_optimize._relationships = None
+  vol_guarantee._volumes = VolumeTable()
+  vol_guarantee._journal = None
+
+
+def script_args(cluster: str, workers: int, *extra):
+  return vol_snap_optimize.parse_args(["-c", cluster, "-svm", SVM, "-vol", "vol00000", "-p", "bench", "--dryrun",
+                                       "--workers", str(workers), "--cluster_workers", str(workers), *extra])
+
+
+def mirror_volume(source: fake_ontap.FakeOntap, target: fake_ontap.FakeOntap, target_uuid: str, name: str):
+  """Create a source volume holding the same snapshots (same version_uuids, own instance uuids) as a target volume """
+  src_uuid = source.add_volume(SVM, name)
+  source.snapshots[src_uuid] = [dict(snap, uuid=str(uuid.uuid4()), volume={"uuid": src_uuid, "name": name}) for snap in target.snapshots[target_uuid]]
+  return src_uuid
+
+
+# --- scenarios -----------------------------------------------------------------
+
+def setup_single(scale: float):
+  target, source = fake_ontap.FakeOntap(), fake_ontap.FakeOntap()
+  snapshots = max(10, int(10000 * scale))
+  vol_uuid = target.add_volume(SVM, "vol00000", snapshots=snapshots, prefix_every=max(1, snapshots - 20))
+  mirror_volume(source, target, vol_uuid, "vol00000")
+  return target, source
+
+
+def run_single(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, 1)
+  entry = {"cluster": target_cluster, "vserver": SVM, "volume": "vol00000",
+           "source_cluster": source_cluster, "source_vserver": SVM, "source_volume": "vol00000"}
+  return [vol_snap_optimize.optimize_volume(entry, True, False)]
+
+
+def run_single_skip(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, 1, "--skip_src_validation")
+  entry = {"cluster": target_cluster, "vserver": SVM, "volume": "vol00000"}
+  return [vol_snap_optimize.optimize_volume(entry, True, False)]
+
+
+def setup_fleet(scale: float):
+  target = fake_ontap.FakeOntap()
+  for n in range(max(2, int(1000 * scale))):
+    target.add_volume(SVM, f"vol{n:05d}", snapshots=200, prefix_every=150)
+  return target, None
+
+
+def setup_fleet_throttled(scale: float):
+  target, _ = setup_fleet(scale)
+  target.max_in_flight, target.error_rate = 4, 0.02
+  return target, None
+
+
+def setup_fleet_paired(scale: float):
+  """Fleet of SnapMirror destinations whose sources are only known from the relationships """
+  target, source = setup_fleet(scale)[0], fake_ontap.FakeOntap()
+  for vol_uuid, vol in list(target.volumes.items()):
+    mirror_volume(source, target, vol_uuid, vol["name"])
+    target.add_relationship(SVM, vol["name"], vol_uuid, "source")
+  return target, source
+
+
+def fleet_inventory(target_cluster, volumes):
+  return [{"cluster": target_cluster, "vserver": SVM, "volume": name,
+           "source_cluster": None, "source_vserver": None, "source_volume": None} for name in volumes]
+
+
+def run_fleet(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, bench_args.workers, "--skip_src_validation")
+  inventory = fleet_inventory(target_cluster, volumes)
+  vol_snap_optimize.prefetch_volumes(inventory)
+  return vol_snap_optimize.run_fleet(inventory, True, bench_args.workers)
+
+
+def run_fleet_async(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, bench_args.workers, "--skip_src_validation", "--async_discovery")
+  inventory = fleet_inventory(target_cluster, volumes)
+  vol_snap_optimize.prefetch_async(inventory)
+  return vol_snap_optimize.run_fleet(inventory, True, bench_args.workers)
+
+
+def run_fleet_paired(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, bench_args.workers, "--source_cluster_map", f"source={source_cluster}")
+  inventory = fleet_inventory(target_cluster, volumes)
+  vol_snap_optimize.prefetch_volumes(inventory)
+  return vol_snap_optimize.run_fleet(inventory, True, bench_args.workers)
+
+
+def run_plan(target_cluster, source_cluster, volumes, bench_args):
+  vol_snap_optimize.args = script_args(target_cluster, bench_args.workers, "--skip_src_validation", "--async_discovery")
+  inventory = fleet_inventory(target_cluster, volumes)
+  vol_snap_optimize.prefetch_async(inventory, snapshots=False)
+  fd, path = tempfile.mkstemp(suffix=".csv")
+  os.close(fd)
+  try:
+    return [dict(row, status="planned") for row in vol_snap_optimize.plan_space(inventory, path)]
+  finally:
+    os.unlink(path)
+
+
+def run_guarantee(target_cluster, source_cluster, volumes, bench_args):
+  vol_guarantee.args = vol_guarantee.parse_args(["-c", target_cluster, "-svm", SVM, "-vol", "vol00000", "-p", "bench", "--guarantee", "none"])
+  results = []
+  for name in volumes:
+    vol_uuid, guarantee = vol_guarantee.get_volume_uuid(SVM, name, target_cluster)
+    if vol_guarantee.get_volume_type(name, vol_uuid, target_cluster).lower() == "rw" and guarantee != "none":
+      vol_guarantee.set_volume_guarantee(name, vol_uuid, target_cluster, "none")
+      vol_uuid, guarantee = vol_guarantee.get_volume_uuid(SVM, name, target_cluster, refresh=True)
+    results.append({"volume": name, "status": guarantee})
+  return results
+
+
+def run_guarantee_bulk(target_cluster, source_cluster, volumes, bench_args):
+  vol_guarantee.args = vol_guarantee.parse_args(["-c", target_cluster, "--bulk", "-p", "bench", "--guarantee", "none"])
+  reselect = lambda: vol_guarantee.select_volumes(target_cluster, SVM, "*")
+  return vol_guarantee.enforce_guarantee(target_cluster, reselect(), "none", 50, False, reselect)
+
+
+def run_audit(target_cluster, source_cluster, volumes, bench_args):
+  vol_guarantee.args = vol_guarantee.parse_args(["-c", target_cluster, "--audit", "-", "-p", "bench", "--guarantee", "none"])
+  counts = vol_guarantee.audit_volumes(target_cluster, None, None, "none", io.StringIO())
+  return [{"status": status} for status, n in counts.items() for _ in range(n)]
+
+
+def every(status: str):
+  return lambda volumes: {status: len(volumes)}
+
+
+SCENARIOS = [
+  Scenario("single-10k", "1 volume with 10k snapshots, source validation, dry-run", setup_single, run_single, lambda volumes: {"dry-run ok": 1}),
+  Scenario("single-10k-skip", "1 volume with 10k snapshots, no source validation, dry-run", setup_single, run_single_skip, lambda volumes: {"dry-run ok": 1}),
+  Scenario("fleet-1000x200", "1000 volumes with 200 snapshots each, fleet dry-run", setup_fleet, run_fleet, every("dry-run ok")),
+  Scenario("fleet-1000x200-async", "as fleet-1000x200, volumes and snapshots listed by the asyncio engine", setup_fleet, run_fleet_async, every("dry-run ok")),
+  Scenario("fleet-throttled", "as fleet-1000x200, cluster answers 429 past 4 requests in flight and 2% 503s", setup_fleet_throttled, run_fleet, every("dry-run ok")),
+  Scenario("fleet-paired", "as fleet-1000x200 with source validation, sources paired from SnapMirror relationships", setup_fleet_paired, run_fleet_paired, every("dry-run ok")),
+  Scenario("plan-1000x200", "reclaimable space plan of 1000 volumes with 200 snapshots each (async)", setup_fleet, run_plan, every("planned")),
+  Scenario("guarantee-1000", "set guarantee none on 1000 volumes one by one", setup_fleet, run_guarantee, every("none")),
+  Scenario("guarantee-audit-1000", "stream the guarantee compliance of 1000 volumes as JSON lines", setup_fleet, run_audit, every("non-compliant")),
+  Scenario("guarantee-bulk-1000", "set guarantee none on 1000 volumes with collection PATCHes", setup_fleet, run_guarantee_bulk, every("changed")),
+]
+
+
+def run_scenario(scenario: Scenario, bench_args) -> dict:
+  reset_state()
+  target, source = scenario.setup(bench_args.scale)
+  servers = []
+  clusters = []
+  for ontap in (target, source):
+    if ontap is None:
+      clusters.append(None)
+      continue
+    ontap.latency = bench_args.latency
+    server = fake_ontap.serve(ontap)
+    servers.append(server)
+    clusters.append(f"127.0.0.1:{server.server_address[1]}")
+  volumes = sorted(v["name"] for v in target.volumes.values())
+  ontap_session.init_sessions("bench", "bench", pool_size=bench_args.workers, scheme="http")
+
+  start = time.perf_counter()
+  results = scenario.run(clusters[0], clusters[1], volumes, bench_args)
+  wall = time.perf_counter() - start
+
+  for server in servers:
+    server.shutdown()
+    server.server_close()
+  fakes = [o for o in (target, source) if o is not None]
+  calls = {}
+  for ontap in fakes:
+    for key, n in ontap.calls.items():
+      calls[key] = calls.get(key, 0) + n
+  statuses = {}
+  for result in results:
+    statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+  expected = scenario.expected(volumes)
+  ok = statuses == expected
+  rejected = sum(o.rejected for o in fakes)
+  if rejected:
+    statuses["rejected by cluster"] = rejected
+  return {"scenario": scenario.name, "description": scenario.description, "volumes": len(volumes),
+          "wall_time": round(wall, 3), "rest_calls": sum(calls.values()),
+          "bytes": sum(o.bytes_sent for o in fakes), "calls": calls, "results": statuses,
+          "expected": expected, "ok": ok}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parse the command line arguments from the user"""
+
+    parser = argparse.ArgumentParser(description="Benchmark the scripts against a local fake ONTAP REST server")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=[s.name for s in SCENARIOS], help="Scenario to run, repeatable (default: all)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="Seconds added to every REST call")
+    parser.add_argument("--scale", dest="scale", type=float, default=1.0, help="Scale volume and snapshot counts (e.g. 0.1 for a quick run)")
+    parser.add_argument("--workers", dest="workers", type=int, default=16, help="Fleet workers")
+    parser.add_argument("--json", dest="json", required=False, help="Write the results to a JSON file")
+    parser.add_argument("--verbose", dest="verbose", action='store_true', default=False, help="Show the scripts' log output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  if not args.verbose:
+    logging.disable(logging.WARNING)
+
+  report = []
+  print(f'{"scenario":<20} {"volumes":>8} {"wall s":>9} {"REST calls":>11} {"MiB sent":>9}  results')
+  for scenario in SCENARIOS:
+    if args.scenarios and scenario.name not in args.scenarios:
+      continue
+    row = run_scenario(scenario, args)
+    report.append(row)
+    print(f'{row["scenario"]:<20} {row["volumes"]:>8} {row["wall_time"]:>9.3f} {row["rest_calls"]:>11} {row["bytes"] / 2**20:>9.2f}  {row["results"]}')
+    if not row["ok"]:
+      print(f'{"":<20} FAILED, expected {row["expected"]}')
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(report, f, indent=2)
+  # a scenario that ran but ended with the wrong statuses fails the benchmark
+  sys.exit(0 if all(row["ok"] for row in report) else 1)
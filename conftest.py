@@ -0,0 +1,34 @@
+################################################################
+# Shared pytest fixtures of the vol-optimize checks
+# (c)NetApp Professional Services Germany
+#
+# Summary: fake ONTAP clusters (fake_ontap.py) on localhost, with
+#          the scripts' module state reset around every test
+#
+################################################################
+
+from types import SimpleNamespace
+
+import pytest
+
+import fake_ontap
+import ontap_session
+import vol_snap_optimize
+from bench_vol_optimize import reset_state
+
+
+@pytest.fixture
+def clusters():
+  """A target and a source fake cluster, served until the test ends """
+  reset_state()
+  fakes = (fake_ontap.FakeOntap(), fake_ontap.FakeOntap())
+  servers = [fake_ontap.serve(ontap) for ontap in fakes]
+  ontap_session.init_sessions("test", "test", scheme="http")
+  yield [SimpleNamespace(ontap=ontap, name=f"127.0.0.1:{server.server_address[1]}") for ontap, server in zip(fakes, servers)]
+  if vol_snap_optimize._restore_tracker is not None:
+    vol_snap_optimize._restore_tracker.close()
+    vol_snap_optimize._restore_tracker = None
+  for server in servers:
+    server.shutdown()
+    server.server_close()
+  reset_state()
@@ -0,0 +1,402 @@
+################################################################
+# Local stand-in for the NetApp ONTAP REST API
+# (c)NetApp Professional Services Germany
+#
+# Summary: serves the volume, snapshot and job endpoints used by
+#          the scripts from in-memory data, with paging, order_by,
+#          field projection, query filters, validate_only restore
+#          PATCHes and a configurable per-request latency. Counts
+#          REST calls and bytes sent for the benchmarks.
+#
+#          python fake_ontap.py --port 8080 --volumes 10 --snapshots 200
+#
+################################################################
+
+import argparse
+import fnmatch
+import json
+import random
+import re
+import threading
+import time
+import uuid as uuidlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# query parameters that are not record filters
+RESERVED_PARAMS = {"fields", "order_by", "max_records", "return_records", "return_timeout", "offset"}
+# fields ONTAP returns even without being asked for
+KEY_FIELDS = ("uuid", "name")
+DEFAULT_PAGE = 10000
+
+SNAPSHOT_SIZE = 64 * 1024 * 1024
+
+
+def _get_path(record: dict, path: str):
+  value = record
+  for part in path.split("."):
+    if not isinstance(value, dict) or part not in value:
+      return None
+    value = value[part]
+  return value
+
+
+def _compare(value, term: str) -> bool:
+  """Match one ONTAP query term (operators, * wildcards, ! negation) against a value """
+  for op in (">=", "<=", ">", "<"):
+    if term.startswith(op):
+      bound = term[len(op):]
+      try:
+        left, right = float(value), float(bound)
+      except (TypeError, ValueError):
+        left, right = str(value), bound
+        if re.match(r"\d{4}-\d\d-\d\dT", right):
+          left, right = datetime.fromisoformat(left), datetime.fromisoformat(right)
+      return {">=": left >= right, "<=": left <= right, ">": left > right, "<": left < right}[op]
+  if term.startswith("!"):
+    return not _compare(value, term[1:])
+  if isinstance(value, bool):
+    return str(value).lower() == term.lower()
+  return fnmatch.fnmatchcase(str(value), term)
+
+
+def matches(record: dict, query: dict) -> bool:
+  for key, expr in query.items():
+    value = _get_path(record, key)
+    if value is None or not any(_compare(value, term) for term in expr.split("|")):
+      return False
+  return True
+
+
+def _project_path(record: dict, out: dict, parts: list):
+  """Copy one dotted field, descending into lists such as aggregates.name """
+  head, rest = parts[0], parts[1:]
+  if head not in record:
+    return
+  value = record[head]
+  if not rest:
+    out[head] = json.loads(json.dumps(value))
+  elif isinstance(value, list):
+    items = out.setdefault(head, [{} for _ in value])
+    for item, item_out in zip(value, items):
+      if isinstance(item, dict):
+        _project_path(item, item_out, rest)
+  elif isinstance(value, dict):
+    _project_path(value, out.setdefault(head, {}), rest)
+
+
+def project(record: dict, fields: str) -> dict:
+  """Copy the requested (dotted) fields of a record """
+  if fields == "*" or fields == "**":
+    return json.loads(json.dumps(record))
+  out = {key: record[key] for key in KEY_FIELDS if key in record}
+  for field in filter(None, (fields or "").split(",")):
+    _project_path(record, out, field.split("."))
+  return out
+
+
+class FakeOntap:
+  """In-memory ONTAP data shared by the request handlers """
+
+  def __init__(self, latency: float = 0.0, job_duration: float = 0.0, max_in_flight: int = 0, error_rate: float = 0.0):
+    self.latency = latency
+    self.job_duration = job_duration
+    # simulated overload: 429 past max_in_flight concurrent requests, random 503s
+    self.max_in_flight = max_in_flight
+    self.error_rate = error_rate
+    self.in_flight = 0
+    self.volumes = {}
+    self.snapshots = {}
+    self.jobs = {}
+    self.relationships = []
+    self.lock = threading.Lock()
+    self.reset_counters()
+
+  def reset_counters(self):
+    self.calls = {}
+    self.bytes_sent = 0
+    self.rejected = 0
+
+  def admit(self):
+    """Take a request slot, returns an error status if the request is turned away """
+    with self.lock:
+      self.in_flight += 1
+      if self.max_in_flight and self.in_flight > self.max_in_flight:
+        self.rejected += 1
+        return 429
+      if self.error_rate and random.random() < self.error_rate:
+        self.rejected += 1
+        return 503
+    return None
+
+  def done(self):
+    with self.lock:
+      self.in_flight -= 1
+
+  @property
+  def call_count(self) -> int:
+    return sum(self.calls.values())
+
+  def count(self, method: str, endpoint: str, sent: int):
+    with self.lock:
+      key = f"{method} {endpoint}"
+      self.calls[key] = self.calls.get(key, 0) + 1
+      self.bytes_sent += sent
+
+  def add_volume(self, svm: str, name: str, snapshots: int = 0, vol_type: str = "rw", guarantee: str = "volume",
+                 aggregate: str = "aggr1", prefix_every: int = 24, size: int = 100 * 1024 ** 3) -> str:
+    """Add a volume with `snapshots` hourly snapshots, every `prefix_every`-th one is a FREEZE snapshot """
+    vol_uuid = str(uuidlib.uuid4())
+    self.volumes[vol_uuid] = {
+      "uuid": vol_uuid, "name": name, "type": vol_type, "state": "online",
+      "svm": {"name": svm, "uuid": str(uuidlib.uuid5(uuidlib.NAMESPACE_DNS, svm))},
+      "guarantee": {"type": guarantee},
+      "aggregates": [{"name": aggregate, "uuid": str(uuidlib.uuid5(uuidlib.NAMESPACE_DNS, aggregate))}],
+      "space": {"size": size, "used": size // 2, "available": size // 2},
+    }
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    snaps = []
+    for i in range(snapshots):
+      name = f"FREEZE_{i:06d}" if prefix_every and i % prefix_every == 0 else f"hourly.{i:06d}"
+      snaps.append(self.make_snapshot(vol_uuid, name, start + timedelta(hours=i)))
+    self.snapshots[vol_uuid] = snaps
+    return vol_uuid
+
+  def make_snapshot(self, vol_uuid: str, name: str, create_time: datetime) -> dict:
+    vol = self.volumes[vol_uuid]
+    # the instance uuid is per volume, the version_uuid stays the same on SnapMirror copies
+    return {"uuid": str(uuidlib.uuid4()), "version_uuid": str(uuidlib.uuid4()), "name": name, "create_time": create_time.isoformat(),
+            "size": SNAPSHOT_SIZE, "volume": {"uuid": vol_uuid, "name": vol["name"]}, "svm": dict(vol["svm"])}
+
+  def add_relationship(self, source_svm: str, source_volume: str, destination_uuid: str, source_cluster: str):
+    dest = self.volumes[destination_uuid]
+    self.relationships.append({
+      "uuid": str(uuidlib.uuid4()), "healthy": True, "state": "snapmirrored",
+      "source": {"path": f"{source_svm}:{source_volume}", "svm": {"name": source_svm}, "cluster": {"name": source_cluster}},
+      "destination": {"path": f'{dest["svm"]["name"]}:{dest["name"]}', "svm": {"name": dest["svm"]["name"]}, "uuid": destination_uuid},
+    })
+
+  def restore(self, vol_uuid: str, snap_uuid: str):
+    """Drop all snapshots younger than the restore snapshot """
+    snaps = self.snapshots.get(vol_uuid, [])
+    for pos, snap in enumerate(snaps):
+      if snap["uuid"] == snap_uuid:
+        del snaps[pos + 1:]
+        return True
+    return False
+
+  def new_job(self, description: str) -> dict:
+    job_uuid = str(uuidlib.uuid4())
+    now = time.time()
+    self.jobs[job_uuid] = {"uuid": job_uuid, "description": description, "start": now, "end": now + self.job_duration}
+    return {"uuid": job_uuid, "_links": {"self": {"href": f"/api/cluster/jobs/{job_uuid}"}}}
+
+  def job_state(self, job_uuid: str):
+    job = self.jobs.get(job_uuid)
+    if job is None:
+      return None
+    done = time.time() >= job["end"]
+    state = {"uuid": job_uuid, "description": job["description"], "state": "success" if done else "running",
+             "message": "success" if done else "running", "code": 0,
+             "start_time": datetime.fromtimestamp(job["start"], timezone.utc).isoformat()}
+    if done:
+      state["end_time"] = datetime.fromtimestamp(job["end"], timezone.utc).isoformat()
+    return state
+
+
+class FakeOntapHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  # send headers and body in one segment, keep-alive clients otherwise wait for delayed ACKs
+  wbufsize = 64 * 1024
+  disable_nagle_algorithm = True
+  ontap = None  # FakeOntap, set by serve()
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send(self, status: int, body: dict, endpoint: str, headers: dict = None):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.send_header("Content-Type", "application/hal+json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+    self.ontap.count(self.command, endpoint, len(data))
+
+  def _error(self, status: int, message: str, endpoint: str):
+    self._send(status, {"error": {"message": message, "code": str(status)}}, endpoint)
+
+  def _body(self) -> dict:
+    length = int(self.headers.get("Content-Length") or 0)
+    raw = self.rfile.read(length) if length else b""
+    return json.loads(raw) if raw.strip() else {}
+
+  def _route(self):
+    url = urlsplit(self.path)
+    parts = [p for p in url.path.split("/") if p]
+    return parts, dict(parse_qsl(url.query, keep_blank_values=True)), url.path
+
+  def _collection(self, records, params: dict, path: str, endpoint: str):
+    query = {k: v for k, v in params.items() if k not in RESERVED_PARAMS}
+    selected = [r for r in records if matches(r, query)]
+    if params.get("order_by"):
+      key, _, direction = params["order_by"].partition(" ")
+      selected.sort(key=lambda r: (_get_path(r, key) is None, _get_path(r, key)), reverse=direction.strip() == "desc")
+    if params.get("return_records") == "false":
+      return self._send(200, {"num_records": len(selected)}, endpoint)
+    offset = int(params.get("offset") or 0)
+    page = int(params.get("max_records") or DEFAULT_PAGE)
+    chunk = selected[offset:offset + page]
+    body = {"records": [project(r, params.get("fields")) for r in chunk], "num_records": len(chunk),
+            "_links": {"self": {"href": path}}}
+    if offset + page < len(selected):
+      next_params = dict(params, offset=str(offset + page))
+      body["_links"]["next"] = {"href": f"{path}?{urlencode(next_params)}"}
+    self._send(200, body, endpoint)
+
+  def _admitted(self, handler):
+    rejected = self.ontap.admit()
+    try:
+      if rejected is None:
+        return handler()
+      self._body()
+      time.sleep(self.ontap.latency)
+      self._send(rejected, {"error": {"message": "too many requests" if rejected == 429 else "service unavailable", "code": str(rejected)}},
+                 "rejected", {"Retry-After": "1"} if rejected == 429 else None)
+    finally:
+      self.ontap.done()
+
+  def do_GET(self):
+    self._admitted(self._get)
+
+  def do_PATCH(self):
+    self._admitted(self._patch)
+
+  def _get(self):
+    time.sleep(self.ontap.latency)
+    parts, params, path = self._route()
+    ontap = self.ontap
+    with ontap.lock:
+      volumes = list(ontap.volumes.values())
+    if parts[:3] == ["api", "storage", "volumes"]:
+      if len(parts) == 3:
+        return self._collection(volumes, params, path, "volumes")
+      vol_uuid = parts[3]
+      if vol_uuid not in ontap.volumes:
+        return self._error(404, f'volume "{vol_uuid}" not found', "volume")
+      if len(parts) == 4:
+        return self._send(200, project(ontap.volumes[vol_uuid], params.get("fields")), "volume")
+      if parts[4] == "snapshots":
+        with ontap.lock:
+          snaps = list(ontap.snapshots.get(vol_uuid, []))
+        if len(parts) == 5:
+          return self._collection(snaps, params, path, "snapshots")
+        for snap in snaps:
+          if snap["uuid"] == parts[5]:
+            return self._send(200, project(snap, params.get("fields") or "*"), "snapshot")
+        return self._error(404, f'snapshot "{parts[5]}" not found', "snapshot")
+    if parts[:3] == ["api", "cluster", "jobs"] and len(parts) == 4:
+      job = ontap.job_state(parts[3])
+      if job is None:
+        return self._error(404, "job not found", "job")
+      return self._send(200, job, "job")
+    if parts[:3] == ["api", "snapmirror", "relationships"] and len(parts) == 3:
+      return self._collection(ontap.relationships, params, path, "snapmirror")
+    self._error(404, f"{path} is not implemented", "unknown")
+
+  def _refused(self, vol: dict, restore_snap: str):
+    """(status, message, endpoint) if ONTAP would refuse the PATCH of this volume, else None """
+    if restore_snap:
+      if vol["type"] != "rw":
+        return 400, f'volume "{vol["name"]}" is not RW', "volume restore"
+      if not any(s["uuid"] == restore_snap for s in self.ontap.snapshots.get(vol["uuid"], [])):
+        return 400, f'snapshot "{restore_snap}" not found', "volume restore"
+    elif vol["state"] != "online":
+      return 400, f'volume "{vol["name"]}" is {vol["state"]} and cannot be modified', "volume patch"
+    return None
+
+  def _patch(self):
+    time.sleep(self.ontap.latency)
+    parts, params, path = self._route()
+    body = self._body()
+    ontap = self.ontap
+    if parts[:3] != ["api", "storage", "volumes"] or len(parts) > 4:
+      return self._error(404, f"{path} is not implemented", "unknown")
+
+    validate_only = str(params.pop("validate_only", body.pop("validate_only", "false"))).lower() == "true"
+    restore_snap = params.pop("restore_to.snapshot.uuid", None) or _get_path(body, "restore_to.snapshot.uuid")
+    if len(parts) == 4:
+      targets = [ontap.volumes.get(parts[3])] if parts[3] in ontap.volumes else []
+      updates = [(targets[0], body)] if targets else []
+    elif "records" in body:
+      updates = [(ontap.volumes.get(r.get("uuid")), {k: v for k, v in r.items() if k != "uuid"}) for r in body["records"]]
+      updates = [(vol, change) for vol, change in updates if vol is not None]
+    else:
+      query = {k: v for k, v in params.items() if k not in RESERVED_PARAMS}
+      updates = [(vol, body) for vol in list(ontap.volumes.values()) if matches(vol, query)]
+    if not updates:
+      return self._error(404, "no matching volume", "volume patch")
+
+    with ontap.lock:
+      # a request that fails for one volume changes none of them
+      error = next(filter(None, (self._refused(vol, restore_snap) for vol, _ in updates)), None)
+      if error is None:
+        for vol, change in updates:
+          if validate_only:
+            continue
+          if restore_snap:
+            ontap.restore(vol["uuid"], restore_snap)
+            continue
+          for key, value in change.items():
+            if key == "restore_to":
+              continue
+            if isinstance(value, dict) and isinstance(vol.get(key), dict):
+              vol[key].update(value)
+            else:
+              vol[key] = value
+        job = ontap.new_job("PATCH /api/storage/volumes")
+    # answered outside the lock, which count() takes
+    if error is not None:
+      return self._error(*error)
+    endpoint = "volume restore" if restore_snap else "volume patch"
+    self._send(202, {"num_records": len(updates), "job": job}, endpoint)
+
+
+def serve(ontap: FakeOntap, port: int = 0, host: str = "127.0.0.1"):
+  """Start the fake server in a background thread, returns the server (server_address has the port) """
+  handler = type("Handler", (FakeOntapHandler,), {"ontap": ontap})
+  server = ThreadingHTTPServer((host, port), handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name="fake-ontap", daemon=True).start()
+  return server
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parse the command line arguments from the user"""
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the ONTAP REST API used by the scripts")
+    parser.add_argument("--port", dest="port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--svm", dest="svm", default="svm1", help="SVM name of the generated volumes")
+    parser.add_argument("--volumes", dest="volumes", type=int, default=10, help="Number of volumes to generate")
+    parser.add_argument("--snapshots", dest="snapshots", type=int, default=200, help="Snapshots per volume")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--max_in_flight", dest="max_in_flight", type=int, default=0, help="Answer 429 past this many concurrent requests")
+    parser.add_argument("--error_rate", dest="error_rate", type=float, default=0.0, help="Share of requests answered with 503")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  ontap = FakeOntap(latency=args.latency, max_in_flight=args.max_in_flight, error_rate=args.error_rate)
+  for n in range(args.volumes):
+    ontap.add_volume(args.svm, f"vol{n:05d}", snapshots=args.snapshots)
+  server = serve(ontap, args.port)
+  print(f"Fake ONTAP on http://127.0.0.1:{server.server_address[1]} with {args.volumes} volumes, Ctrl-C to stop")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -0,0 +1,228 @@
+################################################################
+# asyncio discovery of NetApp ONTAP volumes and snapshots
+# (c)NetApp Professional Services Germany
+#
+# Summary: optional read-only discovery engine. Sends the same
+#          volume and snapshot collection queries as the
+#          netapp_ontap resources, but over one aiohttp session per
+#          cluster with many requests in flight, and decodes only
+#          the fields the scripts use from the JSON responses.
+#          Needs aiohttp (pip install aiohttp).
+#
+################################################################
+
+import asyncio
+import logging
+import time
+
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+from netapp_ontap import NetAppRestError
+
+from ontap_metrics import metrics
+from ontap_session import split_cluster
+from ontap_throttle import GET_POLICY, FAILED, classify, retry_after
+from snapmirror_index import RELATIONSHIP_FIELDS, relationship_json_record
+from snapshot_index import SnapshotIndex, snapshot_json_record
+from space_planner import SIZE_FIELDS, SnapshotSizes
+from volume_lookup import VOLUME_FIELDS, NAME_BATCH, PAGE_SIZE, volume_json_record
+
+DEFAULT_CONCURRENCY = 32
+# the only snapshot fields the selection logic reads (uuid is always returned)
+SNAPSHOT_JSON_FIELDS = "name,create_time,version_uuid"
+
+log = logging.getLogger('ontapAsync')
+
+
+class AsyncCluster:
+  """One aiohttp session to a cluster with at most `concurrency` requests in flight """
+
+  def __init__(self, cluster: str, username, password, verify: bool = False, scheme: str = "https",
+               concurrency: int = DEFAULT_CONCURRENCY, timeout: float = 300.0, throttle=None):
+    host, port = split_cluster(cluster)
+    self.cluster = cluster
+    self.throttle = throttle
+    self.origin = f"{scheme}://{host}:{port}"
+    self._auth = aiohttp.BasicAuth(username, password)
+    self._ssl = None if verify else False
+    self._concurrency = max(1, concurrency)
+    self._timeout = aiohttp.ClientTimeout(total=timeout)
+    self._session = None
+
+  async def __aenter__(self):
+    connector = aiohttp.TCPConnector(limit=self._concurrency, ssl=self._ssl)
+    self._session = aiohttp.ClientSession(auth=self._auth, connector=connector, timeout=self._timeout,
+                                          headers={"Accept": "application/json"})
+    return self
+
+  async def __aexit__(self, *exc):
+    await self._session.close()
+
+  async def _send(self, path: str, params: dict, helper: str, attempt: int):
+    """One attempt, returns (status, body, Retry-After) """
+    start = time.perf_counter()
+    try:
+      async with self._session.get(self.origin + path, params=params) as response:
+        body = await response.json(content_type=None)
+        status = response.status
+        pause = retry_after(response.headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+      metrics.record_request(self.cluster, time.perf_counter() - start, 599, retries=1 if attempt else 0, helper=helper)
+      raise NetAppRestError(f"GET {path} on cluster {self.cluster} failed: {err!r}") from err
+    metrics.record_request(self.cluster, time.perf_counter() - start, status, body.get("num_records", 1), 1 if attempt else 0, helper=helper)
+    return status, body, pause
+
+  async def get(self, path: str, params: dict = None, helper: str = "async_discovery") -> dict:
+    """GET one page through the cluster's throttle with the GET retry policy,
+       errors are raised as NetAppRestError like the resource calls do """
+    attempt = 0
+    while True:
+      if self.throttle is not None:
+        await self.throttle.acquire_async()
+      outcome, pause = FAILED, None
+      try:
+        status, body, pause = await self._send(path, params, helper, attempt)
+        outcome = classify(status)
+      except NetAppRestError:
+        if attempt + 1 >= GET_POLICY.attempts:
+          raise
+        status = None
+      finally:
+        if self.throttle is not None:
+          self.throttle.release(outcome, pause)
+      if status is not None and (status not in GET_POLICY.statuses or attempt + 1 >= GET_POLICY.attempts):
+        break
+      delay = GET_POLICY.backoff(attempt, pause)
+      log.warning(f'GET {path} on cluster {self.cluster} {"failed" if status is None else f"returned {status}"}, retry {attempt + 1} in {delay:.1f}s')
+      await asyncio.sleep(delay)
+      attempt += 1
+    if status >= 400:
+      error = body.get("error", {})
+      raise NetAppRestError(f"GET {path} on cluster {self.cluster} returned {status}: {error.get('message', '')} ({error.get('code', '')})")
+    return body
+
+  async def records(self, path: str, params: dict, helper: str = "async_discovery"):
+    """All records of a collection query, following the next links """
+    records = []
+    while path:
+      body = await self.get(path, params, helper)
+      records += body.get("records", [])
+      path, params = body.get("_links", {}).get("next", {}).get("href"), None
+    return records
+
+
+async def _resolve(client: AsyncCluster, names) -> list:
+  """Bulk volume lookup, the same batched svm.name/name queries as volume_lookup.resolve_volumes() """
+  by_svm = {}
+  for svm, name in names:
+    by_svm.setdefault(svm, set()).add(name)
+  queries = []
+  for svm, svm_names in by_svm.items():
+    svm_names = sorted(svm_names)
+    for start in range(0, len(svm_names), NAME_BATCH):
+      params = {"svm.name": svm, "name": "|".join(svm_names[start:start + NAME_BATCH]),
+                "fields": VOLUME_FIELDS, "max_records": str(PAGE_SIZE)}
+      queries.append(client.records("/api/storage/volumes", params, "resolve_volumes"))
+  pages = await asyncio.gather(*queries)
+  return [volume_json_record(record) for page in pages for record in page]
+
+
+async def _snapshots(client: AsyncCluster, volume_uuid: str):
+  records = await client.records(f"/api/storage/volumes/{volume_uuid}/snapshots",
+                                 {"fields": SNAPSHOT_JSON_FIELDS, "order_by": "create_time"}, "get_snapshot_index")
+  return SnapshotIndex(volume_uuid, client.cluster, [snapshot_json_record(record) for record in records])
+
+
+async def _discover_cluster(cluster: str, names, sessions, concurrency: int, want_snapshots):
+  volumes, indexes = [], {}
+  async with AsyncCluster(cluster, sessions.username, sessions.password, verify=sessions.verify, scheme=sessions.scheme,
+                          concurrency=concurrency, throttle=sessions.throttles.get(cluster)) as client:
+    try:
+      volumes = await _resolve(client, names)
+    except NetAppRestError as err:
+      log.error(f'Async volume lookup on cluster {cluster} failed: {err}')
+      return volumes, indexes
+    uuids = [record["uuid"] for record in volumes if want_snapshots(cluster, record["uuid"])]
+    results = await asyncio.gather(*(_snapshots(client, uuid) for uuid in uuids), return_exceptions=True)
+    for uuid, result in zip(uuids, results):
+      if isinstance(result, Exception):
+        # the synchronous path fetches this volume again later
+        log.error(f'Async snapshot listing of volume {uuid} on cluster {cluster} failed: {result}')
+        continue
+      indexes[(cluster, uuid)] = result
+  return volumes, indexes
+
+
+async def _discover(names_by_cluster: dict, sessions, concurrency: int, want_snapshots):
+  results = await asyncio.gather(*(_discover_cluster(cluster, names, sessions, concurrency, want_snapshots)
+                                   for cluster, names in names_by_cluster.items()))
+  return {cluster: result for cluster, result in zip(names_by_cluster, results)}
+
+
+async def _sizes_cluster(cluster: str, uuids: list, sessions, concurrency: int):
+  sizes = {}
+  async with AsyncCluster(cluster, sessions.username, sessions.password, verify=sessions.verify, scheme=sessions.scheme,
+                          concurrency=concurrency, throttle=sessions.throttles.get(cluster)) as client:
+    results = await asyncio.gather(*(client.records(f"/api/storage/volumes/{uuid}/snapshots",
+                                                    {"fields": SIZE_FIELDS, "order_by": "create_time", "max_records": str(PAGE_SIZE)}, "snapshot_sizes")
+                                     for uuid in uuids), return_exceptions=True)
+  for uuid, result in zip(uuids, results):
+    if isinstance(result, Exception):
+      log.error(f'Async snapshot size listing of volume {uuid} on cluster {cluster} failed: {result}')
+      continue
+    sizes[(cluster, uuid)] = SnapshotSizes.from_json(result)
+  return sizes
+
+
+async def _all_sizes(uuids_by_cluster: dict, sessions, concurrency: int):
+  results = await asyncio.gather(*(_sizes_cluster(cluster, uuids, sessions, concurrency) for cluster, uuids in uuids_by_cluster.items()))
+  return {key: sizes for result in results for key, sizes in result.items()}
+
+
+def snapshot_sizes(uuids_by_cluster: dict, sessions, concurrency: int = DEFAULT_CONCURRENCY) -> dict:
+  """SnapshotSizes of many volumes on all clusters at once, {(cluster, volume uuid): SnapshotSizes}.
+     Volumes whose listing failed are left out """
+  if aiohttp is None:
+    raise SystemExit("aiohttp is required for async discovery: pip install aiohttp")
+  return asyncio.run(_all_sizes(uuids_by_cluster, sessions, concurrency))
+
+
+async def _relationships(cluster: str, sessions, concurrency: int):
+  async with AsyncCluster(cluster, sessions.username, sessions.password, verify=sessions.verify, scheme=sessions.scheme,
+                          concurrency=concurrency, throttle=sessions.throttles.get(cluster)) as client:
+    records = await client.records("/api/snapmirror/relationships",
+                                   {"fields": RELATIONSHIP_FIELDS, "max_records": str(PAGE_SIZE)}, "load_relationships")
+  return [relationship_json_record(record) for record in records]
+
+
+async def _all_relationships(clusters: list, sessions, concurrency: int):
+  results = await asyncio.gather(*(_relationships(cluster, sessions, concurrency) for cluster in clusters), return_exceptions=True)
+  found = {}
+  for cluster, result in zip(clusters, results):
+    if isinstance(result, Exception):
+      log.error(f'Async SnapMirror relationship listing on cluster {cluster} failed: {result}')
+      continue
+    found[cluster] = result
+  return found
+
+
+def relationships(clusters, sessions, concurrency: int = DEFAULT_CONCURRENCY) -> dict:
+  """SnapMirror relationship records of several destination clusters at once, {cluster: records}.
+     Clusters whose listing failed are left out """
+  if aiohttp is None:
+    raise SystemExit("aiohttp is required for async discovery: pip install aiohttp")
+  return asyncio.run(_all_relationships(list(clusters), sessions, concurrency))
+
+
+def discover(names_by_cluster: dict, sessions, concurrency: int = DEFAULT_CONCURRENCY, want_snapshots=None) -> dict:
+  """Resolve (svm, volume) names and list the snapshots of every volume found, all clusters at once.
+
+  Uses the credentials of a ClusterSessions registry. Returns
+  {cluster: (volume records, {(cluster, volume uuid): SnapshotIndex})}.
+  want_snapshots(cluster, uuid) can exclude volumes from the snapshot listing. """
+  if aiohttp is None:
+    raise SystemExit("aiohttp is required for async discovery: pip install aiohttp")
+  return asyncio.run(_discover(names_by_cluster, sessions, concurrency, want_snapshots or (lambda cluster, uuid: True)))
@@ -0,0 +1,45 @@
+################################################################
+# Non-blocking logging for the ONTAP scripts
+# (c)NetApp Professional Services Germany
+#
+# Summary: moves the handlers of the scripts' loggers behind
+#          queues. Worker threads only put records on a queue, a
+#          listener thread per logger formats and writes them, so
+#          slow consoles or disks never hold up REST calls
+#
+################################################################
+
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_listeners = []
+
+
+def queue_handlers(*loggers) -> list:
+  """Replace the handlers of the given loggers (default: the root logger) by one QueueHandler
+     each. The original handlers keep their levels and formatters and run on a listener
+     thread. Call after all handlers are configured """
+  for logger in loggers or (logging.getLogger(),):
+    handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+      continue
+    records = queue.SimpleQueue()
+    for handler in handlers:
+      logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+  return _listeners
+
+
+def stop_queue_handlers():
+  """Write out everything still queued and stop the listener threads """
+  while _listeners:
+    _listeners.pop().stop()
+
+
+# records queued at exit are still written
+atexit.register(stop_queue_handlers)
@@ -0,0 +1,209 @@
+################################################################
+# REST call instrumentation for the ONTAP scripts
+# (c)NetApp Professional Services Germany
+#
+# Summary: counts helper calls and the HTTP requests they make per
+#          helper and cluster (latency histogram, records returned,
+#          errors, retries) and exports them as a JSON summary or a
+#          Prometheus textfile
+#
+################################################################
+
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Histogram:
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, seconds: float):
+    for pos, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.counts[pos] += 1
+        break
+    self.sum += seconds
+    self.count += 1
+
+  def to_dict(self) -> dict:
+    return {"count": self.count, "sum": round(self.sum, 6),
+            "buckets": {("+Inf" if b == float("inf") else str(b)): c for b, c in zip(BUCKETS, self.counts)}}
+
+
+class CallStats:
+  """Counters of one (helper, cluster) pair """
+
+  def __init__(self):
+    self.calls = 0
+    self.requests = 0
+    self.errors = 0
+    self.retries = 0
+    self.records = 0
+    self.latency = Histogram()
+    self.request_latency = Histogram()
+
+  def to_dict(self) -> dict:
+    return {"calls": self.calls, "requests": self.requests, "errors": self.errors, "retries": self.retries,
+            "records": self.records, "latency": self.latency.to_dict(), "request_latency": self.request_latency.to_dict()}
+
+
+class Metrics:
+  """Per helper and cluster call statistics plus per phase timings """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.stats = {}
+    self.phases = {}
+    self.started = time.time()
+
+  def _stats(self, helper: str, cluster: str) -> CallStats:
+    key = (helper, cluster or "-")
+    stats = self.stats.get(key)
+    if stats is None:
+      stats = self.stats[key] = CallStats()
+    return stats
+
+  def _stack(self):
+    stack = getattr(self._local, "stack", None)
+    if stack is None:
+      stack = self._local.stack = []
+    return stack
+
+  @contextmanager
+  def call(self, helper: str, cluster: str):
+    """Attribute the HTTP requests made inside the block to a helper """
+    stack = self._stack()
+    stack.append((helper, cluster))
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      stack.pop()
+      with self._lock:
+        stats = self._stats(helper, cluster)
+        stats.calls += 1
+        stats.latency.observe(elapsed)
+
+  def record_request(self, cluster: str, seconds: float, status: int, records: int = 0, retries: int = 0, helper: str = None):
+    """Called by the HTTP adapter for every request sent. Async callers name the helper
+       themselves, their requests interleave on one thread """
+    if helper is None:
+      stack = self._stack()
+      helper = stack[-1][0] if stack else "other"
+    with self._lock:
+      stats = self._stats(helper, cluster)
+      stats.requests += 1
+      stats.records += records
+      stats.retries += retries
+      stats.request_latency.observe(seconds)
+      if status >= 400:
+        stats.errors += 1
+
+  def record_phase(self, phase: str, seconds: float):
+    with self._lock:
+      total = self.phases.setdefault(phase, [0, 0.0])
+      total[0] += 1
+      total[1] += seconds
+
+  def summary(self) -> dict:
+    with self._lock:
+      helpers = {}
+      for (helper, cluster), stats in sorted(self.stats.items()):
+        helpers.setdefault(helper, {})[cluster] = stats.to_dict()
+      return {
+        "started": self.started, "duration": round(time.time() - self.started, 3),
+        "requests": sum(s.requests for s in self.stats.values()),
+        "helpers": helpers,
+        "phases": {phase: {"count": n, "seconds": round(sec, 6)} for phase, (n, sec) in sorted(self.phases.items())},
+      }
+
+  def write_json(self, path: str):
+    with open(path, "w") as f:
+      json.dump(self.summary(), f, indent=2)
+
+  def write_prometheus(self, path: str, prefix: str = "ontap"):
+    """Write a node_exporter textfile (atomically, via a temporary file) """
+    lines = []
+    counters = [("helper_calls_total", "calls", "Helper invocations"),
+                ("rest_requests_total", "requests", "HTTP requests sent"),
+                ("rest_errors_total", "errors", "HTTP responses with status >= 400"),
+                ("rest_retries_total", "retries", "HTTP retries done by the connection pool"),
+                ("rest_records_total", "records", "Records returned by collection queries")]
+    with self._lock:
+      items = sorted(self.stats.items())
+      for name, attr, text in counters:
+        lines += [f"# HELP {prefix}_{name} {text}", f"# TYPE {prefix}_{name} counter"]
+        for (helper, cluster), stats in items:
+          lines.append(f'{prefix}_{name}{{helper="{helper}",cluster="{cluster}"}} {getattr(stats, attr)}')
+      for name, attr, text in [("helper_duration_seconds", "latency", "Helper call duration"),
+                               ("rest_request_duration_seconds", "request_latency", "HTTP request duration")]:
+        lines += [f"# HELP {prefix}_{name} {text}", f"# TYPE {prefix}_{name} histogram"]
+        for (helper, cluster), stats in items:
+          hist = getattr(stats, attr)
+          labels = f'helper="{helper}",cluster="{cluster}"'
+          cumulative = 0
+          for bound, count in zip(BUCKETS, hist.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append(f'{prefix}_{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+          lines.append(f"{prefix}_{name}_sum{{{labels}}} {hist.sum:.6f}")
+          lines.append(f"{prefix}_{name}_count{{{labels}}} {hist.count}")
+      lines += [f"# HELP {prefix}_phase_seconds_total Time spent per run phase", f"# TYPE {prefix}_phase_seconds_total counter"]
+      for phase, (_, seconds) in sorted(self.phases.items()):
+        lines.append(f'{prefix}_phase_seconds_total{{phase="{phase}"}} {seconds:.6f}')
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+      f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+def instrumented(func):
+  """Count a helper's calls and the requests it sends, per its `cluster` argument """
+  signature = inspect.signature(func)
+  name = func.__name__
+
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    bound = signature.bind_partial(*args, **kwargs)
+    with metrics.call(name, bound.arguments.get("cluster")):
+      return func(*args, **kwargs)
+  return wrapper
+
+
+@contextmanager
+def timed(timings: dict, phase: str):
+  """Add the block's duration to timings[phase] and to the run's phase totals """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    timings[phase] = timings.get(phase, 0.0) + elapsed
+    metrics.record_phase(phase, elapsed)
+
+
+def export_metrics(logger, json_path: str = None, prometheus_path: str = None):
+  """Write the summary where requested, otherwise log it as one JSON line """
+  if json_path:
+    metrics.write_json(json_path)
+    logger.info(f'Metrics summary written to {json_path}')
+  else:
+    logger.info(f'Metrics summary: {json.dumps(metrics.summary())}')
+  if prometheus_path:
+    metrics.write_prometheus(prometheus_path)
+    logger.info(f'Prometheus metrics written to {prometheus_path}')
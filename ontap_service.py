@@ -0,0 +1,497 @@
+################################################################
+# Service mode for vol_snap_optimize.py and vol_guarantee.py
+# (c)NetApp Professional Services Germany
+#
+# Summary: long-running process that imports both scripts once,
+#          keeps the cluster sessions, volume tables and snapshot
+#          indexes warm and runs optimize, dry-run, guarantee and
+#          list jobs from a queue. Jobs are submitted over a local
+#          HTTP API on a Unix socket (default) or on localhost, every
+#          request carries the service's bearer token:
+#
+#          python ontap_service.py -u admin --socket /run/vol-optimize.sock
+#          curl -s --unix-socket /run/vol-optimize.sock -XPOST localhost/jobs \
+#            -H "Authorization: Bearer $(cat ontap_service.token)" \
+#            -H "Content-Type: application/json" -d '{"type": "dry-run",
+#            "cluster": "cluster1", "vserver": "svm1", "volume": "vol1",
+#            "skip_src_validation": true}'
+#
+################################################################
+
+import argparse
+import contextvars
+import hmac
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import secrets
+import signal
+import socketserver
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from getpass import getpass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from netapp_ontap import NetAppRestError
+
+import vol_guarantee
+import vol_snap_optimize
+from ontap_metrics import metrics, export_metrics
+from ontap_logging import queue_handlers
+from ontap_session import init_sessions, session_stats, log_session_stats
+from run_journal import RunJournal
+
+log = logging.getLogger('ontapService')
+
+JOB_TYPES = ("optimize", "dry-run", "guarantee", "list")
+# options a job may set for itself, everything else comes from the service command line
+JOB_OPTIONS = ("skip_src_validation", "verify_scan", "profile", "refresh_catalog")
+# the scripts insist on a target, jobs bring their own
+PLACEHOLDER = ["-c", "service", "-svm", "service", "-vol", "service"]
+# names a browser may use for the TCP listener, anything else is a rebound DNS name
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "[::1]")
+# longest long poll of GET /jobs/<id>?wait=<seconds>
+MAX_WAIT = 3600
+
+
+class JobArgs:
+  """Stands in for a script's `args`: a job's own options in the job's context, the
+     service options everywhere else. Helper threads see the job's options when the
+     scripts hand them a copy of the context (contextvars.copy_context().run) """
+
+  def __init__(self, base: argparse.Namespace):
+    self._base = base
+    self._overrides = contextvars.ContextVar("job_options", default=None)
+
+  def __getattr__(self, name):
+    overrides = self._overrides.get()
+    if overrides and name in overrides:
+      return overrides[name]
+    return getattr(self._base, name)
+
+  @contextmanager
+  def override(self, **values):
+    token = self._overrides.set(values)
+    try:
+      yield
+    finally:
+      self._overrides.reset(token)
+
+
+class ServiceJob:
+  def __init__(self, job_id: int, kind: str, params: dict):
+    self.id = job_id
+    self.kind = kind
+    self.params = params
+    self.state = "queued"
+    self.result = None
+    self.error = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+    self.done = threading.Event()
+    self.lock = threading.Lock()
+
+  @property
+  def current_state(self) -> str:
+    # a restore keeps running after its job was submitted, the tracker updates the result in place
+    if self.state == "done" and isinstance(self.result, dict) and self.result.get("status") == "restore submitted":
+      return "running"
+    return self.state
+
+  def finish(self):
+    """Mark the job finished, with the lock held """
+    self.finished = time.time()
+    self.done.set()
+    log.info(f'Job {self.id} {self.state} in {self.finished - self.started:.2f}s')
+
+  def restore_done(self, result: dict):
+    """Completion handler of a submitted restore, runs on the job tracker's poller """
+    with self.lock:
+      # before the worker stored the result, it sees the final status itself
+      if self.state == "done" and not self.done.is_set():
+        self.finish()
+
+  def to_dict(self) -> dict:
+    """Snapshot of the job for the API, the result copied while the job tracker cannot update it """
+    with self.lock, vol_snap_optimize._results_lock:
+      result = dict(self.result) if isinstance(self.result, dict) else self.result
+      return {"id": self.id, "type": self.kind, "state": self.current_state, "params": self.params,
+              "submitted": self.submitted, "started": self.started, "finished": self.finished,
+              "result": result, "error": self.error}
+
+
+class JobService:
+  """Job queue with a fixed number of worker threads in front of the scripts' helpers """
+
+  def __init__(self, workers: int = 4, max_queue: int = 1000, index_ttl: float = 300.0, keep_jobs: int = 1000):
+    self.index_ttl = index_ttl
+    self.keep_jobs = keep_jobs
+    self.jobs = {}
+    self.started = time.time()
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._queue = queue.Queue(maxsize=max_queue)
+    self._workers = [threading.Thread(target=self._work, name=f"job-{n}", daemon=True) for n in range(max(1, workers))]
+    for worker in self._workers:
+      worker.start()
+
+  def submit(self, params: dict) -> ServiceJob:
+    """Queue a job, raises ValueError on an invalid request and queue.Full if the queue is full """
+    kind = params.get("type")
+    if kind not in JOB_TYPES:
+      raise ValueError(f"type must be one of {', '.join(JOB_TYPES)}")
+    for key in ("cluster", "vserver", "volume"):
+      if not params.get(key):
+        raise ValueError(f"{key} is required")
+    if kind == "guarantee" and params.get("guarantee") not in ("volume", "none"):
+      raise ValueError("guarantee must be volume or none")
+    if kind == "optimize" and params.get("confirm") is not True:
+      raise ValueError("optimize restores the volume and needs \"confirm\": true")
+    with self._lock:
+      job = ServiceJob(next(self._ids), kind, params)
+      self._queue.put_nowait(job)
+      self.jobs[job.id] = job
+      self._prune()
+    log.info(f'Job {job.id} queued: {kind} {params["cluster"]}:{params["vserver"]}:{params["volume"]}')
+    return job
+
+  def _prune(self):
+    # an optimize job is only finished when its restore is
+    finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set() and job.current_state != "running"]
+    for job_id in finished[:max(0, len(self.jobs) - self.keep_jobs)]:
+      del self.jobs[job_id]
+
+  def get(self, job_id: int):
+    with self._lock:
+      return self.jobs.get(job_id)
+
+  def stats(self) -> dict:
+    with self._lock:
+      states = {}
+      for job in self.jobs.values():
+        states[job.current_state] = states.get(job.current_state, 0) + 1
+    return {"uptime": round(time.time() - self.started, 1), "queued": self._queue.qsize(), "jobs": states,
+            "workers": len(self._workers), "sessions": session_stats(),
+            "snapshot_indexes": len(vol_snap_optimize._snapshot_indexes), "volumes": len(vol_snap_optimize._volumes)}
+
+  def _work(self):
+    while True:
+      job = self._queue.get()
+      if job is None:
+        return
+      job.state, job.started = "running", time.time()
+      result, error = None, None
+      try:
+        options = {key: bool(job.params[key]) for key in JOB_OPTIONS if key in job.params}
+        with vol_snap_optimize.args.override(**options):
+          result = RUNNERS[job.kind](self, job)
+        state = "done"
+      except (NetAppRestError, ValueError) as err:
+        state, error = "failed", str(err)
+      except Exception as err:
+        log.exception(f'Job {job.id} failed')
+        state, error = "failed", f"{err.__class__.__name__}: {err}"
+      with job.lock:
+        job.result, job.state, job.error = result, state, error
+        if job.current_state == "running":
+          # the job tracker finishes the job when the restore ends, see ServiceJob.restore_done
+          log.info(f'Job {job.id} submitted its restore in {time.time() - job.started:.2f}s')
+        else:
+          job.finish()
+
+  def evict_stale(self):
+    """Drop snapshot indexes, volume records and SnapMirror relationships older than the TTL """
+    now = time.time()
+    with vol_snap_optimize._snapshot_indexes_lock:
+      indexes = vol_snap_optimize._snapshot_indexes
+      for key in [k for k, index in indexes.items() if now - index.fetched_at > self.index_ttl]:
+        del indexes[key]
+    vol_snap_optimize._volumes.evict(self.index_ttl)
+    if vol_snap_optimize._relationships is not None:
+      vol_snap_optimize._relationships.evict(self.index_ttl)
+
+  def stop(self):
+    """Finish queued and running jobs, then stop the workers """
+    for _ in self._workers:
+      self._queue.put(None)
+    for worker in self._workers:
+      worker.join()
+
+
+def target_of(params: dict) -> dict:
+  return {key: params.get(key) for key in vol_snap_optimize.INVENTORY_FIELDS}
+
+
+def run_optimize(service: JobService, job: ServiceJob, dryrun: bool = False):
+  # a restore re-reads the volume and its snapshots itself, a dry-run reuses what is younger than the TTL
+  service.evict_stale()
+  return vol_snap_optimize.optimize_volume(target_of(job.params), dryrun, interactive=False, assume_yes=not dryrun,
+                                           on_restore_done=job.restore_done)
+
+
+def run_dry_run(service: JobService, job: ServiceJob):
+  return run_optimize(service, job, dryrun=True)
+
+
+def run_guarantee(service: JobService, job: ServiceJob):
+  """Volume and vserver may be patterns, as in vol_guarantee.py --bulk """
+  params = job.params
+  cluster = params["cluster"]
+  reselect = lambda: vol_guarantee.select_volumes(cluster, params["vserver"], params["volume"])
+  return vol_guarantee.enforce_guarantee(cluster, reselect(), params["guarantee"], max(1, vol_guarantee.args.batch_size),
+                                         bool(params.get("dryrun")), reselect)
+
+
+def run_list(service: JobService, job: ServiceJob):
+  service.evict_stale()
+  params = job.params
+  cluster = params["cluster"]
+  volume_uuid = vol_snap_optimize.get_volume_uuid(params["vserver"], params["volume"], cluster)
+  if volume_uuid is None:
+    raise ValueError(f'volume {params["volume"]} not found on SVM {params["vserver"]}')
+  index = vol_snap_optimize.get_snapshot_index(volume_uuid, cluster, refresh=bool(params.get("refresh")))
+  if index is None:
+    raise ValueError("snapshots could not be read")
+  relevant = index.youngest_match(vol_snap_optimize.SNAPPREFIX)
+  return {"volume_uuid": volume_uuid, "relevant_snapshot": index.names[relevant] if relevant is not None else None,
+          "snapshots": [{"name": snap.name, "version_uuid": snap.version_uuid, "uuid": snap.uuid, "create_time": snap.ct_human.isoformat()}
+                        for snap in index.ordered()]}
+
+
+RUNNERS = {"optimize": run_optimize, "dry-run": run_dry_run, "guarantee": run_guarantee, "list": run_list}
+
+
+def load_token(path: str) -> str:
+  """Bearer token of the API: $ONTAP_SERVICE_TOKEN, else a new random token written to a 0600 file """
+  token = os.environ.get("ONTAP_SERVICE_TOKEN")
+  if token:
+    return token
+  token = secrets.token_urlsafe(32)
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  with os.fdopen(fd, "w") as f:
+    # an existing file keeps its mode on O_CREAT
+    os.fchmod(f.fileno(), 0o600)
+    f.write(token + "\n")
+  return token
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  service = None  # JobService, set by serve()
+  token = None  # bearer token every request must carry, set by serve()
+  allowed_hosts = None  # Host header values accepted on TCP, None on a Unix socket
+
+  def log_message(self, format, *args):
+    log.debug(f'{self.command} {self.path} -> {args[1] if len(args) > 1 else ""}')
+
+  def _send(self, status: int, body):
+    data = json.dumps(body, default=str).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _error(self, status: int, message: str):
+    self._send(status, {"error": message})
+
+  def _authorized(self) -> bool:
+    """Host and bearer token check, answers the request itself if it fails """
+    # the body of a refused request is never read, so the connection cannot be reused
+    close, self.close_connection = self.close_connection, True
+    if self.allowed_hosts is not None and (self.headers.get("Host") or "").lower() not in self.allowed_hosts:
+      self._error(403, "Host not allowed")
+      return False
+    scheme, _, token = (self.headers.get("Authorization") or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), self.token.encode()):
+      self._error(401, "bearer token required")
+      return False
+    self.close_connection = close
+    return True
+
+  def do_GET(self):
+    if not self._authorized():
+      return
+    url = urlsplit(self.path)
+    parts = [p for p in url.path.split("/") if p]
+    params = dict(parse_qsl(url.query))
+    if parts == ["health"]:
+      return self._send(200, self.service.stats())
+    if parts == ["metrics"]:
+      return self._send(200, metrics.summary())
+    if parts == ["jobs"]:
+      with self.service._lock:
+        jobs = [job.to_dict() for job in self.service.jobs.values()]
+      return self._send(200, {"jobs": jobs})
+    if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+      job = self.service.get(int(parts[1]))
+      if job is None:
+        return self._error(404, f"no job {parts[1]}")
+      # long poll: ?wait=<seconds> returns as soon as the job is done
+      if params.get("wait"):
+        try:
+          wait = float(params["wait"])
+        except ValueError:
+          wait = math.nan
+        if math.isnan(wait):
+          return self._error(400, "wait must be a number of seconds")
+        job.done.wait(min(max(wait, 0), MAX_WAIT))
+      return self._send(200, job.to_dict())
+    self._error(404, f"no such endpoint {url.path}")
+
+  def do_POST(self):
+    if not self._authorized():
+      return
+    # a browser only sends JSON cross-origin after a CORS preflight, which this API never answers
+    if self.headers.get_content_type() != "application/json":
+      self.close_connection = True
+      return self._error(415, "jobs are submitted as application/json")
+    parts = [p for p in urlsplit(self.path).path.split("/") if p]
+    length = int(self.headers.get("Content-Length") or 0)
+    try:
+      params = json.loads(self.rfile.read(length) or b"{}")
+    except ValueError as err:
+      return self._error(400, f"invalid JSON: {err}")
+    if parts != ["jobs"]:
+      return self._error(404, "jobs are submitted to /jobs")
+    if not isinstance(params, dict):
+      return self._error(400, "a job is a JSON object")
+    try:
+      job = self.service.submit(params)
+    except ValueError as err:
+      return self._error(400, str(err))
+    except queue.Full:
+      return self._error(503, "job queue is full")
+    self._send(202, job.to_dict())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.unlink(self.server_address)
+    super().server_bind()
+    os.chmod(self.server_address, 0o600)
+
+  def get_request(self):
+    # BaseHTTPRequestHandler expects a (host, port) client address
+    request, _ = super().get_request()
+    return request, ("unix", 0)
+
+
+def allowed_hosts(host: str, port: int) -> set:
+  """Host header values of the TCP listener: the local names and the listen address, with and without port """
+  names = set(LOCAL_HOSTS) | {host.lower()}
+  return names | {f"{name}:{port}" for name in names}
+
+
+def serve(service: JobService, token: str, listen: str = None, socket_path: str = None):
+  """API server on the Unix socket, or on TCP if listen (host:port) is given """
+  attributes = {"service": service, "token": token}
+  if not listen:
+    return UnixHTTPServer(socket_path, type("Handler", (ServiceHandler,), attributes))
+  host, _, port = listen.rpartition(":")
+  host = host or "127.0.0.1"
+  server = ThreadingHTTPServer((host.strip("[]"), int(port)), type("Handler", (ServiceHandler,), attributes))
+  server.daemon_threads = True
+  # port 0 binds a free port
+  server.RequestHandlerClass.allowed_hosts = allowed_hosts(host, server.server_address[1])
+  return server
+
+
+def parse_args(argv=None):
+    """Parse the service options; all other options are passed on to the scripts """
+
+    parser = argparse.ArgumentParser(description="Run vol_snap_optimize and vol_guarantee jobs from a local API",
+                                     epilog="Other options (e.g. --workers, --cluster_workers, --catalog, --rate_limit, --batch_size) are passed on to the scripts")
+    parser.add_argument("--socket", dest="socket", default="ontap_service.sock", help="Unix socket of the API, mode 0600 (default: ontap_service.sock)")
+    parser.add_argument("--listen", dest="listen", required=False, help="Serve the API on this host:port instead, e.g. 127.0.0.1:8750")
+    parser.add_argument("--token_file", dest="token_file", default="ontap_service.token", help="File the bearer token of the API is written to, mode 0600 (default: ontap_service.token, ignored if $ONTAP_SERVICE_TOKEN is set)")
+    parser.add_argument("--journal", dest="journal", default="ontap_service.journal", help="Journal of the optimize jobs (default: ontap_service.journal, 'none' to disable), never the one of a vol_snap_optimize.py run")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=4, help="Jobs running at the same time")
+    parser.add_argument("--max_queue", dest="max_queue", type=int, default=1000, help="Queued jobs before new ones are refused")
+    parser.add_argument("--index_ttl", dest="index_ttl", type=float, default=300, help="Seconds snapshot indexes, volume records and SnapMirror relationships are reused by dry-run and list jobs")
+    parser.add_argument("--scheme", dest="scheme", choices=("https", "http"), default="https", help="http only to talk to a local fake_ontap.py")
+    parser.add_argument("--debug", dest="debug", action='store_true', default=False, help="Debug logging")
+    parser.add_argument("-u", "--api_user", "--username", dest="username", default="admin", help="API Username")
+    parser.add_argument("-p", "--api_pass", "--password", dest="password", default=os.environ.get("ONTAP_PASSWORD"), help="API Password (default: $ONTAP_PASSWORD)")
+    parsed_args, script_argv = parser.parse_known_args(argv)
+    if not parsed_args.password:
+      parsed_args.password = getpass()
+    credentials = ["-u", parsed_args.username, "-p", parsed_args.password]
+    optimize_args = vol_snap_optimize.parse_args(PLACEHOLDER + credentials + ["--journal", parsed_args.journal] + strip_option(script_argv, "--batch_size"))
+    guarantee_args = vol_guarantee.parse_args(["-c", "service", "--bulk", "--guarantee", "none", "--journal", "none"] + credentials +
+                                              pick_options(script_argv, ("--batch_size", "--rate_limit")))
+    return parsed_args, optimize_args, guarantee_args
+
+
+def strip_option(argv, option):
+  """argv without an option and its value """
+  out, skip = [], False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg == option:
+      skip = True
+    elif not arg.startswith(option + "="):
+      out.append(arg)
+  return out
+
+
+def pick_options(argv, options):
+  """Only the given options (with their values) of argv """
+  out = []
+  for pos, arg in enumerate(argv):
+    if arg in options and pos + 1 < len(argv):
+      out += [arg, argv[pos + 1]]
+    elif arg.split("=", 1)[0] in options:
+      out.append(arg)
+  return out
+
+
+if __name__ == "__main__":
+  args, optimize_args, guarantee_args = parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                      format="[%(asctime)s] [%(levelname)5s] [%(threadName)s] %(message)s", stream=sys.stdout)
+  queue_handlers()
+
+  # the scripts' module state is the warm cache: one session registry, volume table and index cache for all jobs
+  vol_snap_optimize.args = JobArgs(optimize_args)
+  vol_guarantee.args = guarantee_args
+  pool_size = max(optimize_args.workers, optimize_args.cluster_workers, args.jobs)
+  init_sessions(args.username, args.password, pool_size=pool_size, scheme=args.scheme, rate_limit=optimize_args.rate_limit)
+  if optimize_args.journal.lower() != "none":
+    vol_snap_optimize._journal = RunJournal(optimize_args.journal, resume=optimize_args.resume)
+  if optimize_args.catalog:
+    vol_snap_optimize._catalog = vol_snap_optimize.SnapshotCatalog(optimize_args.catalog, ttl=optimize_args.catalog_ttl * 3600)
+
+  token = load_token(args.token_file)
+  service = JobService(workers=args.jobs, max_queue=args.max_queue, index_ttl=args.index_ttl)
+  server = serve(service, token, args.listen, args.socket)
+  # SIGTERM stops like Ctrl-C: no new jobs, queued ones finish
+  signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+  log.info(f'Service ready on {"http://" + args.listen if args.listen else args.socket} with {args.jobs} job workers, '
+           f'token {"from $ONTAP_SERVICE_TOKEN" if os.environ.get("ONTAP_SERVICE_TOKEN") else "in " + args.token_file}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  log.info('Stopping: finishing queued jobs...')
+  service.stop()
+  if vol_snap_optimize._restore_tracker is not None:
+    vol_snap_optimize._restore_tracker.close()
+  if vol_snap_optimize._journal is not None:
+    vol_snap_optimize._journal.close()
+  if not args.listen and os.path.exists(args.socket):
+    os.unlink(args.socket)
+  log_session_stats(log)
+  export_metrics(log, optimize_args.metrics, optimize_args.prometheus)
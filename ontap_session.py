@@ -0,0 +1,184 @@
+################################################################
+# Shared NetApp ONTAP cluster sessions
+# (c)NetApp Professional Services Germany
+#
+# Summary: keeps one keep-alive HostConnection with a sized HTTP
+#          pool per cluster for the whole run. The connection is
+#          passed explicitly to every resource call, so nothing is
+#          written to the global config.CONNECTION and the same
+#          connection can be used from worker threads. All requests
+#          pass the cluster's throttle (ontap_throttle.py), which
+#          also owns the retries.
+#
+################################################################
+
+import re
+import threading
+import time
+import logging
+
+from netapp_ontap import HostConnection
+from netapp_ontap.host_connection import LoggingAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+
+from ontap_metrics import metrics
+from ontap_throttle import Throttles, policy_for, classify, retry_after
+
+DEFAULT_POOL_SIZE = 16
+
+log = logging.getLogger('ontapSession')
+
+
+def split_cluster(cluster: str):
+  """Split an optional :port off a cluster name """
+  host, sep, port = cluster.rpartition(":")
+  if sep and port.isdigit() and (":" not in host or host.startswith("[")):
+    return host, int(port)
+  return cluster, 443
+
+
+def connect_failed(err) -> bool:
+  """True if the request never reached the cluster """
+  return isinstance(err, ConnectTimeout) or isinstance(getattr(err.args[0] if err.args else None, "reason", None), NewConnectionError)
+
+
+class InstrumentedAdapter(LoggingAdapter):
+  """LoggingAdapter sending every request through the cluster's throttle, retrying
+     it per its method's policy and reporting each attempt to the run metrics """
+
+  NUM_RECORDS = re.compile(rb'"num_records":\s*(\d+)')
+
+  def __init__(self, cluster: str, throttle, *args, **kwargs):
+    self.cluster = cluster
+    self.throttle = throttle
+    super().__init__(*args, **kwargs)
+
+  def send(self, request, *args, **kwargs):
+    policy = policy_for(request.method)
+    attempt = 0
+    while True:
+      with self.throttle.slot() as report:
+        start = time.perf_counter()
+        try:
+          response = super().send(request, *args, **kwargs)
+        except (ConnectionError, Timeout) as err:
+          metrics.record_request(self.cluster, time.perf_counter() - start, 599, retries=1 if attempt else 0)
+          retry = policy.retry_connect if connect_failed(err) else policy.retry_read
+          if not retry or attempt + 1 >= policy.attempts:
+            raise
+          delay = policy.backoff(attempt)
+          log.warning(f'{request.method} on cluster {self.cluster} failed ({err.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s')
+        else:
+          status = response.status_code
+          report["outcome"] = classify(status)
+          pause = retry_after(response.headers) if status in policy.statuses else None
+          report["pause"] = pause
+          records = 0
+          if request.method == "GET" and status < 400 and "return_records=false" not in request.url:
+            match = self.NUM_RECORDS.search(response.content)
+            records = int(match.group(1)) if match else 1
+          metrics.record_request(self.cluster, time.perf_counter() - start, status, records, 1 if attempt else 0)
+          if status not in policy.statuses or attempt + 1 >= policy.attempts:
+            return response
+          delay = policy.backoff(attempt, pause)
+          log.warning(f'{request.method} on cluster {self.cluster} returned {status}, retry {attempt + 1} in {delay:.1f}s')
+      time.sleep(delay)
+      attempt += 1
+
+
+class ClusterSessions:
+  """Registry of one HostConnection per cluster """
+
+  def __init__(self, username, password, verify: bool = False, pool_size: int = DEFAULT_POOL_SIZE, scheme: str = "https",
+               rate_limit: float = 0.0, max_concurrency: int = None):
+    self.username = username
+    self.password = password
+    self.verify = verify
+    self.pool_size = pool_size
+    self.scheme = scheme
+    self.throttles = Throttles(max_concurrency=max_concurrency or pool_size, rate=rate_limit)
+    self._connections = {}
+    self._reused = {}
+    self._lock = threading.Lock()
+
+  def get(self, cluster: str) -> HostConnection:
+    """Connection for a cluster, opened on first use """
+    with self._lock:
+      conn = self._connections.get(cluster)
+      if conn is not None:
+        self._reused[cluster] += 1
+        return conn
+      host, port = split_cluster(cluster)
+      conn = HostConnection(host, self.username, self.password, verify=self.verify, port=port, scheme=self.scheme)
+      # replace the default adapter with a throttled one sized for the worker threads, retries are done by the throttle
+      session = conn.session
+      default = session.adapters[conn.origin]
+      session.mount(conn.origin, InstrumentedAdapter(cluster, self.throttles.get(cluster), conn, max_retries=0, timeout=default.timeout,
+                                                     pool_connections=1, pool_maxsize=self.pool_size))
+      self._connections[cluster] = conn
+      self._reused[cluster] = 0
+      log.debug(f'Opened session to cluster {cluster} (HTTP pool size {self.pool_size})')
+      return conn
+
+  def stats(self) -> dict:
+    """Per cluster: times the session was reused, TCP connections opened and HTTP requests sent """
+    stats = {}
+    with self._lock:
+      for cluster, conn in self._connections.items():
+        tcp_opened = requests_sent = 0
+        adapter = conn.session.adapters.get(conn.origin)
+        if adapter is not None:
+          for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is not None:
+              tcp_opened += pool.num_connections
+              requests_sent += pool.num_requests
+        stats[cluster] = {"reused": self._reused[cluster], "tcp_opened": tcp_opened, "requests": requests_sent}
+    return stats
+
+  def close(self):
+    with self._lock:
+      for conn in self._connections.values():
+        conn.session.close()
+      self._connections.clear()
+      self._reused.clear()
+
+
+_sessions = None
+
+
+def init_sessions(username, password, verify: bool = False, pool_size: int = DEFAULT_POOL_SIZE, scheme: str = "https",
+                  rate_limit: float = 0.0, max_concurrency: int = None) -> ClusterSessions:
+  """Create the session registry shared by the scripts """
+  global _sessions
+  if _sessions is not None:
+    _sessions.close()
+  _sessions = ClusterSessions(username, password, verify=verify, pool_size=pool_size, scheme=scheme, rate_limit=rate_limit,
+                              max_concurrency=max_concurrency)
+  return _sessions
+
+
+def get_sessions() -> ClusterSessions:
+  return _sessions
+
+
+def get_connection(cluster: str) -> HostConnection:
+  """Shared connection for a cluster """
+  if _sessions is None:
+    raise RuntimeError("init_sessions() must be called before connecting to a cluster")
+  return _sessions.get(cluster)
+
+
+def session_stats() -> dict:
+  return _sessions.stats() if _sessions is not None else {}
+
+
+def log_session_stats(logger):
+  """Log connections opened and reused and the throttle state per cluster """
+  throttles = _sessions.throttles.stats() if _sessions is not None else {}
+  for cluster, s in session_stats().items():
+    logger.info(f'Cluster {cluster}: session reused {s["reused"]} times, {s["tcp_opened"]} TCP connections opened for {s["requests"]} requests')
+    t = throttles.get(cluster)
+    if t is not None and (t["throttled"] or t["decreases"]):
+      logger.info(f'Cluster {cluster}: {t["throttled"]} requests throttled, concurrency limit reduced {t["decreases"]} times, now {t["limit"]}')
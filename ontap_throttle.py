@@ -0,0 +1,248 @@
+################################################################
+# Adaptive per cluster rate limiting and retries for ONTAP REST
+# (c)NetApp Professional Services Germany
+#
+# Summary: every request to a cluster passes a token bucket and
+#          an AIMD concurrency limit. The limit grows by one
+#          request per window of successes and halves on throttling
+#          or server errors. Idempotent GETs are retried with
+#          jittered exponential backoff, mutating requests only
+#          when the cluster refused them before doing any work.
+#
+################################################################
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger('ontapThrottle')
+
+# outcomes reported back to the limiter
+OK, THROTTLED, FAILED = "ok", "throttled", "failed"
+# responses that mean "slow down"
+THROTTLE_STATUS = (429, 503)
+
+
+class RetryPolicy:
+  """When and how often a request is sent again """
+
+  def __init__(self, attempts: int, statuses, retry_connect: bool, retry_read: bool,
+               base: float = 0.5, cap: float = 30.0):
+    self.attempts = attempts
+    self.statuses = frozenset(statuses)
+    self.retry_connect = retry_connect
+    self.retry_read = retry_read
+    self.base = base
+    self.cap = cap
+
+  def backoff(self, attempt: int, retry_after: float = None) -> float:
+    """Full jitter exponential backoff, never shorter than a Retry-After from the cluster """
+    delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+# GETs do not change anything and can be repeated after any transient error
+GET_POLICY = RetryPolicy(attempts=6, statuses=(429, 502, 503, 504), retry_connect=True, retry_read=True)
+# a PATCH may already be applied when the response is lost, so it is only repeated
+# when the cluster turned it away (429/503) or the connection was never established
+PATCH_POLICY = RetryPolicy(attempts=3, statuses=THROTTLE_STATUS, retry_connect=True, retry_read=False, base=2.0, cap=60.0)
+
+
+def policy_for(method: str) -> RetryPolicy:
+  return GET_POLICY if method.upper() in ("GET", "HEAD", "OPTIONS") else PATCH_POLICY
+
+
+def classify(status: int) -> str:
+  if status in THROTTLE_STATUS:
+    return THROTTLED
+  return FAILED if status >= 500 else OK
+
+
+def retry_after(headers) -> float:
+  value = headers.get("Retry-After") if headers is not None else None
+  try:
+    return float(value) if value is not None else None
+  except ValueError:
+    return None
+
+
+class TokenBucket:
+  """`rate` requests per second with bursts of up to `burst`, unlimited if rate is 0 """
+
+  def __init__(self, rate: float = 0.0, burst: int = 1):
+    self.rate = rate
+    self.burst = max(1, burst)
+    self._tokens = float(self.burst)
+    self._stamp = time.monotonic()
+    self._lock = threading.Lock()
+
+  def reserve(self) -> float:
+    """Take a token, returns the seconds to wait before using it """
+    if not self.rate:
+      return 0.0
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+      self._stamp = now
+      self._tokens -= 1
+      return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class ClusterThrottle:
+  """Token bucket plus AIMD concurrency limit of one cluster """
+
+  def __init__(self, cluster: str, max_concurrency: int = 16, min_concurrency: int = 1,
+               rate: float = 0.0, burst: int = None, cooldown: float = 1.0):
+    self.cluster = cluster
+    self.max_concurrency = max(1, max_concurrency)
+    self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+    self.limit = float(self.max_concurrency)
+    self.bucket = TokenBucket(rate, burst or max(1, int(rate)))
+    self.cooldown = cooldown
+    self.in_flight = 0
+    self.paused_until = 0.0
+    self.throttled = 0
+    self.decreases = 0
+    self._last_decrease = 0.0
+    self._cond = threading.Condition()
+    # (loop, future) of coroutines waiting in acquire_async(), oldest first
+    self._async_waiters = deque()
+    # waiters woken for a free slot that have not taken it yet
+    self._woken = 0
+
+  def try_acquire(self) -> bool:
+    with self._cond:
+      if self.in_flight >= int(self.limit) or time.monotonic() < self.paused_until:
+        return False
+      self.in_flight += 1
+      return True
+
+  def acquire(self):
+    while True:
+      with self._cond:
+        pause = self.paused_until - time.monotonic()
+        if pause <= 0 and self.in_flight < int(self.limit):
+          self.in_flight += 1
+          break
+        self._cond.wait(pause if pause > 0 else None)
+    time.sleep(self.bucket.reserve())
+
+  def _free_slots(self) -> int:
+    if time.monotonic() < self.paused_until:
+      return 0
+    return int(self.limit) - self.in_flight
+
+  def _wake_async(self, count: int):
+    """Wake up to `count` waiting coroutines, called with the lock held """
+    while count > 0 and self._async_waiters:
+      loop, waiter = self._async_waiters.popleft()
+      try:
+        loop.call_soon_threadsafe(_resolve, waiter)
+      except RuntimeError:
+        # its loop is closed
+        continue
+      self._woken += 1
+      count -= 1
+
+  async def acquire_async(self):
+    """acquire() for coroutines: waits on a future that release() resolves instead of blocking the loop """
+    loop = asyncio.get_running_loop()
+    while True:
+      with self._cond:
+        pause = self.paused_until - time.monotonic()
+        if pause <= 0 and self.in_flight < int(self.limit):
+          self.in_flight += 1
+          # slots freed meanwhile (limit grew, pause ended) go to the next waiters
+          self._wake_async(self._free_slots() - self._woken)
+          break
+        entry = (loop, loop.create_future())
+        self._async_waiters.append(entry)
+      cancelled = True
+      try:
+        # a pause ends without a release, so waiters wake up by themselves then
+        await asyncio.wait_for(entry[1], pause if pause > 0 else None)
+        cancelled = False
+      except asyncio.TimeoutError:
+        cancelled = False
+      finally:
+        with self._cond:
+          try:
+            self._async_waiters.remove(entry)
+          except ValueError:
+            # woken by release()
+            self._woken -= 1
+            if cancelled:
+              # the slot it was woken for goes to the next waiter
+              self._wake_async(1)
+    await asyncio.sleep(self.bucket.reserve())
+
+  def release(self, outcome: str, pause: float = None):
+    """Give the slot back and adapt the limit to the outcome """
+    with self._cond:
+      self.in_flight -= 1
+      now = time.monotonic()
+      if outcome == OK:
+        # additive increase: about one more slot per window of `limit` successes
+        self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+      elif now - self._last_decrease >= self.cooldown:
+        # multiplicative decrease, once per cooldown so one burst of errors counts once
+        old = int(self.limit)
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        self._last_decrease = now
+        self.decreases += 1
+        log.warning(f'Cluster {self.cluster} {"throttles" if outcome == THROTTLED else "fails"} requests, concurrency {old} -> {int(self.limit)}')
+      if outcome == THROTTLED:
+        self.throttled += 1
+        if pause:
+          self.paused_until = max(self.paused_until, now + pause)
+      self._cond.notify_all()
+      if now < self.paused_until:
+        # one waiter sleeps out the pause and wakes the others when it takes a slot
+        self._wake_async(0 if self._woken else 1)
+      else:
+        self._wake_async(self._free_slots() - self._woken)
+
+  @contextmanager
+  def slot(self):
+    """Hold a slot for one request, the caller reports the outcome via the yielded dict """
+    self.acquire()
+    report = {"outcome": FAILED, "pause": None}
+    try:
+      yield report
+    finally:
+      self.release(report["outcome"], report["pause"])
+
+  def stats(self) -> dict:
+    with self._cond:
+      return {"limit": int(self.limit), "in_flight": self.in_flight, "throttled": self.throttled, "decreases": self.decreases}
+
+
+def _resolve(waiter):
+  if not waiter.done():
+    waiter.set_result(None)
+
+
+class Throttles:
+  """One ClusterThrottle per cluster, created on first use """
+
+  def __init__(self, max_concurrency: int = 16, rate: float = 0.0, burst: int = None):
+    self.max_concurrency = max_concurrency
+    self.rate = rate
+    self.burst = burst
+    self._throttles = {}
+    self._lock = threading.Lock()
+
+  def get(self, cluster: str) -> ClusterThrottle:
+    with self._lock:
+      throttle = self._throttles.get(cluster)
+      if throttle is None:
+        throttle = self._throttles[cluster] = ClusterThrottle(cluster, self.max_concurrency, rate=self.rate, burst=self.burst)
+      return throttle
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {cluster: throttle.stats() for cluster, throttle in self._throttles.items()}
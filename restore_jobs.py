@@ -0,0 +1,244 @@
+################################################################
+# Non-blocking tracking of NetApp ONTAP restore jobs
+# (c)NetApp Professional Services Germany
+#
+# Summary: restores are submitted without waiting for their job,
+#          a poller thread checks all running jobs concurrently
+#          with backoff and reports each one as it finishes.
+#          In-flight restores are capped per cluster and per
+#          aggregate.
+#
+################################################################
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from netapp_ontap.resources import Job
+
+from ontap_session import get_connection
+
+log = logging.getLogger('restoreJobs')
+
+TERMINAL_STATES = ("success", "failure")
+# reported when a job has no result after the timeout: it may still be running on ONTAP
+UNKNOWN = "unknown"
+
+
+class RestoreSkipped(Exception):
+  """Raised by a submit() that decided not to send its restore """
+
+
+def job_uuids(response):
+  """Job uuids of a NetAppResponse (single job or multi-record "jobs" list) """
+  try:
+    body = response.http_response.json()
+  except ValueError:
+    return []
+  jobs = body.get("jobs") or ([body["job"]] if body.get("job") else [])
+  return [job["uuid"] for job in jobs if job.get("uuid")]
+
+
+class RestoreJob:
+  """One submitted restore and the ONTAP jobs it started """
+
+  def __init__(self, label: str, cluster: str, aggregate: str, on_done=None):
+    self.label = label
+    self.cluster = cluster
+    self.aggregate = aggregate
+    self.on_done = on_done
+    self.job_uuids = []
+    self.state = "submitting"
+    self.message = ""
+    self.submitted = time.time()
+    self.finished = None
+    self.interval = 0.0
+    self.next_poll = 0.0
+    # on_done already ran with an UNKNOWN outcome, the job is polled on until ONTAP ends it
+    self.overdue = False
+
+  @property
+  def duration(self):
+    return (self.finished or time.time()) - self.submitted
+
+
+class JobTracker:
+  """Submit restores under per cluster / per aggregate caps and poll their jobs """
+
+  def __init__(self, max_per_cluster: int = 4, max_per_aggregate: int = 2, poll_interval: float = 1.0,
+               max_interval: float = 15.0, timeout: float = 3600.0, pollers: int = 8):
+    self.max_per_cluster = max(1, max_per_cluster)
+    self.max_per_aggregate = max(1, max_per_aggregate)
+    self.poll_interval = poll_interval
+    self.max_interval = max_interval
+    self.timeout = timeout
+    self._slots = {}
+    self._lock = threading.Lock()
+    self._wakeup = threading.Condition(self._lock)
+    self._running = []
+    self._pool = ThreadPoolExecutor(max_workers=max(1, pollers), thread_name_prefix="job-poll")
+    self._thread = threading.Thread(target=self._poll_loop, name="job-tracker", daemon=True)
+    self._stopped = False
+    self._thread.start()
+
+  def _slot(self, key, limit: int):
+    with self._lock:
+      if key not in self._slots:
+        self._slots[key] = threading.BoundedSemaphore(limit)
+      return self._slots[key]
+
+  def submit(self, label: str, cluster: str, aggregate: str, submit, on_done=None) -> RestoreJob:
+    """Run submit() (which sends the PATCH with poll=False) once a cluster and an aggregate
+       slot are free. Blocks while the caps are reached. submit() may raise RestoreSkipped,
+       the job then ends as "skipped". on_done(job) runs when the job ends """
+    job = RestoreJob(label, cluster, aggregate, on_done)
+    cluster_slot = self._slot(("cluster", cluster), self.max_per_cluster)
+    aggr_slot = self._slot(("aggregate", cluster, aggregate), self.max_per_aggregate)
+    cluster_slot.acquire()
+    aggr_slot.acquire()
+    job.release = lambda: (aggr_slot.release(), cluster_slot.release())
+    job.submitted = time.time()
+    try:
+      response = submit()
+    except RestoreSkipped as err:
+      self._finish(job, "skipped", str(err))
+      return job
+    except Exception as err:
+      self._finish(job, "failure", str(err))
+      return job
+    if response is None:
+      self._finish(job, "failure", "restore request was not accepted")
+      return job
+    job.job_uuids = job_uuids(response)
+    if not job.job_uuids:
+      self._finish(job, "success", "completed synchronously")
+      return job
+    job.state = "running"
+    job.interval = self.poll_interval
+    job.next_poll = time.time() + job.interval
+    log.info(f'Restore of {label} submitted, job {",".join(job.job_uuids)}')
+    with self._wakeup:
+      self._running.append(job)
+      self._wakeup.notify()
+    return job
+
+  def _finish(self, job: RestoreJob, state: str, message: str):
+    if job.overdue:
+      # reported as UNKNOWN already, only the slots were still held
+      job.release()
+      log.warning(f'Restore of {job.label} ended with {state} after {job.duration:.1f}s, past its timeout{": " + message if message else ""}')
+      with self._wakeup:
+        self._running.remove(job)
+      return
+    job.state = state
+    job.message = message
+    job.finished = time.time()
+    job.release()
+    if state == "success":
+      log.info(f'++ Restore of {job.label} finished in {job.duration:.1f}s')
+    elif state == "skipped":
+      log.info(f'Restore of {job.label} was not sent: {message}')
+    else:
+      log.error(f'-- Restore of {job.label} failed after {job.duration:.1f}s: {message}')
+    # the completion handler runs before wait_all() can see the job as done
+    if job.on_done is not None:
+      try:
+        job.on_done(job)
+      except Exception as err:
+        log.error(f'Completion handler of {job.label} failed: {err}')
+    with self._wakeup:
+      # finished jobs are not kept, the service runs for months
+      if job in self._running:
+        self._running.remove(job)
+      self._wakeup.notify_all()
+
+  def _overdue(self, job: RestoreJob):
+    """Report a job without result after the timeout as UNKNOWN. It keeps its cluster and
+       aggregate slots, so no other restore starts next to it, until ONTAP ends it """
+    job.state = UNKNOWN
+    job.message = f"no result after {self.timeout:.0f}s, the ONTAP job may still be running"
+    log.error(f'-- Restore of {job.label}: {job.message}, check it by hand')
+    if job.on_done is not None:
+      try:
+        job.on_done(job)
+      except Exception as err:
+        log.error(f'Completion handler of {job.label} failed: {err}')
+    with self._wakeup:
+      job.overdue = True
+      self._wakeup.notify_all()
+
+  def _poll(self, job: RestoreJob):
+    """Check all ONTAP jobs of a restore once, returns (state, message) or None while running """
+    messages = []
+    for job_uuid in job.job_uuids:
+      ontap_job = Job(uuid=job_uuid)
+      ontap_job.set_connection(get_connection(job.cluster))
+      ontap_job.get(fields="state,message")
+      if ontap_job.state not in TERMINAL_STATES:
+        return None
+      if ontap_job.state == "failure":
+        messages.append(getattr(ontap_job, "message", "failed"))
+    return ("failure", "; ".join(messages)) if messages else ("success", "")
+
+  def _poll_loop(self):
+    while True:
+      with self._wakeup:
+        while not self._running and not self._stopped:
+          self._wakeup.wait()
+        if self._stopped:
+          # close() waited for every job except the overdue ones
+          return
+        now = time.time()
+        due = [job for job in self._running if job.next_poll <= now]
+        if not due:
+          # jobs being checked have no next poll until their check is done
+          next_poll = min(job.next_poll for job in self._running)
+          self._wakeup.wait(next_poll - now if next_poll != float("inf") else None)
+          continue
+        for job in due:
+          job.next_poll = float("inf")
+      # checks and completion handlers (which journal with fsync) run on the poller threads,
+      # the loop goes on polling the other jobs meanwhile
+      for job in due:
+        self._pool.submit(self._check, job)
+
+  def _check(self, job: RestoreJob):
+    try:
+      outcome = self._poll(job)
+    except Exception as err:
+      log.warning(f'Polling job of {job.label} failed, retrying: {err}')
+      outcome = None
+    if outcome is None and not job.overdue and job.duration > self.timeout:
+      self._overdue(job)
+    if outcome is None:
+      # back off on long running jobs
+      job.interval = min(job.interval * 1.5, self.max_interval)
+      with self._wakeup:
+        job.next_poll = time.time() + job.interval
+        self._wakeup.notify_all()
+      return
+    self._finish(job, *outcome)
+
+  def in_flight(self) -> int:
+    """Restores without an outcome yet, overdue ones are reported already """
+    with self._lock:
+      return sum(not job.overdue for job in self._running)
+
+  def wait_all(self):
+    """Block until every submitted restore has finished or was reported overdue """
+    with self._wakeup:
+      while any(not job.overdue for job in self._running):
+        self._wakeup.wait()
+
+  def close(self):
+    self.wait_all()
+    with self._lock:
+      overdue = [job.label for job in self._running]
+    if overdue:
+      log.warning(f'Not polling overdue restores any more: {", ".join(overdue)}')
+    with self._wakeup:
+      self._stopped = True
+      self._wakeup.notify_all()
+    self._thread.join()
+    self._pool.shutdown()
@@ -0,0 +1,62 @@
+################################################################
+# Checksummed restore plans for unattended volume restores
+# (c)NetApp Professional Services Germany
+#
+# Summary: a dry-run writes the restores it validated, with the
+#          exact target and source snapshot version_uuids and the
+#          restore snapshot uuid, into a JSON plan with a SHA-256
+#          checksum. Passing that checksum back approves the whole
+#          plan; a plan changed after it was written is refused.
+#
+################################################################
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+PLAN_VERSION = 1
+ENTRY_FIELDS = ("cluster", "vserver", "volume", "source_cluster", "source_vserver", "source_volume", "volume_uuid",
+                "relevant_snapshot", "relevant_snapshot_uuid", "source_version_uuid", "restore_snapshot",
+                "restore_snapshot_uuid", "restore_version_uuid", "reclaimable_bytes")
+# shortest checksum prefix accepted as approval
+MIN_APPROVAL = 12
+
+
+class PlanError(Exception):
+  """A plan file that cannot be executed """
+
+
+def plan_checksum(entries: list) -> str:
+  canonical = json.dumps({"version": PLAN_VERSION, "entries": entries}, sort_keys=True, separators=(",", ":"))
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def write_restore_plan(path: str, entries: list) -> str:
+  """Write the plan entries with their checksum, returns the checksum """
+  entries = [{field: entry.get(field) for field in ENTRY_FIELDS} for entry in entries]
+  checksum = plan_checksum(entries)
+  doc = {"version": PLAN_VERSION, "created": datetime.now().astimezone().isoformat(), "sha256": checksum, "entries": entries}
+  # never leave a half written plan behind
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(doc, f, indent=2)
+  os.replace(f"{path}.tmp", path)
+  return checksum
+
+
+def load_restore_plan(path: str, approval: str) -> list:
+  """Entries of a plan whose content matches its checksum and the approval (checksum or a prefix of it) """
+  try:
+    with open(path) as f:
+      doc = json.load(f)
+  except (OSError, ValueError) as err:
+    raise PlanError(f"plan {path} cannot be read: {err}") from err
+  if not isinstance(doc, dict) or doc.get("version") != PLAN_VERSION:
+    raise PlanError(f"{path} is no restore plan of version {PLAN_VERSION}")
+  checksum = plan_checksum(doc.get("entries", []))
+  if checksum != doc.get("sha256"):
+    raise PlanError(f"plan {path} was changed after it was written")
+  approval = (approval or "").strip().lower()
+  if len(approval) < MIN_APPROVAL or not checksum.startswith(approval):
+    raise PlanError(f"approval does not match the checksum of plan {path} (at least {MIN_APPROVAL} characters)")
+  return doc["entries"]
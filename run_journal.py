@@ -0,0 +1,121 @@
+################################################################
+# Append-only journal of per volume phase outcomes
+# (c)NetApp Professional Services Germany
+#
+# Summary: every phase a volume passes (resolved, scanned,
+#          validated, dry-run ok, restored, guarantee set, ...) is
+#          appended as one JSON line. Lines are fsync'ed in batches,
+#          outcomes of single changes on the cluster right away and
+#          those of a bulk change once it is verified. A resumed
+#          run replays the journal and skips or reuses what the
+#          previous run already did.
+#
+################################################################
+
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('runJournal')
+
+# phases after which nothing is left to do for a volume
+RESTORED = "restored"
+DRY_RUN_OK = "dry-run ok"
+GUARANTEE_SET = "guarantee set"
+# a restore PATCH is about to be sent, its outcome follows as one of RESTORE_OUTCOMES
+RESTORE_SUBMITTED = "restore submitted"
+RESTORE_OUTCOMES = (RESTORED, "restore failed", "plan drift")
+
+
+def _set_phase(phases: dict, phase: str, data: dict):
+  # re-inserted, so the phases of a volume stay ordered by when they were last recorded
+  phases.pop(phase, None)
+  phases[phase] = data
+
+
+class RunJournal:
+  """JSON lines journal keyed by (cluster, svm, volume).
+
+  Without resume an existing journal is kept as <path>.1 and a new one is
+  started. Lines are fsync'ed every `batch` records or `interval` seconds;
+  durable records (changes made on the cluster) are fsync'ed immediately,
+  so at worst the last read-only phases of a crashed run are redone.
+  Bulk changes (vol_guarantee.py --bulk) record their verified outcomes
+  without durable and fsync them together with flush(); a volume whose
+  record is lost is found compliant and skipped by the next run. """
+
+  def __init__(self, path: str, resume: bool = False, batch: int = 64, interval: float = 1.0):
+    self.path = path
+    self.batch = batch
+    self.interval = interval
+    self.entries = self.replay(path) if resume else {}
+    if not resume and os.path.exists(path):
+      os.replace(path, f"{path}.1")
+    self._file = open(path, "a")
+    self._lock = threading.Lock()
+    self._pending = 0
+    self._synced = time.monotonic()
+    self._write({"run": time.time(), "resume": resume}, durable=True)
+    if resume:
+      log.info(f'Resuming from journal {path}: {len(self.entries)} volumes with recorded phases')
+
+  @staticmethod
+  def replay(path: str) -> dict:
+    """{(cluster, svm, volume): {phase: data}} from a journal, the last record of a phase wins """
+    entries = {}
+    if not os.path.exists(path):
+      return entries
+    with open(path) as f:
+      for n, line in enumerate(f, 1):
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # a line cut short by a crash
+          log.warning(f'Journal {path} line {n} is incomplete and ignored')
+          continue
+        if "phase" in record:
+          _set_phase(entries.setdefault((record["cluster"], record["svm"], record["volume"]), {}), record["phase"], record.get("data", {}))
+    return entries
+
+  def completed(self, cluster: str, svm: str, volume: str) -> dict:
+    """Phases recorded for a volume, {phase: data} """
+    with self._lock:
+      return dict(self.entries.get((cluster, svm, volume), {}))
+
+  def latest(self, cluster: str, svm: str, volume: str, phases) -> str:
+    """The one of the given phases recorded last for a volume, or None """
+    with self._lock:
+      recorded = [phase for phase in self.entries.get((cluster, svm, volume), {}) if phase in phases]
+    return recorded[-1] if recorded else None
+
+  def record(self, cluster: str, svm: str, volume: str, phase: str, durable: bool = False, **data):
+    with self._lock:
+      _set_phase(self.entries.setdefault((cluster, svm, volume), {}), phase, data)
+    self._write({"ts": round(time.time(), 3), "cluster": cluster, "svm": svm, "volume": volume, "phase": phase, "data": data}, durable)
+
+  def _write(self, record: dict, durable: bool):
+    line = json.dumps(record, default=str) + "\n"
+    with self._lock:
+      self._file.write(line)
+      self._pending += 1
+      if durable or self._pending >= self.batch or time.monotonic() - self._synced >= self.interval:
+        self._sync()
+
+  def flush(self):
+    """fsync everything recorded so far """
+    with self._lock:
+      self._sync()
+
+  def _sync(self):
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._pending = 0
+    self._synced = time.monotonic()
+
+  def close(self):
+    with self._lock:
+      if not self._file.closed:
+        self._sync()
+        self._file.close()
@@ -0,0 +1,157 @@
+################################################################
+# SnapMirror relationship index of NetApp ONTAP destination volumes
+# (c)NetApp Professional Services Germany
+#
+# Summary: fetches all SnapMirror relationships of a destination
+#          cluster with one paged collection query and keeps the
+#          source cluster, SVM and volume of every destination
+#          volume in memory, so inventories can leave the source
+#          columns empty and sources are paired automatically
+#
+################################################################
+
+import logging
+import threading
+import time
+
+from netapp_ontap.resources import SnapmirrorRelationship
+
+from ontap_metrics import instrumented
+from volume_lookup import PAGE_SIZE
+
+RELATIONSHIP_FIELDS = "source.path,source.svm.name,source.cluster.name,destination.path,destination.svm.name,destination.uuid,destination.cluster.name,state,healthy"
+
+log = logging.getLogger('snapmirrorIndex')
+
+
+def split_path(path: str):
+  """(svm, volume) of a SnapMirror endpoint path "svm:volume" """
+  svm, _, volume = (path or "").partition(":")
+  return svm or None, volume or None
+
+
+def _record(source_path, source_svm, source_cluster, destination_path, destination_uuid, destination_cluster, state, healthy):
+  source_vserver, source_volume = split_path(source_path)
+  vserver, volume = split_path(destination_path)
+  return {
+    "source_cluster": source_cluster,
+    "source_vserver": source_svm or source_vserver,
+    "source_volume": source_volume,
+    "vserver": vserver,
+    "volume": volume,
+    "uuid": destination_uuid,
+    # set only when the cluster lists a relationship it is the source of
+    "destination_cluster": destination_cluster,
+    "state": state,
+    "healthy": healthy,
+  }
+
+
+def relationship_record(rel) -> dict:
+  """Compact record of a SnapmirrorRelationship resource """
+  source, destination = getattr(rel, "source", None), getattr(rel, "destination", None)
+  return _record(
+    getattr(source, "path", None),
+    getattr(getattr(source, "svm", None), "name", None),
+    getattr(getattr(source, "cluster", None), "name", None),
+    getattr(destination, "path", None),
+    getattr(destination, "uuid", None),
+    getattr(getattr(destination, "cluster", None), "name", None),
+    getattr(rel, "state", None),
+    getattr(rel, "healthy", None),
+  )
+
+
+def relationship_json_record(data: dict) -> dict:
+  """Same record built straight from a REST response record """
+  source, destination = data.get("source", {}), data.get("destination", {})
+  return _record(
+    source.get("path"), source.get("svm", {}).get("name"), source.get("cluster", {}).get("name"),
+    destination.get("path"), destination.get("uuid"), destination.get("cluster", {}).get("name"),
+    data.get("state"), data.get("healthy"),
+  )
+
+
+def parse_cluster_map(value: str) -> dict:
+  """"name=address,name2=address2" -> {name: address} """
+  mapping = {}
+  for item in filter(None, (part.strip() for part in (value or "").split(","))):
+    name, sep, address = item.partition("=")
+    if not sep or not name.strip() or not address.strip():
+      raise ValueError(f'cluster map entry "{item}" is not name=address')
+    mapping[name.strip()] = address.strip()
+  return mapping
+
+
+class RelationshipIndex:
+  """Relationships by (destination cluster, destination volume uuid) and by
+  (destination cluster, svm, volume), loaded once per destination cluster.
+
+  ONTAP reports the source by its cluster name, cluster_map translates that
+  name into the address the scripts connect to (default: the name itself).
+  Intra-cluster relationships have no source cluster and resolve to the
+  destination cluster. """
+
+  def __init__(self, cluster_map: dict = None):
+    self.cluster_map = dict(cluster_map or {})
+    self._by_uuid = {}
+    self._by_name = {}
+    # destination cluster -> time its relationships were loaded
+    self._loaded = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._by_uuid)
+
+  def loaded(self, cluster: str) -> bool:
+    with self._lock:
+      return cluster in self._loaded
+
+  def add(self, cluster: str, records) -> int:
+    """Index the relationships listed by a destination cluster, returns the number kept """
+    kept = 0
+    with self._lock:
+      for record in records:
+        if record["destination_cluster"] or not record["source_volume"]:
+          continue
+        source_cluster = record["source_cluster"]
+        record = dict(record, source_cluster=self.cluster_map.get(source_cluster, source_cluster) if source_cluster else cluster)
+        if record["uuid"]:
+          self._by_uuid[(cluster, record["uuid"])] = record
+        self._by_name[(cluster, record["vserver"], record["volume"])] = record
+        kept += 1
+      self._loaded[cluster] = time.time()
+    return kept
+
+  def evict(self, max_age: float) -> int:
+    """Forget the relationships of clusters loaded more than max_age seconds ago, returns the number of clusters """
+    cutoff = time.time() - max_age
+    with self._lock:
+      expired = {cluster for cluster, loaded in self._loaded.items() if loaded < cutoff}
+      for entries in (self._by_uuid, self._by_name):
+        for key in [key for key in entries if key[0] in expired]:
+          del entries[key]
+      for cluster in expired:
+        del self._loaded[cluster]
+    return len(expired)
+
+  def by_uuid(self, cluster: str, uuid: str):
+    return self._by_uuid.get((cluster, uuid))
+
+  def get(self, cluster: str, svm: str, volume: str):
+    return self._by_name.get((cluster, svm, volume))
+
+  def source_of(self, cluster: str, svm: str, volume: str, uuid: str = None):
+    """Relationship record of a destination volume, by uuid if known, else by name """
+    record = self.by_uuid(cluster, uuid) if uuid else None
+    return record or self.get(cluster, svm, volume)
+
+
+@instrumented
+def load_relationships(index: RelationshipIndex, cluster: str, connection) -> int:
+  """Fetch all relationships of a destination cluster in one paged query """
+  records = [relationship_record(rel) for rel in SnapmirrorRelationship.get_collection(
+    connection=connection, fields=RELATIONSHIP_FIELDS, max_records=PAGE_SIZE)]
+  kept = index.add(cluster, records)
+  log.debug(f'Indexed {kept} SnapMirror relationships of destination cluster {cluster}')
+  return kept
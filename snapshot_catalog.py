@@ -0,0 +1,104 @@
+################################################################
+# Local SQLite catalog of NetApp ONTAP volume snapshots
+# (c)NetApp Professional Services Germany
+#
+# Summary: keeps snapshot lists of volumes between runs, keyed by
+#          cluster / volume uuid / version_uuid, so repeated runs
+#          only fetch the snapshots created since the last one. A
+#          listing of all version_uuids and names, when the count is
+#          off or the TTL is up, applies deletions and renames
+#
+################################################################
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from snapshot_index import SnapshotRecord
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+  cluster      TEXT NOT NULL,
+  volume_uuid  TEXT NOT NULL,
+  synced_at    REAL NOT NULL,
+  PRIMARY KEY (cluster, volume_uuid)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+  cluster      TEXT NOT NULL,
+  volume_uuid  TEXT NOT NULL,
+  version_uuid TEXT NOT NULL,
+  uuid         TEXT NOT NULL,
+  name         TEXT NOT NULL,
+  create_time  REAL NOT NULL,
+  ct_human     TEXT NOT NULL,
+  PRIMARY KEY (cluster, volume_uuid, version_uuid)
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_time ON snapshots (cluster, volume_uuid, create_time);
+"""
+
+# cached volumes without a full listing (synced_at) within this time are evicted
+DEFAULT_TTL = 24 * 3600
+
+
+class SnapshotCatalog:
+  """On-disk snapshot lists per (cluster, volume uuid) """
+
+  def __init__(self, path: str, ttl: float = DEFAULT_TTL):
+    self.path = path
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.executescript(SCHEMA)
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+  def evict(self) -> int:
+    """Drop volumes (and their snapshots) older than the TTL, returns the number of volumes dropped """
+    cutoff = time.time() - self.ttl
+    with self._lock, self._db:
+      expired = self._db.execute("SELECT cluster, volume_uuid FROM volumes WHERE synced_at < ?", (cutoff,)).fetchall()
+      for cluster, volume_uuid in expired:
+        self._forget(cluster, volume_uuid)
+    return len(expired)
+
+  def has(self, cluster: str, volume_uuid: str) -> bool:
+    with self._lock:
+      row = self._db.execute("SELECT synced_at FROM volumes WHERE cluster = ? AND volume_uuid = ?", (cluster, volume_uuid)).fetchone()
+    return row is not None and row[0] >= time.time() - self.ttl
+
+  def load(self, cluster: str, volume_uuid: str):
+    """Cached records oldest first, or None if the volume is not cached or expired """
+    if not self.has(cluster, volume_uuid):
+      return None
+    with self._lock:
+      rows = self._db.execute("SELECT version_uuid, uuid, name, create_time, ct_human FROM snapshots "
+                              "WHERE cluster = ? AND volume_uuid = ? ORDER BY create_time", (cluster, volume_uuid)).fetchall()
+    return [SnapshotRecord.from_datetime(r[0], r[1], r[2], datetime.fromisoformat(r[4])) for r in rows]
+
+  def store(self, cluster: str, volume_uuid: str, records):
+    """Replace the cached snapshot list of a volume """
+    with self._lock, self._db:
+      self._forget(cluster, volume_uuid)
+      self._insert(cluster, volume_uuid, records)
+      self._db.execute("INSERT INTO volumes (cluster, volume_uuid, synced_at) VALUES (?, ?, ?)", (cluster, volume_uuid, time.time()))
+
+  def apply_delta(self, cluster: str, volume_uuid: str, new_records, deleted_version_uuids=(), synced: bool = True):
+    """Add new snapshots and drop deleted ones. synced marks the volume as fully listed, which
+       restarts its TTL; a delta of new snapshots only leaves it due for its next full listing """
+    with self._lock, self._db:
+      self._insert(cluster, volume_uuid, new_records)
+      self._db.executemany("DELETE FROM snapshots WHERE cluster = ? AND volume_uuid = ? AND version_uuid = ?",
+                           [(cluster, volume_uuid, v) for v in deleted_version_uuids])
+      if synced:
+        self._db.execute("INSERT OR REPLACE INTO volumes (cluster, volume_uuid, synced_at) VALUES (?, ?, ?)", (cluster, volume_uuid, time.time()))
+
+  def _insert(self, cluster, volume_uuid, records):
+    self._db.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(cluster, volume_uuid, r["version_uuid"], r["uuid"], r["name"], r["create_time"], r["ct_human"].isoformat()) for r in records])
+
+  def _forget(self, cluster, volume_uuid):
+    self._db.execute("DELETE FROM snapshots WHERE cluster = ? AND volume_uuid = ?", (cluster, volume_uuid))
+    self._db.execute("DELETE FROM volumes WHERE cluster = ? AND volume_uuid = ?", (cluster, volume_uuid))
@@ -0,0 +1,214 @@
+################################################################
+# In-memory snapshot index of a NetApp ONTAP volume
+# (c)NetApp Professional Services Germany
+#
+# Summary: holds the snapshot list of one volume fetched with a
+#          single collection call in compact columns and answers
+#          lookups by name prefix (per prefix bitmaps), version_uuid
+#          and create_time order from memory
+#
+################################################################
+
+import re
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+SNAPSHOT_FIELDS = "create_time,version_uuid,name,volume,svm"
+# utcoffset column value of naive create_times
+NAIVE = -2 ** 31
+
+
+@lru_cache(maxsize=None)
+def _tz(utcoffset: int):
+  return timezone(timedelta(seconds=utcoffset))
+
+
+def _utcoffset(create_time: datetime) -> int:
+  offset = create_time.utcoffset()
+  return NAIVE if offset is None else int(offset.total_seconds())
+
+
+class SnapshotRecord:
+  """One snapshot. Reads like the former dict records (record["name"]), ct_human is
+     rebuilt from the float create_time and the cluster's UTC offset on access """
+
+  __slots__ = ("version_uuid", "uuid", "name", "create_time", "utcoffset")
+
+  def __init__(self, version_uuid, uuid, name, create_time: float, utcoffset: int = NAIVE):
+    self.version_uuid = version_uuid
+    self.uuid = uuid
+    self.name = name
+    self.create_time = create_time
+    self.utcoffset = utcoffset
+
+  @classmethod
+  def from_datetime(cls, version_uuid, uuid, name, create_time: datetime):
+    return cls(version_uuid, uuid, name, datetime.timestamp(create_time), _utcoffset(create_time))
+
+  @property
+  def ct_human(self) -> datetime:
+    if self.utcoffset == NAIVE:
+      return datetime.fromtimestamp(self.create_time)
+    return datetime.fromtimestamp(self.create_time, _tz(self.utcoffset))
+
+  def __getitem__(self, key):
+    if key not in ("version_uuid", "uuid", "name", "create_time", "ct_human"):
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def astuple(self):
+    """(version_uuid, uuid, name, create_time, utcoffset), SnapshotRecord(*t) rebuilds the record """
+    return (self.version_uuid, self.uuid, self.name, self.create_time, self.utcoffset)
+
+  def __eq__(self, other):
+    return isinstance(other, SnapshotRecord) and self.astuple() == other.astuple()
+
+  __hash__ = None
+
+  def __repr__(self):
+    return f'SnapshotRecord({self.name!r}, version_uuid={self.version_uuid!r}, ct_human={self.ct_human.isoformat()!r})'
+
+
+def snapshot_record(snap):
+  """Convert a Snapshot resource into the record format used by the scripts """
+  return SnapshotRecord.from_datetime(snap.version_uuid, snap.uuid, snap.name, snap.create_time)
+
+
+def snapshot_json_record(data: dict):
+  """Same record built straight from a REST response record, without a Snapshot resource """
+  create_time = datetime.fromisoformat(data["create_time"].replace("Z", "+00:00"))
+  return SnapshotRecord.from_datetime(data["version_uuid"], data["uuid"], data["name"], create_time)
+
+
+def scan_newest_first(records, regex):
+  """Walk records newest first and stop at the first one matching the regex.
+
+  Returns the matching record (or None) and the records younger than it,
+  oldest first. Nothing past the match is consumed from the iterator. """
+  younger = []
+  for record in records:
+    if regex.match(record["name"]):
+      younger.reverse()
+      return record, younger
+    younger.append(record)
+  younger.reverse()
+  return None, younger
+
+
+def _set_bits(bitmap: int):
+  """Positions of the set bits, lowest first """
+  while bitmap:
+    low = bitmap & -bitmap
+    yield low.bit_length() - 1
+    bitmap ^= low
+
+
+class SnapshotIndex:
+  """Snapshots of one volume as parallel columns ordered by create_time (oldest first).
+
+  Rows are only turned into SnapshotRecords when they are read. Name prefix
+  matches are kept as one bitmap per prefix, so the youngest match is the
+  highest set bit rather than a scan over records. """
+
+  def __init__(self, volume_uuid, cluster: str, records):
+    self.volume_uuid = volume_uuid
+    self.cluster = cluster
+    rows = sorted(records, key=lambda r: r["create_time"])
+    self.version_uuids = [r["version_uuid"] for r in rows]
+    self.uuids = [r["uuid"] for r in rows]
+    self.names = [r["name"] for r in rows]
+    self.create_times = array("d", (r["create_time"] for r in rows))
+    self.utcoffsets = array("i", (r.utcoffset if isinstance(r, SnapshotRecord) else _utcoffset(r["ct_human"]) for r in rows))
+    self._positions = None
+    self._bitmaps = {}
+    self.fetched_at = time.time()
+
+  @classmethod
+  def from_snapshots(cls, volume_uuid, cluster: str, snapshots):
+    return cls(volume_uuid, cluster, [snapshot_record(snap) for snap in snapshots])
+
+  def __len__(self):
+    return len(self.names)
+
+  def __iter__(self):
+    return self.ordered()
+
+  def row(self, pos: int) -> SnapshotRecord:
+    return SnapshotRecord(self.version_uuids[pos], self.uuids[pos], self.names[pos], self.create_times[pos], self.utcoffsets[pos])
+
+  @property
+  def records(self):
+    """All rows as records, oldest first """
+    return [self.row(pos) for pos in range(len(self))]
+
+  def ordered(self, newest_first: bool = False):
+    """Records in create_time order """
+    positions = range(len(self) - 1, -1, -1) if newest_first else range(len(self))
+    return (self.row(pos) for pos in positions)
+
+  def get(self, version_uuid):
+    """Record by version_uuid or None """
+    if self._positions is None:
+      self._positions = {v: pos for pos, v in enumerate(self.version_uuids)}
+    pos = self._positions.get(version_uuid)
+    return None if pos is None else self.row(pos)
+
+  def prefix_bitmap(self, prefix) -> int:
+    """Bit i is set if row i matches the prefix regex, computed once per prefix """
+    regex = re.compile(prefix) if isinstance(prefix, str) else prefix
+    bitmap = self._bitmaps.get(regex.pattern)
+    if bitmap is None:
+      bitmap = 0
+      for pos, name in enumerate(self.names):
+        if regex.match(name):
+          bitmap |= 1 << pos
+      self._bitmaps[regex.pattern] = bitmap
+    return bitmap
+
+  def prefix_names(self, prefix) -> dict:
+    """version_uuid -> name of the rows matching the prefix regex, oldest first """
+    return {self.version_uuids[pos]: self.names[pos] for pos in _set_bits(self.prefix_bitmap(prefix))}
+
+  def youngest_match(self, prefix):
+    """Position of the youngest record matching the prefix regex or None """
+    bitmap = self.prefix_bitmap(prefix)
+    return bitmap.bit_length() - 1 if bitmap else None
+
+  def after(self, pos: int):
+    """Records younger than the given position """
+    return [self.row(p) for p in range(pos + 1, len(self))]
+
+  def last_match(self, prefix):
+    """Same result as scan_newest_first() over the index: the youngest record matching
+       the prefix (or None) and the records younger than it, oldest first """
+    pos = self.youngest_match(prefix)
+    return (None, self.after(-1)) if pos is None else (self.row(pos), self.after(pos))
+
+
+class SnapshotDiff:
+  """Prefix snapshots of a target and a source volume compared by version_uuid """
+
+  def __init__(self, matched, missing_on_source, missing_on_target):
+    self.matched = matched
+    self.missing_on_source = missing_on_source
+    self.missing_on_target = missing_on_target
+
+  @property
+  def in_sync(self) -> bool:
+    return not self.missing_on_source and not self.missing_on_target
+
+  def to_dict(self) -> dict:
+    return {"matched": self.matched, "missing_on_source": self.missing_on_source, "missing_on_target": self.missing_on_target}
+
+
+def compare_prefix_snapshots(target: SnapshotIndex, source: SnapshotIndex, prefix) -> SnapshotDiff:
+  """Compare the prefix snapshots of two indexes; each part maps version_uuid to name """
+  target_snaps = target.prefix_names(prefix)
+  source_snaps = source.prefix_names(prefix)
+  return SnapshotDiff(
+    matched={k: v for k, v in target_snaps.items() if k in source_snaps},
+    missing_on_source={k: v for k, v in target_snaps.items() if k not in source_snaps},
+    missing_on_target={k: v for k, v in source_snaps.items() if k not in target_snaps},
+  )
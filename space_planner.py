@@ -0,0 +1,161 @@
+################################################################
+# Reclaimable space planner for volume snapshot restores
+# (c)NetApp Professional Services Germany
+#
+# Summary: works out for every volume which snapshots a restore
+#          to the snapshot after the youngest relevant one would
+#          discard and how many bytes that frees, keeps the
+#          results of a whole fleet in columns and writes them as
+#          a plan ranked by reclaimable bytes (CSV or JSON) that
+#          vol_snap_optimize.py --execute_plan runs
+#
+################################################################
+
+import csv
+import json
+import re
+from array import array
+from datetime import datetime
+from itertools import accumulate
+
+from netapp_ontap.resources import Snapshot
+
+from ontap_metrics import instrumented
+from volume_lookup import PAGE_SIZE
+
+# snapshot fields the planner reads, size is the space held by the snapshot alone
+SIZE_FIELDS = "name,create_time,version_uuid,size"
+PLAN_FIELDS = ("rank", "cluster", "vserver", "volume", "source_cluster", "source_vserver", "source_volume",
+               "volume_uuid", "aggregate", "relevant_snapshot", "relevant_snapshot_uuid", "restore_snapshot",
+               "restore_version_uuid", "discarded_snapshots", "reclaimable_bytes", "cumulative_bytes", "volume_used")
+_TEXT_FIELDS = PLAN_FIELDS[1:13]
+_INT_FIELDS = ("rank", "discarded_snapshots", "reclaimable_bytes", "cumulative_bytes", "volume_used")
+
+
+class SnapshotSizes:
+  """name, version_uuid and size columns of one volume's snapshots, oldest first """
+
+  __slots__ = ("names", "version_uuids", "sizes")
+
+  def __init__(self, rows):
+    # rows: (create_time, name, version_uuid, size)
+    rows = sorted(rows, key=lambda r: r[0])
+    self.names = [r[1] for r in rows]
+    self.version_uuids = [r[2] for r in rows]
+    self.sizes = array("q", (r[3] or 0 for r in rows))
+
+  def __len__(self):
+    return len(self.names)
+
+  @classmethod
+  def from_snapshots(cls, snapshots):
+    return cls((datetime.timestamp(s.create_time), s.name, s.version_uuid, getattr(s, "size", 0)) for s in snapshots)
+
+  @classmethod
+  def from_json(cls, records):
+    return cls((datetime.fromisoformat(r["create_time"].replace("Z", "+00:00")).timestamp(), r["name"], r["version_uuid"], r.get("size", 0))
+               for r in records)
+
+
+@instrumented
+def snapshot_sizes(volume_uuid, connection) -> SnapshotSizes:
+  return SnapshotSizes.from_snapshots(Snapshot.get_collection(volume_uuid, connection=connection, fields=SIZE_FIELDS,
+                                                              order_by="create_time", max_records=PAGE_SIZE))
+
+
+def restore_candidate(snapshots: SnapshotSizes, prefix):
+  """(relevant position, restore position, discarded snapshots, reclaimable bytes) of a volume.
+
+  The restore goes to the snapshot after the youngest one matching the prefix,
+  every snapshot younger than that is deleted by ONTAP. The reclaimable bytes
+  are the sum of their sizes, a lower bound: blocks shared only among the
+  discarded snapshots are freed too. None if there is nothing to restore to. """
+  regex = re.compile(prefix) if isinstance(prefix, str) else prefix
+  names = snapshots.names
+  relevant = next((pos for pos in range(len(names) - 1, -1, -1) if regex.match(names[pos])), None)
+  if relevant is None or relevant + 1 >= len(names):
+    return None
+  restore = relevant + 1
+  return relevant, restore, len(names) - restore - 1, sum(snapshots.sizes[restore + 1:])
+
+
+class SpacePlan:
+  """Restore candidates of a fleet as columns, ranked by reclaimable bytes on output """
+
+  def __init__(self):
+    self.text = {field: [] for field in _TEXT_FIELDS}
+    self.discarded = array("q")
+    self.reclaimable = array("q")
+    self.volume_used = array("q")
+
+  def __len__(self):
+    return len(self.reclaimable)
+
+  def add(self, entry: dict, volume: dict, snapshots: SnapshotSizes, prefix) -> bool:
+    """Add a volume if it has a restore candidate, entry carries the inventory fields """
+    candidate = restore_candidate(snapshots, prefix)
+    if candidate is None:
+      return False
+    relevant, restore, discarded, reclaimable = candidate
+    values = dict(entry, volume_uuid=volume["uuid"], aggregate=volume.get("aggregate"),
+                  relevant_snapshot=snapshots.names[relevant], relevant_snapshot_uuid=snapshots.version_uuids[relevant],
+                  restore_snapshot=snapshots.names[restore], restore_version_uuid=snapshots.version_uuids[restore])
+    for field, column in self.text.items():
+      column.append(values.get(field))
+    self.discarded.append(discarded)
+    self.reclaimable.append(reclaimable)
+    self.volume_used.append(volume.get("used") or 0)
+    return True
+
+  def order(self):
+    """Row positions by reclaimable bytes, then discarded snapshots, descending """
+    return sorted(range(len(self)), key=lambda pos: (-self.reclaimable[pos], -self.discarded[pos], self.text["volume"][pos]))
+
+  def ranked(self) -> list:
+    """Rows as dicts in rank order with the running total of reclaimable bytes """
+    order = self.order()
+    cumulative = accumulate(self.reclaimable[pos] for pos in order)
+    rows = []
+    for rank, (pos, total) in enumerate(zip(order, cumulative), 1):
+      row = {field: column[pos] for field, column in self.text.items()}
+      row.update({"rank": rank, "discarded_snapshots": self.discarded[pos], "reclaimable_bytes": self.reclaimable[pos],
+                  "cumulative_bytes": total, "volume_used": self.volume_used[pos]})
+      rows.append(row)
+    return rows
+
+  def totals(self, field: str = "cluster") -> dict:
+    """{value of a text column: (restores, reclaimable bytes)} """
+    totals = {}
+    for key, reclaimable in zip(self.text[field], self.reclaimable):
+      count, total = totals.get(key, (0, 0))
+      totals[key] = (count + 1, total + reclaimable)
+    return totals
+
+  def write(self, path: str) -> list:
+    """Write the ranked plan as CSV or JSON (by file extension) """
+    rows = self.ranked()
+    if path.lower().endswith(".json"):
+      with open(path, "w") as f:
+        json.dump(rows, f, indent=2)
+    else:
+      with open(path, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PLAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def load_plan(path: str) -> list:
+  """Rows of a plan file in rank order, empty text fields as None """
+  if path.lower().endswith(".json"):
+    with open(path) as f:
+      rows = json.load(f)
+  else:
+    with open(path, newline='') as f:
+      rows = list(csv.DictReader(f))
+  plan = []
+  for row in rows:
+    entry = {field: (str(row[field]) if row.get(field) not in (None, "") else None) for field in _TEXT_FIELDS}
+    entry.update({field: int(row[field]) if row.get(field) not in (None, "") else 0 for field in _INT_FIELDS})
+    plan.append(entry)
+  return sorted(plan, key=lambda entry: entry["rank"])
@@ -0,0 +1,119 @@
+################################################################
+# Checks of ontap_service.py against the fake ONTAP server
+# (c)NetApp Professional Services Germany
+#
+# Summary: bearer token and Host header checks, JSON-only job
+#          submission, long polls and optimize jobs that stay running
+#          until their restore ends, served on localhost
+#
+#          python -m pytest -q test_ontap_service.py
+#
+################################################################
+
+import http.client
+import json
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import ontap_service
+import vol_snap_optimize
+from bench_vol_optimize import SVM
+
+TOKEN = "secret"
+
+
+class UnixConnection(http.client.HTTPConnection):
+
+  def __init__(self, path: str):
+    super().__init__("localhost")
+    self.path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.path)
+
+
+@pytest.fixture
+def service(clusters):
+  vol_snap_optimize.args = ontap_service.JobArgs(vol_snap_optimize.parse_args(
+    ontap_service.PLACEHOLDER + ["-p", "test", "--skip_src_validation", "--journal", "none", "--job_poll_interval", "0.05"]))
+  service = ontap_service.JobService(workers=2)
+  server = ontap_service.serve(service, TOKEN, "127.0.0.1:0")
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+  server.shutdown()
+  server.server_close()
+  service.stop()
+
+
+def call(connection, method: str, path: str, body: dict = None, headers: dict = None):
+  headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json", **(headers or {})}
+  connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+  response = connection.getresponse()
+  status, answer = response.status, json.loads(response.read())
+  connection.close()
+  return status, answer
+
+
+def test_requests_without_the_token_or_from_another_host_are_refused(service):
+  assert call(service, "GET", "/health")[0] == 200
+  assert call(service, "GET", "/health", headers={"Authorization": ""})[0] == 401
+  assert call(service, "GET", "/health", headers={"Authorization": "Bearer wrong"})[0] == 401
+  assert call(service, "GET", "/health", headers={"Authorization": f"Basic {TOKEN}"})[0] == 401
+  # DNS rebinding: a page of another site resolving to 127.0.0.1
+  status, answer = call(service, "GET", "/health", headers={"Host": "attacker.example:8750"})
+  assert status == 403 and "Host" in answer["error"]
+
+
+def test_jobs_are_only_submitted_as_json(clusters, service):
+  target, _ = clusters
+  vol_uuid = target.ontap.add_volume(SVM, "vol1", snapshots=5)
+  job = {"type": "list", "cluster": target.name, "vserver": SVM, "volume": "vol1"}
+  assert call(service, "POST", "/jobs", job, headers={"Content-Type": "text/plain"})[0] == 415
+  assert call(service, "POST", "/jobs", job, headers={"Content-Type": "application/x-www-form-urlencoded"})[0] == 415
+  assert call(service, "POST", "/jobs", {**job, "type": "optimize"})[0] == 400
+  assert call(service, "GET", "/jobs")[1] == {"jobs": []}
+
+  status, queued = call(service, "POST", "/jobs", job)
+  assert status == 202
+  status, listed = call(service, "GET", f"/jobs/{queued['id']}?wait=10")
+  assert (listed["state"], listed["result"]["volume_uuid"], len(listed["result"]["snapshots"])) == ("done", vol_uuid, 5)
+  for wait in ("abc", "nan"):
+    assert call(service, "GET", f"/jobs/{queued['id']}?wait={wait}")[0] == 400
+  assert call(service, "GET", f"/jobs/{queued['id']}?wait=-1")[0] == 200
+
+
+def test_optimize_job_is_running_until_its_restore_ends(clusters, service):
+  target, _ = clusters
+  target.ontap.job_duration = 1.0
+  target.ontap.add_volume(SVM, "vol1", snapshots=60, prefix_every=24)
+  status, job = call(service, "POST", "/jobs", {"type": "optimize", "cluster": target.name, "vserver": SVM, "volume": "vol1",
+                                                "confirm": True})
+  assert status == 202
+
+  status, job = call(service, "GET", f"/jobs/{job['id']}?wait=0.5")
+  assert job["state"] == "running" and job["finished"] is None
+  status, job = call(service, "GET", f"/jobs/{job['id']}?wait=10")
+  assert (job["state"], job["result"]["status"]) == ("done", "restored")
+  assert job["finished"] is not None
+  assert job["result"]["restore_snapshot"] == "hourly.000049"
+
+
+def test_unix_socket_is_only_open_to_its_owner(tmp_path):
+  path = str(tmp_path / "service.sock")
+  service = ontap_service.JobService(workers=1)
+  server = ontap_service.serve(service, TOKEN, None, path)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  try:
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    # no Host check on the socket, the token is still required
+    assert call(UnixConnection(path), "GET", "/health", headers={"Host": "attacker.example"})[0] == 200
+    assert call(UnixConnection(path), "GET", "/health", headers={"Authorization": ""})[0] == 401
+  finally:
+    server.shutdown()
+    server.server_close()
+    service.stop()
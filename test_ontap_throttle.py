@@ -0,0 +1,106 @@
+################################################################
+# Checks of ontap_throttle.py, alone and against the fake ONTAP
+# (c)NetApp Professional Services Germany
+#
+# Summary: AIMD concurrency limit, Retry-After pauses and async
+#          waiters of the per cluster throttle, and a cluster that
+#          answers 429 past two requests in flight
+#
+#          python -m pytest -q test_ontap_throttle.py
+#
+################################################################
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from netapp_ontap.resources import Volume
+
+import ontap_session
+from bench_vol_optimize import SVM
+from ontap_throttle import OK, THROTTLED, FAILED, ClusterThrottle
+
+
+def test_limit_halves_on_errors_and_grows_back_on_successes():
+  throttle = ClusterThrottle("c1", max_concurrency=8, cooldown=0.0)
+  throttle.acquire()
+  throttle.release(THROTTLED)
+  assert int(throttle.limit) == 4
+  throttle.acquire()
+  throttle.release(FAILED)
+  assert int(throttle.limit) == 2
+  for _ in range(3):
+    throttle.acquire()
+    throttle.release(THROTTLED)
+  assert int(throttle.limit) == throttle.min_concurrency == 1
+
+  # about one slot more per window of `limit` successes
+  for _ in range(1 + 2 + 3):
+    throttle.acquire()
+    throttle.release(OK)
+  assert int(throttle.limit) == 3
+  for _ in range(100):
+    throttle.acquire()
+    throttle.release(OK)
+  assert int(throttle.limit) == 8
+  assert throttle.stats() == {"limit": 8, "in_flight": 0, "throttled": 4, "decreases": 5}
+
+
+def test_burst_of_errors_within_the_cooldown_counts_once():
+  throttle = ClusterThrottle("c1", max_concurrency=8, cooldown=60.0)
+  for _ in range(4):
+    throttle.acquire()
+  for _ in range(4):
+    throttle.release(THROTTLED)
+  assert int(throttle.limit) == 4 and throttle.decreases == 1
+
+
+def test_retry_after_pauses_the_cluster():
+  throttle = ClusterThrottle("c1", max_concurrency=4)
+  throttle.acquire()
+  throttle.release(THROTTLED, pause=0.3)
+  assert not throttle.try_acquire()
+  start = time.monotonic()
+  throttle.acquire()
+  assert time.monotonic() - start >= 0.25
+  throttle.release(OK)
+
+
+def test_async_waiters_never_exceed_the_limit():
+  throttle = ClusterThrottle("c1", max_concurrency=4)
+  running = []
+
+  async def request():
+    await throttle.acquire_async()
+    running.append(throttle.in_flight)
+    await asyncio.sleep(0.001)
+    throttle.release(OK)
+
+  async def main():
+    await asyncio.gather(*(request() for _ in range(300)))
+
+  asyncio.run(main())
+  assert len(running) == 300 and max(running) == 4
+  assert throttle.stats()["in_flight"] == 0
+
+
+def test_overloaded_cluster_is_throttled_and_every_get_succeeds(clusters):
+  target, _ = clusters
+  target.ontap.max_in_flight = 2
+  target.ontap.latency = 0.02
+  for i in range(4):
+    target.ontap.add_volume(SVM, f"vol{i}")
+  sessions = ontap_session.init_sessions("test", "test", pool_size=12, scheme="http")
+
+  def list_volumes(_):
+    return len(list(Volume.get_collection(connection=ontap_session.get_connection(target.name), fields="name")))
+
+  with ThreadPoolExecutor(max_workers=12) as pool:
+    counts = list(pool.map(list_volumes, range(24)))
+  assert counts == [4] * 24
+  assert target.ontap.rejected > 0
+  stats = sessions.throttles.get(target.name).stats()
+  # 429 halved the limit, the throttle counted what the cluster rejected
+  assert stats["decreases"] >= 1 and stats["limit"] < 12
+  assert stats["throttled"] == target.ontap.rejected
+  assert stats["in_flight"] == 0
@@ -0,0 +1,100 @@
+################################################################
+# Checks of restore_jobs.py against the fake ONTAP server
+# (c)NetApp Professional Services Germany
+#
+# Summary: restore slots per cluster and aggregate, jobs past their
+#          timeout and the non-blocking poller, with restore jobs
+#          run by fake_ontap.py on localhost
+#
+#          python -m pytest -q test_restore_jobs.py
+#
+################################################################
+
+import threading
+import time
+
+from netapp_ontap.resources import Volume
+
+from bench_vol_optimize import SVM
+from ontap_session import get_connection
+from restore_jobs import UNKNOWN, JobTracker
+
+
+def restore(cluster, ontap, vol_uuid: str, spans: dict):
+  """submit() of a restore to the volume's second snapshot, records when it started """
+  def submit():
+    spans[vol_uuid] = [time.time(), None]
+    vol = Volume()
+    vol.set_connection(get_connection(cluster.name))
+    return vol.patch(poll=False, uuid=vol_uuid, **{"restore_to.snapshot.uuid": ontap.snapshots[vol_uuid][1]["uuid"]})
+  return submit
+
+
+def most_at_once(spans) -> int:
+  events = sorted([(start, 1) for start, _ in spans] + [(end, -1) for _, end in spans])
+  running = peak = 0
+  for _, step in events:
+    running += step
+    peak = max(peak, running)
+  return peak
+
+
+def test_restores_keep_the_cluster_and_aggregate_limits(clusters):
+  target, _ = clusters
+  target.ontap.job_duration = 0.3
+  aggregates = {target.ontap.add_volume(SVM, f"vol{i}", snapshots=5, aggregate=aggr): aggr
+                for i, aggr in enumerate(["aggr1"] * 4 + ["aggr2"] * 3)}
+  tracker = JobTracker(max_per_cluster=3, max_per_aggregate=2, poll_interval=0.05)
+  spans, jobs = {}, []
+
+  def done(job):
+    spans[job.label][1] = job.finished
+
+  threads = [threading.Thread(target=lambda u=vol_uuid, a=aggr: jobs.append(
+               tracker.submit(u, target.name, a, restore(target, target.ontap, u, spans), done)))
+             for vol_uuid, aggr in aggregates.items()]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  tracker.close()
+
+  assert [job.state for job in jobs] == ["success"] * 7
+  assert most_at_once(spans.values()) == 3
+  assert most_at_once([span for u, span in spans.items() if aggregates[u] == "aggr1"]) == 2
+
+
+def test_restore_past_its_timeout_is_unknown_and_keeps_its_slots(clusters):
+  target, _ = clusters
+  target.ontap.job_duration = 1.0
+  first, second = (target.ontap.add_volume(SVM, f"vol{i}", snapshots=5) for i in range(2))
+  tracker = JobTracker(max_per_cluster=1, poll_interval=0.05, max_interval=0.1, timeout=0.3)
+  spans, reported = {}, []
+
+  job = tracker.submit("first", target.name, "aggr1", restore(target, target.ontap, first, spans), reported.append)
+  tracker.wait_all()
+  assert job.state == UNKNOWN and reported == [job]
+  assert tracker.in_flight() == 0
+
+  # the cluster slot is free only once ONTAP ended the overdue restore
+  tracker.submit("second", target.name, "aggr1", restore(target, target.ontap, second, spans))
+  assert spans[second][0] >= spans[first][0] + target.ontap.job_duration
+  tracker.close()
+  # reported once, as UNKNOWN
+  assert reported == [job] and job.state == UNKNOWN
+
+
+def test_slow_completion_handler_does_not_hold_up_polling(clusters):
+  target, _ = clusters
+  target.ontap.job_duration = 0.2
+  slow, fast = (target.ontap.add_volume(SVM, f"vol{i}", snapshots=5, aggregate=f"aggr{i}") for i in range(2))
+  tracker = JobTracker(poll_interval=0.05, max_interval=0.05)
+  spans = {}
+
+  slow_job = tracker.submit("slow", target.name, "aggr0", restore(target, target.ontap, slow, spans), lambda job: time.sleep(1.0))
+  time.sleep(0.1)
+  fast_job = tracker.submit("fast", target.name, "aggr1", restore(target, target.ontap, fast, spans))
+  tracker.close()
+  assert (slow_job.state, fast_job.state) == ("success", "success")
+  # found done at its first polls, not after the slow handler
+  assert fast_job.finished - fast_job.submitted < 0.6
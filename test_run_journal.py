@@ -0,0 +1,100 @@
+################################################################
+# Checks of run_journal.py and of --resume against the fake ONTAP
+# (c)NetApp Professional Services Germany
+#
+# Summary: journal replay and rotation, volumes skipped by a resumed
+#          run and restores an interrupted run submitted without
+#          recording their outcome
+#
+#          python -m pytest -q test_run_journal.py
+#
+################################################################
+
+import vol_snap_optimize
+from bench_vol_optimize import SVM
+from run_journal import DRY_RUN_OK, RESTORE_OUTCOMES, RESTORE_SUBMITTED, RESTORED, RunJournal
+
+
+def resume_args(cluster: str, journal_path: str, *extra):
+  vol_snap_optimize.args = vol_snap_optimize.parse_args(["-c", cluster, "-svm", SVM, "-vol", "vol0", "-p", "test", "--skip_src_validation",
+                                                         "--journal", journal_path, "--job_poll_interval", "0.05", *extra])
+  vol_snap_optimize._journal = RunJournal(journal_path, resume=vol_snap_optimize.args.resume)
+
+
+def optimize(cluster: str, volume: str, dryrun: bool) -> dict:
+  result = vol_snap_optimize.optimize_volume({"cluster": cluster, "vserver": SVM, "volume": volume}, dryrun, False, assume_yes=True)
+  if vol_snap_optimize._restore_tracker is not None:
+    vol_snap_optimize._restore_tracker.wait_all()
+  return result
+
+
+def test_replay_keeps_the_last_record_and_a_new_run_rotates(tmp_path):
+  path = str(tmp_path / "run.journal")
+  journal = RunJournal(path)
+  journal.record("c1", SVM, "vol0", "scanned", snapshots=[])
+  journal.record("c1", SVM, "vol0", RESTORE_SUBMITTED, durable=True, restore_snapshot="hourly.1")
+  journal.record("c1", SVM, "vol0", "restore failed", durable=True, message="first try")
+  journal.record("c1", SVM, "vol0", RESTORE_SUBMITTED, durable=True, restore_snapshot="hourly.2")
+  journal.close()
+  with open(path, "a") as f:
+    # a line cut short by a crash
+    f.write('{"ts": 1, "cluster": "c1", "svm": "svm1", "vol')
+
+  resumed = RunJournal(path, resume=True)
+  assert resumed.completed("c1", SVM, "vol0")[RESTORE_SUBMITTED] == {"restore_snapshot": "hourly.2"}
+  # the resubmit came after the failure, its outcome is missing
+  assert resumed.latest("c1", SVM, "vol0", (RESTORE_SUBMITTED,) + RESTORE_OUTCOMES) == RESTORE_SUBMITTED
+  resumed.close()
+
+  RunJournal(path).close()
+  assert RunJournal.replay(path) == {}
+  assert RESTORE_SUBMITTED in RunJournal.replay(f"{path}.1")[("c1", SVM, "vol0")]
+
+
+def test_resumed_runs_skip_finished_volumes(clusters, tmp_path):
+  target, _ = clusters
+  for i in range(2):
+    target.ontap.add_volume(SVM, f"vol{i}", snapshots=60)
+  path = str(tmp_path / "run.journal")
+  resume_args(target.name, path)
+  assert optimize(target.name, "vol0", True)["status"] == DRY_RUN_OK
+  assert optimize(target.name, "vol1", False)["status"] == RESTORED
+  vol_snap_optimize._journal.close()
+
+  target.ontap.reset_counters()
+  resume_args(target.name, path, "--resume")
+  assert optimize(target.name, "vol0", True)["status"] == "skipped"
+  assert optimize(target.name, "vol1", True)["status"] == "skipped"
+  assert target.ontap.calls == {}
+  # a restore run only skips restored volumes, and looks up and scans the others again
+  assert optimize(target.name, "vol1", False)["status"] == "skipped"
+  assert optimize(target.name, "vol0", False)["status"] == RESTORED
+  vol_snap_optimize._journal.close()
+
+
+def test_interrupted_restore_is_verified_and_never_sent_again(clusters, tmp_path):
+  target, _ = clusters
+  uuids = [target.ontap.add_volume(SVM, f"vol{i}", snapshots=60) for i in range(2)]
+  path = str(tmp_path / "run.journal")
+  journal = RunJournal(path)
+  for vol_uuid, volume in zip(uuids, ("vol0", "vol1")):
+    restore_snap = target.ontap.snapshots[vol_uuid][49]
+    journal.record(target.name, SVM, volume, RESTORE_SUBMITTED, durable=True,
+                   restore_snapshot=restore_snap["name"], restore_version_uuid=restore_snap["version_uuid"])
+  journal.close()
+  # the restore of vol0 went through before the run was interrupted, the one of vol1 did not
+  target.ontap.restore(uuids[0], target.ontap.snapshots[uuids[0]][49]["uuid"])
+
+  resume_args(target.name, path, "--resume")
+  verified, unverified = optimize(target.name, "vol0", False), optimize(target.name, "vol1", False)
+  vol_snap_optimize._journal.close()
+  assert (verified["status"], verified["restore_snapshot"]) == (RESTORED, "hourly.000049")
+  assert unverified["status"] == "error" and "not verified" in unverified["message"]
+  assert "PATCH volume restore" not in target.ontap.calls
+  assert len(target.ontap.snapshots[uuids[1]]) == 60
+
+  # a further resumed run still finds the restore of vol1 unverified
+  journal = RunJournal(path, resume=True)
+  assert journal.latest(target.name, SVM, "vol0", (RESTORE_SUBMITTED,) + RESTORE_OUTCOMES) == RESTORED
+  assert journal.latest(target.name, SVM, "vol1", (RESTORE_SUBMITTED,) + RESTORE_OUTCOMES) == RESTORE_SUBMITTED
+  journal.close()
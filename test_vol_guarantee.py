@@ -0,0 +1,59 @@
+################################################################
+# Checks of vol_guarantee.py against the fake ONTAP server
+# (c)NetApp Professional Services Germany
+#
+# Summary: bulk guarantee enforcement with collection PATCHes,
+#          run against fake_ontap.py on localhost
+#
+#          python -m pytest -q test_vol_guarantee.py
+#
+################################################################
+
+import vol_guarantee
+from bench_vol_optimize import SVM
+from run_journal import RunJournal
+
+
+def enforce(cluster: str, journal_path: str, *extra):
+  vol_guarantee.args = vol_guarantee.parse_args(["-c", cluster, "--bulk", "-svm", SVM, "-vol", "vol*", "--guarantee", "none",
+                                                 "-p", "test", "--journal", journal_path, *extra])
+  vol_guarantee._journal = RunJournal(journal_path, resume=vol_guarantee.args.resume)
+  reselect = lambda: vol_guarantee.select_volumes(cluster, SVM, "vol*")
+  try:
+    results = vol_guarantee.enforce_guarantee(cluster, reselect(), "none", 4, False, reselect)
+  finally:
+    vol_guarantee._journal.close()
+  return {result["volume"]: result for result in results}
+
+
+def test_bulk_patch_isolates_a_failing_volume(clusters, tmp_path):
+  target, _ = clusters
+  uuids = {f"vol{i}": target.ontap.add_volume(SVM, f"vol{i}") for i in range(6)}
+  target.ontap.volumes[uuids["vol2"]]["state"] = "offline"
+  journal_path = str(tmp_path / "guarantee.journal")
+
+  results = enforce(target.name, journal_path)
+  assert {name: result["status"] for name, result in results.items()} == {
+    "vol0": "changed", "vol1": "changed", "vol2": "failed", "vol3": "changed", "vol4": "changed", "vol5": "changed"}
+  assert "offline" in results["vol2"]["message"]
+  # two batches of up to 4, the one holding vol2 failed as a whole and was patched one by one
+  assert target.ontap.calls["PATCH volume patch"] == 2 + 4
+  assert [vol["guarantee"]["type"] for vol in target.ontap.volumes.values()] == ["none", "none", "volume", "none", "none", "none"]
+
+  # only the verified changes are journaled
+  journal = RunJournal(journal_path, resume=True)
+  assert [name for name in uuids if journal.completed(target.name, SVM, name)] == ["vol0", "vol1", "vol3", "vol4", "vol5"]
+  journal.close()
+
+
+def test_resume_changes_a_volume_changed_back_since_the_journaled_run(clusters, tmp_path):
+  target, _ = clusters
+  uuids = {f"vol{i}": target.ontap.add_volume(SVM, f"vol{i}") for i in range(3)}
+  journal_path = str(tmp_path / "guarantee.journal")
+  assert {result["status"] for result in enforce(target.name, journal_path).values()} == {"changed"}
+
+  target.ontap.volumes[uuids["vol1"]]["guarantee"]["type"] = "volume"
+  results = enforce(target.name, journal_path, "--resume")
+  assert {name: result["status"] for name, result in results.items()} == {"vol0": "skipped", "vol1": "changed", "vol2": "skipped"}
+  assert "previous run" in results["vol0"]["message"]
+  assert target.ontap.volumes[uuids["vol1"]]["guarantee"]["type"] == "none"
@@ -0,0 +1,195 @@
+################################################################
+# Checks of vol_snap_optimize.py against the fake ONTAP server
+# (c)NetApp Professional Services Germany
+#
+# Summary: snapshot selection, restore plans and their approval,
+#          plan drift, catalog sync and the bench scenarios, all run
+#          against fake_ontap.py on localhost
+#
+#          python -m pytest -q test_vol_optimize.py
+#
+################################################################
+
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import bench_vol_optimize
+import fake_ontap
+import restore_plan
+import vol_snap_optimize
+from bench_vol_optimize import SVM, mirror_volume
+from run_journal import RESTORE_SUBMITTED, RunJournal
+from snapshot_catalog import SnapshotCatalog
+from snapshot_index import SnapshotIndex, SnapshotRecord, scan_newest_first
+
+BENCH_ARGS = SimpleNamespace(scale=0.005, latency=0.0, workers=4)
+
+
+def add_snapshot(ontap: fake_ontap.FakeOntap, vol_uuid: str, name: str):
+  """Append a snapshot one hour younger than the youngest one of the volume """
+  newest = datetime.fromisoformat(ontap.snapshots[vol_uuid][-1]["create_time"])
+  ontap.snapshots[vol_uuid].append(ontap.make_snapshot(vol_uuid, name, newest + timedelta(hours=1)))
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_last_match_agrees_with_scan_newest_first(seed):
+  rng = random.Random(seed)
+  start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+  records = [SnapshotRecord.from_datetime(f"v{i}", f"u{i}", rng.choice(["hourly", "daily", "FREEZE", "LH", "NONE", "xFREEZE"]) + f".{i}",
+                                          start + timedelta(minutes=i))
+             for i in range(rng.randint(0, 40))]
+  rng.shuffle(records)
+  index = SnapshotIndex("vol", "cluster", records)
+  regex = re.compile(vol_snap_optimize.SNAPPREFIX)
+  assert index.last_match(regex) == scan_newest_first(index.ordered(newest_first=True), regex)
+
+
+def test_plan_checksum_accepts_the_plan_and_refuses_tampering(tmp_path):
+  path = str(tmp_path / "restores.json")
+  entries = [{"cluster": "c1", "vserver": SVM, "volume": "vol1", "volume_uuid": "u1", "restore_snapshot": "hourly.000001"}]
+  checksum = restore_plan.write_restore_plan(path, entries)
+
+  loaded = restore_plan.load_restore_plan(path, checksum[:restore_plan.MIN_APPROVAL])
+  assert [entry["volume"] for entry in loaded] == ["vol1"]
+  with pytest.raises(restore_plan.PlanError, match="approval"):
+    restore_plan.load_restore_plan(path, checksum[:restore_plan.MIN_APPROVAL - 1])
+  with pytest.raises(restore_plan.PlanError, match="approval"):
+    restore_plan.load_restore_plan(path, "0" * 64)
+
+  with open(path) as f:
+    text = f.read()
+  with open(path, "w") as f:
+    f.write(text.replace("hourly.000001", "hourly.000002"))
+  with pytest.raises(restore_plan.PlanError, match="changed after it was written"):
+    restore_plan.load_restore_plan(path, checksum)
+
+
+def test_plan_drift_catches_a_new_freeze_snapshot(clusters, tmp_path):
+  target, source = clusters
+  vol_uuid = target.ontap.add_volume(SVM, "vol1", snapshots=60, prefix_every=24)
+  mirror_volume(source.ontap, target.ontap, vol_uuid, "vol1")
+  vol_snap_optimize.args = bench_vol_optimize.script_args(target.name, 1)
+  entry = {"cluster": target.name, "vserver": SVM, "volume": "vol1",
+           "source_cluster": source.name, "source_vserver": SVM, "source_volume": "vol1"}
+  result = vol_snap_optimize.optimize_volume(entry, True, False)
+  assert result["status"] == "dry-run ok"
+
+  path = str(tmp_path / "restores.json")
+  vol_snap_optimize.write_plan([result], path)
+  with open(path) as f:
+    checksum = re.search(r'"sha256": "(\w+)"', f.read()).group(1)
+  planned, = restore_plan.load_restore_plan(path, checksum)
+  assert planned["relevant_snapshot"] == "FREEZE_000048"
+  assert planned["restore_snapshot"] == "hourly.000049"
+  restore_snap = target.ontap.snapshots[vol_uuid][49]
+  assert (planned["restore_snapshot_uuid"], planned["restore_version_uuid"]) == (restore_snap["uuid"], restore_snap["version_uuid"])
+  assert vol_snap_optimize.plan_drift(planned) is None
+
+  add_snapshot(target.ontap, vol_uuid, "FREEZE_new")
+  assert "FREEZE_new" in vol_snap_optimize.plan_drift(planned)
+
+
+def test_approved_plan_skips_a_drifted_volume_and_restores_the_others(clusters, tmp_path):
+  target, _ = clusters
+  uuids = [target.ontap.add_volume(SVM, f"vol{i}", snapshots=60, prefix_every=24) for i in range(2)]
+  journal_path = str(tmp_path / "run.journal")
+  vol_snap_optimize.args = bench_vol_optimize.script_args(target.name, 1, "--skip_src_validation", "--journal", journal_path,
+                                                          "--job_poll_interval", "0.05")
+  vol_snap_optimize._journal = RunJournal(journal_path)
+  results = [vol_snap_optimize.optimize_volume({"cluster": target.name, "vserver": SVM, "volume": f"vol{i}"}, True, False) for i in range(2)]
+  path = str(tmp_path / "restores.json")
+  vol_snap_optimize.write_plan(results, path)
+  with open(path) as f:
+    checksum = re.search(r'"sha256": "(\w+)"', f.read()).group(1)
+
+  add_snapshot(target.ontap, uuids[1], "FREEZE_new")
+  restored, drifted = [vol_snap_optimize.restore_approved(entry) for entry in sorted(restore_plan.load_restore_plan(path, checksum),
+                                                                                      key=lambda entry: entry["volume"])]
+  vol_snap_optimize._restore_tracker.wait_all()
+  vol_snap_optimize._journal.close()
+  assert restored["status"] == "restored"
+  assert drifted["status"] == "skipped" and "FREEZE_new" in drifted["message"]
+  assert target.ontap.calls["PATCH volume restore"] == 2 + 1
+  assert len(target.ontap.snapshots[uuids[1]]) == 61
+  # journaled as submitted only after its check passed
+  entries = RunJournal.replay(journal_path)
+  assert RESTORE_SUBMITTED in entries[(target.name, SVM, "vol0")]
+  assert RESTORE_SUBMITTED not in entries[(target.name, SVM, "vol1")]
+  assert "plan drift" in entries[(target.name, SVM, "vol1")]
+
+
+def test_restore_sends_the_instance_uuid_and_validates_by_version_uuid(clusters):
+  target, source = clusters
+  vol_uuid = target.ontap.add_volume(SVM, "vol1", snapshots=60, prefix_every=24)
+  src_uuid = mirror_volume(source.ontap, target.ontap, vol_uuid, "vol1")
+  target_snaps, source_snaps = target.ontap.snapshots[vol_uuid], source.ontap.snapshots[src_uuid]
+  # a SnapMirror copy: same version_uuids, other instance uuids
+  assert [s["version_uuid"] for s in target_snaps] == [s["version_uuid"] for s in source_snaps]
+  assert not {s["uuid"] for s in target_snaps} & {s["uuid"] for s in source_snaps}
+  assert all(s["uuid"] != s["version_uuid"] for s in target_snaps)
+
+  vol_snap_optimize.args = vol_snap_optimize.parse_args(["-c", target.name, "-svm", SVM, "-vol", "vol1", "-p", "test",
+                                                         "--journal", "none", "--job_poll_interval", "0.05"])
+  entry = {"cluster": target.name, "vserver": SVM, "volume": "vol1",
+           "source_cluster": source.name, "source_vserver": SVM, "source_volume": "vol1"}
+  result = vol_snap_optimize.optimize_volume(entry, False, False, assume_yes=True)
+  vol_snap_optimize._restore_tracker.wait_all()
+  # the fake only restores to an instance uuid of the target volume
+  assert result["status"] == "restored", result["message"]
+  assert [s["name"] for s in target_snaps[-2:]] == ["FREEZE_000048", "hourly.000049"]
+
+
+def test_catalog_sync_applies_deletes_and_renames(clusters, tmp_path):
+  target, _ = clusters
+  vol_uuid = target.ontap.add_volume(SVM, "vol1", snapshots=30, prefix_every=10)
+  vol_snap_optimize.args = bench_vol_optimize.script_args(target.name, 1, "--skip_src_validation")
+  vol_snap_optimize._catalog = SnapshotCatalog(str(tmp_path / "snapshots.db"))
+  assert len(vol_snap_optimize.get_snapshot_index(vol_uuid, target.name)) == 30
+
+  snaps = target.ontap.snapshots[vol_uuid]
+  del snaps[5]
+  renamed = snaps[25]
+  renamed["name"] = "FREEZE_renamed"
+  add_snapshot(target.ontap, vol_uuid, "hourly.new")
+  vol_snap_optimize._snapshot_indexes.clear()
+
+  index = vol_snap_optimize.get_snapshot_index(vol_uuid, target.name)
+  current = [(snap["version_uuid"], snap["name"]) for snap in snaps]
+  assert [(r.version_uuid, r.name) for r in index] == current
+  assert [(r.version_uuid, r.name) for r in vol_snap_optimize._catalog.load(target.name, vol_uuid)] == current
+  # the renamed snapshot is now the youngest relevant one
+  match, younger = index.last_match(re.compile(vol_snap_optimize.SNAPPREFIX))
+  assert match.version_uuid == renamed["version_uuid"]
+  assert [r.name for r in younger] == [snap["name"] for snap in snaps[25:]][1:]
+
+
+def test_catalog_sync_fetches_only_new_snapshots(clusters, tmp_path):
+  target, _ = clusters
+  vol_uuid = target.ontap.add_volume(SVM, "vol1", snapshots=300, prefix_every=10)
+  vol_snap_optimize.args = bench_vol_optimize.script_args(target.name, 1, "--skip_src_validation")
+  vol_snap_optimize._catalog = SnapshotCatalog(str(tmp_path / "snapshots.db"))
+  vol_snap_optimize.get_snapshot_index(vol_uuid, target.name)
+  synced_at = vol_snap_optimize._catalog._db.execute("SELECT synced_at FROM volumes").fetchone()[0]
+
+  add_snapshot(target.ontap, vol_uuid, "FREEZE_new")
+  add_snapshot(target.ontap, vol_uuid, "hourly.new")
+  vol_snap_optimize._snapshot_indexes.clear()
+  target.ontap.reset_counters()
+  index = vol_snap_optimize.get_snapshot_index(vol_uuid, target.name)
+  assert [r.name for r in index] == [snap["name"] for snap in target.ontap.snapshots[vol_uuid]]
+  # the new snapshots and a count, no listing of all 302 snapshots
+  assert target.ontap.calls == {"GET snapshots": 2}
+  assert target.ontap.bytes_sent < 2000
+  # still due for its full listing after the TTL
+  assert vol_snap_optimize._catalog._db.execute("SELECT synced_at FROM volumes").fetchone()[0] == synced_at
+
+
+@pytest.mark.parametrize("scenario", bench_vol_optimize.SCENARIOS, ids=lambda scenario: scenario.name)
+def test_bench_scenario_statuses(scenario):
+  row = bench_vol_optimize.run_scenario(scenario, BENCH_ARGS)
+  statuses = {status: n for status, n in row["results"].items() if status != "rejected by cluster"}
+  assert statuses == row["expected"]
@@ -7,50 +7,216 @@
 #
 # Summary: Sets volume guarantee to thin volume if set otherwise
 # Possible values: [volume, none]
+#          --audit streams all volumes of a cluster or SVM and reports
+#          their compliance as JSON lines without changing anything
 ################################################################
 
-from netapp_ontap import config, HostConnection, NetAppRestError
-from netapp_ontap.resources import Volume, Snapshot
+from netapp_ontap import NetAppRestError
+from netapp_ontap.resources import Volume
 import sys
+import csv, json
 import argparse
 from getpass import getpass
 import logging
+from ontap_session import init_sessions, get_connection, log_session_stats
+from volume_lookup import VolumeTable, query_volumes, resolve_volumes, read_inventory
+from ontap_metrics import instrumented, export_metrics
+from ontap_logging import queue_handlers
+from run_journal import RunJournal, GUARANTEE_SET
 
+log = logging.getLogger('volGuarantee')
+
+# volume metadata of all looked up volumes
+_volumes = VolumeTable()
+# per volume phase journal (--journal), None if disabled
+_journal = None
+
+@instrumented
 def set_volume_guarantee(vol_name, vol_uuid, cluster, guarantee: str):
   try:
-    with HostConnection(cluster, args.username, args.password, verify=False):
-    	vol = Volume(uuid=vol_uuid)
-    	vol.guarantee = {'type': guarantee}
-    	vol.patch()
-    	return vol 
+    vol = Volume(uuid=vol_uuid)
+    vol.set_connection(get_connection(cluster))
+    vol.guarantee = {'type': guarantee}
+    vol.patch()
+    return vol 
   except NetAppRestError as err:
       log.error(f"Setting volume guarantee to {guarantee} was not successful: {err}")
       return None
 
-def get_volume_uuid(vserver_name, volume_name, cluster: str):
+@instrumented
+def get_volume_uuid(vserver_name, volume_name, cluster: str, refresh: bool = False):
     """List Volume uuid and guarantee in an SVM """
+    record = _volumes.get(cluster, vserver_name, volume_name)
+    if record is not None and not refresh:
+      return record["uuid"], record["guarantee"]
     try:
-      with HostConnection(cluster, args.username, args.password, verify=False):
-        for vol in Volume.get_collection(**{"svm.name": vserver_name, "name": volume_name}):
-            vol.get(fields="uuid,guarantee")
-            return vol.uuid, vol.guarantee.type
+      for record in query_volumes(get_connection(cluster), **{"svm.name": vserver_name, "name": volume_name}):
+          _volumes.add(cluster, record)
+          return record["uuid"], record["guarantee"]
+      log.error(f'Volume {volume_name} not found on SVM {vserver_name}')
     except NetAppRestError as err:
         log.error(f'Volume not found: {err}')
-        return None
+    return None, None
 
+@instrumented
 def get_volume_type(vol_name, vol_uuid, cluster: str):
 
 	""" Retrieving volume type """
+	record = _volumes.by_uuid(cluster, vol_uuid)
+	if record is not None and record["type"]:
+		return record["type"]
 	try:
-		with HostConnection(cluster, args.username, args.password, verify=False):
-			vol = Volume(uuid=vol_uuid)
-			vol.get(fields="type")
-			return vol.type
+		vol = Volume(uuid=vol_uuid)
+		vol.set_connection(get_connection(cluster))
+		vol.get(fields="type")
+		return vol.type
 	except NetAppRestError as err:
 		log.error(f'Error reading type for volume {vol_name}: {err}')
 		return None
 
-def parse_args() -> argparse.Namespace:
+def select_volumes(cluster: str, vserver_pattern: str, volume_pattern: str):
+  """All volumes matching SVM and name patterns (wildcards allowed), one paged query """
+  records = []
+  for record in query_volumes(get_connection(cluster), **{"svm.name": vserver_pattern or "*", "name": volume_pattern or "*"}):
+    _volumes.add(cluster, record)
+    records.append(record)
+  return records
+
+def select_inventory(cluster: str, path: str):
+  """Volumes listed in an inventory file (columns vserver, volume), resolved in bulk """
+  names = [(row["vserver"].strip(), row["volume"].strip()) for row in read_inventory(path) if row.get("vserver") and row.get("volume")]
+  table = VolumeTable()
+  resolve_volumes(table, cluster, get_connection(cluster), names)
+  records = []
+  for svm, name in names:
+    record = table.get(cluster, svm, name)
+    if record is None:
+      log.error(f'Volume {name} not found on SVM {svm}')
+      continue
+    _volumes.add(cluster, record)
+    records.append(record)
+  return records
+
+def plan_guarantee(records, guarantee: str):
+  """Split volumes into the ones to change and the ones to skip (not RW or already compliant) """
+  to_change, skipped = [], []
+  for record in records:
+    if (record["type"] or "").lower() != "rw":
+      skipped.append((record, f'type is {record["type"]}'))
+    elif (record["guarantee"] or "").lower() == guarantee.lower():
+      skipped.append((record, "already compliant"))
+    else:
+      to_change.append(record)
+  return to_change, skipped
+
+@instrumented
+def patch_guarantee_batch(cluster: str, records, guarantee: str):
+  """Set the guarantee of a batch of volumes with one collection PATCH.
+     If the batch fails, the volumes are patched one by one to find the failing ones.
+     Returns {uuid: error} of failed volumes """
+  try:
+    Volume.patch_collection({"guarantee": {"type": guarantee}}, connection=get_connection(cluster),
+                            uuid="|".join(record["uuid"] for record in records))
+    return {}
+  except NetAppRestError as err:
+    log.warning(f'Batch PATCH of {len(records)} volumes failed, retrying one by one: {err}')
+  failures = {}
+  for record in records:
+    try:
+      vol = Volume(uuid=record["uuid"])
+      vol.set_connection(get_connection(cluster))
+      vol.guarantee = {'type': guarantee}
+      vol.patch()
+    except NetAppRestError as err:
+      failures[record["uuid"]] = str(err)
+  return failures
+
+def enforce_guarantee(cluster: str, records, guarantee: str, batch_size: int, dryrun: bool, reselect):
+  """Apply a guarantee to all selected volumes in batches and verify with one re-query.
+     `reselect` re-runs the selection and returns fresh records. Returns per volume results """
+  if _journal is not None and args.resume:
+    # the fresh records decide: a volume changed back since the journaled run is changed again
+    done = [r for r in records if (r["guarantee"] or "").lower() == guarantee.lower() and
+            _journal.completed(cluster, r["svm"], r["name"]).get(GUARANTEE_SET, {}).get("guarantee") == guarantee]
+    if done:
+      log.info(f'{len(done)} volumes were set to {guarantee} in a previous run and are skipped')
+      done_uuids = {r["uuid"] for r in done}
+      records = [r for r in records if r["uuid"] not in done_uuids]
+  else:
+    done = []
+  to_change, skipped = plan_guarantee(records, guarantee)
+  skipped += [(r, "guarantee set in a previous run (journal)") for r in done]
+  log.info(f'{len(records) + len(done)} volumes selected: {len(to_change)} to change, {len(skipped)} skipped')
+  results = [{"vserver": r["svm"], "volume": r["name"], "uuid": r["uuid"], "guarantee": r["guarantee"], "status": "skipped", "message": reason}
+             for r, reason in skipped]
+  if dryrun:
+    return results + [{"vserver": r["svm"], "volume": r["name"], "uuid": r["uuid"], "guarantee": r["guarantee"],
+                       "status": "would change", "message": f'{r["guarantee"]} -> {guarantee}'} for r in to_change]
+
+  failures = {}
+  for start in range(0, len(to_change), batch_size):
+    batch = to_change[start:start + batch_size]
+    failures.update(patch_guarantee_batch(cluster, batch, guarantee))
+    log.info(f'Patched {min(start + batch_size, len(to_change))}/{len(to_change)} volumes, {len(failures)} failures so far')
+
+  current = {r["uuid"]: r for r in reselect()} if to_change else {}
+  for record in to_change:
+    now = current.get(record["uuid"], {}).get("guarantee")
+    result = {"vserver": record["svm"], "volume": record["name"], "uuid": record["uuid"], "guarantee": now}
+    if now is not None and now.lower() == guarantee.lower():
+      result.update({"status": "changed", "message": f'{record["guarantee"]} -> {now}'})
+      # fsync'ed once for the whole run below; setting a guarantee again is harmless
+      if _journal is not None:
+        _journal.record(cluster, record["svm"], record["name"], GUARANTEE_SET, guarantee=guarantee, previous=record["guarantee"])
+    else:
+      result.update({"status": "failed", "message": failures.get(record["uuid"], f'guarantee is {now} after PATCH')})
+      log.error(f'-- Volume {record["name"]} on SVM {record["svm"]}: {result["message"]}')
+    results.append(result)
+  if _journal is not None:
+    _journal.flush()
+  return results
+
+def audit_record(cluster: str, record: dict, guarantee: str) -> dict:
+  """Guarantee, type and thin provisioning compliance of one volume """
+  actual = (record["guarantee"] or "").lower()
+  rw = (record["type"] or "").lower() == "rw"
+  compliant = actual == guarantee.lower()
+  if compliant:
+    status = "compliant"
+  else:
+    # only RW volumes can be changed, see enforce_guarantee()
+    status = "non-compliant" if rw else "not applicable"
+  return {"cluster": cluster, "vserver": record["svm"], "volume": record["name"], "uuid": record["uuid"],
+          "type": record["type"], "rw": rw, "guarantee": record["guarantee"], "expected": guarantee,
+          "guarantee_compliant": compliant, "thin_provisioned": actual == "none",
+          "size": record["size"], "used": record["used"], "available": record["available"], "status": status}
+
+def audit_volumes(cluster: str, vserver_pattern: str, volume_pattern: str, guarantee: str, out) -> dict:
+  """Stream every volume matching the patterns page by page and write one JSON line per volume.
+     Nothing is kept per volume, returns the number of volumes per status """
+  counts = {}
+  query = {"svm.name": vserver_pattern or "*", "name": volume_pattern or "*"}
+  for n, record in enumerate(query_volumes(get_connection(cluster), **query), 1):
+    result = audit_record(cluster, record, guarantee)
+    out.write(json.dumps(result) + "\n")
+    counts[result["status"]] = counts.get(result["status"], 0) + 1
+    if n % 1000 == 0:
+      log.info(f'Audited {n} volumes...')
+  return counts
+
+def write_report(results: list, path: str):
+  """Write the per-volume results as CSV or JSON (by file extension) """
+  if path.lower().endswith(".json"):
+    with open(path, "w") as f:
+      json.dump(results, f, indent=2)
+  else:
+    with open(path, "w", newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=["vserver", "volume", "uuid", "guarantee", "status", "message"])
+      writer.writeheader()
+      writer.writerows(results)
+  log.info(f'Report with {len(results)} volumes written to {path}')
+
+def parse_args(argv=None) -> argparse.Namespace:
     """Parse the command line arguments from the user"""
 
     parser = argparse.ArgumentParser(
@@ -60,10 +226,25 @@ def parse_args() -> argparse.Namespace:
         "-c", "--cluster", "--target_cluster", required=True, help="Target cluster"
     )
     parser.add_argument(
-        "--volume", "-vol", dest="volume", required=True, help="Volume on which restoration is executed"
+        "--volume", "-vol", dest="volume", required=False, help="Volume on which restoration is executed (name pattern in bulk mode)"
+    )
+    parser.add_argument(
+        "-svm", "--vserver", "--target_vserver", required=False, help="SVM on which volume must be restored (pattern in bulk mode)"
+    )
+    parser.add_argument(
+        "--bulk", dest="bulk", action='store_true', default=False, required=False, help="Bulk mode: all volumes matching --vserver and --volume patterns (default *)"
+    )
+    parser.add_argument(
+        "--inventory", dest="inventory", required=False, help="Bulk mode: CSV or YAML inventory with vserver and volume columns"
+    )
+    parser.add_argument(
+        "--audit", dest="audit", required=False, help="Audit mode: write guarantee, type and thin provisioning compliance of all volumes matching --vserver and --volume (default *) as JSON lines to this file ('-' for stdout)"
     )
     parser.add_argument(
-        "-svm", "--vserver", "--target_vserver", required=True, help="SVM on which volume must be restored"
+        "--batch_size", dest="batch_size", type=int, default=50, required=False, help="Bulk mode: volumes per collection PATCH"
+    )
+    parser.add_argument(
+        "--report", dest="report", required=False, help="Bulk mode: per-volume result report file (.csv or .json)"
     )
     parser.add_argument(
         "-debug", "--debug", dest="debug", action='store_true', default=False, required=False, help="Debug output enabled"
@@ -77,9 +258,27 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--guarantee", dest="guarantee", required=True, help="Dry-run, no restore, only finding right snapshots and validating details"
     )
+    parser.add_argument(
+        "--journal", dest="journal", default="vol_guarantee.journal", required=False, help="Journal of per volume outcomes (default: vol_guarantee.journal, 'none' to disable)"
+    )
+    parser.add_argument(
+        "--resume", dest="resume", action='store_true', default=False, required=False, help="Skip volumes the journal records as already set"
+    )
+    parser.add_argument(
+        "--rate_limit", dest="rate_limit", type=float, default=0.0, required=False, help="Max REST requests per second per cluster (default: unlimited)"
+    )
+    parser.add_argument(
+        "--metrics", dest="metrics", required=False, help="Write the REST call metrics summary to this JSON file"
+    )
+    parser.add_argument(
+        "--prometheus", dest="prometheus", required=False, help="Write the REST call metrics as a Prometheus textfile"
+    )
     parser.add_argument("-u", "--api_user", "--username", dest="username", default="admin", help="API Username")
     parser.add_argument("-p", "--api_pass", "--password", dest="password", help="API Password")
-    parsed_args = parser.parse_args()
+    parsed_args = parser.parse_args(argv)
+
+    if not (parsed_args.bulk or parsed_args.inventory or parsed_args.audit) and not (parsed_args.vserver and parsed_args.volume):
+        parser.error("--vserver and --volume are required unless --bulk or --inventory is used")
 
     # collect the password without echo if not already provided
     if not parsed_args.password:
@@ -95,7 +294,50 @@ if __name__ == "__main__":
 		logging.basicConfig(level=logging.DEBUG, format="[%(asctime)s] [%(levelname)5s] [%(module)s:%(lineno)s] %(message)s")
 	else:
 		logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)5s] %(message)s")
-		log = logging.getLogger('volGuarantee')
+	# logging must not stall the REST calls
+	queue_handlers()
+
+	init_sessions(args.username, args.password, rate_limit=args.rate_limit)
+
+	if args.audit:
+		log.info(f"Auditing volumes {args.vserver or '*'}:{args.volume or '*'} on cluster {args.cluster} for guarantee {args.guarantee}...")
+		out = sys.stdout if args.audit == "-" else open(args.audit, "w")
+		try:
+			counts = audit_volumes(args.cluster, args.vserver, args.volume, args.guarantee, out)
+		except NetAppRestError as err:
+			log.error(f"-- Audit failed: {err}")
+			sys.exit(2)
+		finally:
+			if out is not sys.stdout:
+				out.close()
+		log.info(f"Audited {sum(counts.values())} volumes: " + ", ".join(f"{k}: {v}" for k, v in sorted(counts.items())))
+		log_session_stats(log)
+		export_metrics(log, args.metrics, args.prometheus)
+		sys.exit(1 if counts.get("non-compliant") else 0)
+	if args.journal.lower() != "none":
+		_journal = RunJournal(args.journal, resume=args.resume)
+
+	if args.bulk or args.inventory:
+		try:
+			if args.inventory:
+				log.info(f"Resolving volumes from {args.inventory} on cluster {args.cluster}...")
+				reselect = lambda: select_inventory(args.cluster, args.inventory)
+			else:
+				log.info(f"Selecting volumes {args.vserver or '*'}:{args.volume or '*'} on cluster {args.cluster}...")
+				reselect = lambda: select_volumes(args.cluster, args.vserver, args.volume)
+			results = enforce_guarantee(args.cluster, reselect(), args.guarantee, max(1, args.batch_size), args.dryrun, reselect)
+		except NetAppRestError as err:
+			log.error(f"-- Bulk guarantee change failed: {err}")
+			quit()
+		for n, result in enumerate(results, 1):
+			log.info(f"[{n}/{len(results)}] {result['vserver']}:{result['volume']} {result['status']} {result['message']}")
+		if args.report:
+			write_report(results, args.report)
+		if _journal is not None:
+			_journal.close()
+		log_session_stats(log)
+		export_metrics(log, args.metrics, args.prometheus)
+		sys.exit(1 if any(r["status"] == "failed" for r in results) else 0)
 
 	log.info(f"Looking up for volume {args.volume} on cluster {args.cluster} and checking it's capabilities...")
 	volume_uuid, volume_guarantee = get_volume_uuid(args.vserver, args.volume, args.cluster)
@@ -112,20 +354,27 @@ if __name__ == "__main__":
 			            To proceed volume type must be RW (Snapmirror destination?)''')
 			quit()
 
-		if args.guarantee and args.guarantee.lower() != volume_guarantee.lower():
+		if _journal is not None and args.resume and _journal.completed(args.cluster, args.vserver, args.volume).get(GUARANTEE_SET, {}).get("guarantee") == args.guarantee:
+			log.info(f"Volume guarantee was set to {args.guarantee} in a previous run. No action needed.")
+		elif args.guarantee and args.guarantee.lower() != volume_guarantee.lower():
 			log.info(f"Setting volume guarantee to {args.guarantee}... ")
 			set_guarantee_resp = set_volume_guarantee(args.volume, volume_uuid, args.cluster, args.guarantee)
 
 			# Re-reading volume guarantee after changes
-			volume_uuid, volume_guarantee = get_volume_uuid(args.vserver, args.volume, args.cluster)
+			volume_uuid, volume_guarantee = get_volume_uuid(args.vserver, args.volume, args.cluster, refresh=True)
 			log.info(f"Now volume {args.volume} guarantee: {volume_guarantee}")
 			
 			if set_guarantee_resp == None:
 				log.error(f"-- Cannot set volume guarantee to {args.guarantee} due to previous errors")
+			elif _journal is not None and volume_guarantee == args.guarantee:
+				_journal.record(args.cluster, args.vserver, args.volume, GUARANTEE_SET, durable=True, guarantee=args.guarantee)
 		else: 
 			log.info(f"Volume guarantee is already {volume_guarantee}. No action needed.")
 	# volume not found, error is reported in function
 	else:
 		quit()
-  
-  
+
+	if _journal is not None:
+		_journal.close()
+	log_session_stats(log)
+	export_metrics(log, args.metrics, args.prometheus)
@@ -12,16 +12,63 @@
 ################################################################
 
 
-from netapp_ontap import config, HostConnection, NetAppRestError
+from netapp_ontap import NetAppRestError
 from netapp_ontap.resources import Volume, Snapshot
 import re, sys
+import csv, json, threading, time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
 import argparse
 from getpass import getpass
 import logging
+from snapshot_index import SnapshotIndex, SnapshotRecord, SNAPSHOT_FIELDS, snapshot_record, scan_newest_first, compare_prefix_snapshots
+from ontap_session import init_sessions, get_connection, get_sessions, log_session_stats
+from volume_lookup import VolumeTable, NAME_BATCH, query_volumes, resolve_volumes, read_inventory
+from snapshot_catalog import SnapshotCatalog
+from ontap_metrics import instrumented, timed, export_metrics
+from ontap_logging import queue_handlers
+from restore_jobs import UNKNOWN, JobTracker, RestoreSkipped
+import ontap_async
+from run_journal import RunJournal, RESTORED, DRY_RUN_OK, RESTORE_SUBMITTED, RESTORE_OUTCOMES
+from snapmirror_index import RelationshipIndex, load_relationships, parse_cluster_map
+from space_planner import SpacePlan, snapshot_sizes, load_plan
+from restore_plan import PlanError, write_restore_plan, load_restore_plan
 
 SNAPPREFIX = '^(NONE|LH|FREEZE)'
 
+# columns of an inventory file, empty source_* are paired from the SnapMirror relationships
+INVENTORY_FIELDS = ("cluster", "vserver", "volume", "source_cluster", "source_vserver", "source_volume")
+SOURCE_FIELDS = ("source_cluster", "source_vserver", "source_volume")
+
+logd = logging.getLogger('snapsDebug')
+logc = logging.getLogger('snapsInfo')
+log = logc
+
+# per-cluster worker slots for fleet mode
+_cluster_slots = {}
+_cluster_slots_lock = threading.Lock()
+# volume metadata of all looked up volumes
+_volumes = VolumeTable()
+# snapshot indexes keyed by (cluster, volume uuid), filled once per run
+_snapshot_indexes = {}
+_snapshot_indexes_lock = threading.Lock()
+# optional on-disk snapshot catalog (--catalog)
+_catalog = None
+# SnapMirror relationships of the target clusters, see get_relationship_index()
+_relationships = None
+_relationships_lock = threading.Lock()
+# per volume phase journal (--journal), None if disabled
+_journal = None
+# restore jobs running in the background, see get_restore_tracker()
+_restore_tracker = None
+_restore_tracker_lock = threading.Lock()
+# held while the job tracker updates the result of a submitted restore
+_results_lock = threading.Lock()
+# interactive confirmations must not interleave between workers
+_confirm_lock = threading.Lock()
+
 def pretty_dict(d, indent=0):
    for key, value in d.items():
       print('\t' * indent + str(key))
@@ -39,24 +86,30 @@ def confirm_restore(volume_name, snap_uuid: str):
     else:
       return False
 
+@instrumented
 def get_volume_type(vol_name, vol_uuid, cluster: str):
+  record = _volumes.by_uuid(cluster, vol_uuid)
+  if record is not None and record["type"]:
+    return record["type"]
   try:
-    with HostConnection(cluster, args.username, args.password, verify=False):
-      vol = Volume(uuid=vol_uuid)
-      vol.get(fields="type")
-      return vol.type
+    vol = Volume(uuid=vol_uuid)
+    vol.set_connection(get_connection(cluster))
+    vol.get(fields="type")
+    return vol.type
   except NetAppRestError as err:
       log.error(f'Error reading type for volume {vol_name}: {err}')
       return None
 
-def volume_restore_by_uuid(vol_name, vol_uuid, snap_insta_uuid, snap_name, vserver, cluster: str, dryrun: bool):
-  """Restore Volume to a given UUID """
+@instrumented
+def volume_restore_by_uuid(vol_name, vol_uuid, snap_insta_uuid, snap_name, vserver, cluster: str, dryrun: bool, poll: bool = True):
+  """Restore Volume to a given UUID, with poll=False returns as soon as the restore job is started """
   vol_data = {
         'uuid': vol_uuid,
         'restore_to.snapshot.uuid': snap_insta_uuid,
          'validate_only': dryrun
          }
   vol = Volume()
+  vol.set_connection(get_connection(cluster))
 
   if not dryrun:
     logc.info(f'''\n\n+ Restoring volume {vol_name} 
@@ -69,113 +122,252 @@ def volume_restore_by_uuid(vol_name, vol_uuid, snap_insta_uuid, snap_name, vserv
                           on cluster {cluster} 
                           to snapshot {snap_name} (next after the youngest) - only data validation execution''')
   try:
-    with HostConnection(cluster, args.username, args.password, verify=False):
-      return vol.patch(**vol_data) 
+    return vol.patch(poll=poll, poll_interval=args.job_poll_interval, **vol_data)
   except NetAppRestError as err:
       log.error(f'Volume restore was not successful: {err}')
       return None
 
-def get_volume_uuid(vserver_name, volume_name, cluster: str):
-    """List Volumes in a SVM """
+@instrumented
+def get_volume_uuid(vserver_name, volume_name, cluster: str, refresh: bool = False):
+    """List Volumes in a SVM, refresh re-reads uuid and type from the cluster """
+    record = _volumes.get(cluster, vserver_name, volume_name)
+    if record is not None and not refresh:
+      return record["uuid"]
     try:
       logc.info(f'''+ Looking up volume {volume_name} on vserver {vserver_name} on cluster {cluster} ''')
-      with HostConnection(cluster, args.username, args.password, verify=False):
-        for vol in Volume.get_collection(**{"svm.name": vserver_name, "name": volume_name}):
-            vol.get(fields="svm,uuid")
-            return vol.uuid
+      for record in query_volumes(get_connection(cluster), **{"svm.name": vserver_name, "name": volume_name}):
+          _volumes.add(cluster, record)
+          return record["uuid"]
     except NetAppRestError as err:
         log.error(f'Volume not found: {err}')
         return None
+
+def has_source(entry: dict) -> bool:
+    return all(entry.get(key) for key in SOURCE_FIELDS)
+
+def get_relationship_index() -> RelationshipIndex:
+    """SnapMirror relationship index of the target clusters, created on first use """
+    global _relationships
+    with _relationships_lock:
+      if _relationships is None:
+        _relationships = RelationshipIndex(parse_cluster_map(args.source_cluster_map))
+      return _relationships
+
+def pair_sources(inventory: list, use_async: bool = False):
+    """Fill the missing source_* fields of inventory entries from the SnapMirror relationships
+       of their clusters. The relationships are fetched once per target cluster, given fields win """
+    unpaired = [entry for entry in inventory if not has_source(entry)]
+    if args.skip_src_validation or not unpaired:
+      return
+    index = get_relationship_index()
+    clusters = sorted({entry["cluster"] for entry in unpaired if not index.loaded(entry["cluster"])})
+    if use_async and clusters:
+      for cluster, records in ontap_async.relationships(clusters, get_sessions(), args.async_concurrency).items():
+        logc.info(f'+ Indexed {index.add(cluster, records)} SnapMirror relationships of cluster {cluster}')
+    else:
+      for cluster in clusters:
+        try:
+          logc.info(f'+ Indexed {load_relationships(index, cluster, get_connection(cluster))} SnapMirror relationships of cluster {cluster}')
+        except NetAppRestError as err:
+          log.error(f'SnapMirror relationships of cluster {cluster} could not be listed: {err}')
+
+    paired = 0
+    for entry in unpaired:
+      known = _volumes.get(entry["cluster"], entry["vserver"], entry["volume"])
+      relationship = index.source_of(entry["cluster"], entry["vserver"], entry["volume"], known["uuid"] if known else None)
+      if relationship is None:
+        continue
+      for key in SOURCE_FIELDS:
+        entry[key] = entry.get(key) or relationship[key]
+      logd.debug(f'Volume {entry["volume"]} on cluster {entry["cluster"]} is a {relationship["state"]} destination of '
+                 f'{entry["source_vserver"]}:{entry["source_volume"]} on cluster {entry["source_cluster"]}')
+      paired += 1
+    if len(inventory) > 1:
+      logc.info(f'+ Paired {paired} of {len(unpaired)} volumes without source with their SnapMirror source')
+
+def inventory_names(inventory: list) -> dict:
+    """(svm, volume) names of all target and source volumes of an inventory, by cluster """
+    names = {}
+    for entry in inventory:
+      names.setdefault(entry["cluster"], set()).add((entry["vserver"], entry["volume"]))
+      if has_source(entry):
+        names.setdefault(entry["source_cluster"], set()).add((entry["source_vserver"], entry["source_volume"]))
+    return names
+
+def prefetch_volumes(inventory: list, pair: bool = True):
+    """Pair missing sources, then resolve all target and source volumes of an inventory
+       with one bulk query per cluster """
+    if pair:
+      pair_sources(inventory)
+    names = inventory_names(inventory)
+    for cluster, cluster_names in names.items():
+      try:
+        found = resolve_volumes(_volumes, cluster, get_connection(cluster), cluster_names)
+        logc.info(f'+ Resolved {found} of {len(cluster_names)} volumes on cluster {cluster}')
+      except NetAppRestError as err:
+        log.error(f'Bulk volume lookup on cluster {cluster} failed, falling back to single lookups: {err}')
     
 
-def find_last_snap(prefix, volume_uuid, cluster: str):
-    """Find suitable last snapshot on a Volume """
-    snaps_list = {}
-    regex = re.compile(prefix)
-    idx = 0
-    prefix_snap = False
+def prefetch_async(inventory: list, snapshots: bool = True):
+    """Resolve all volumes of an inventory and list their snapshots with the asyncio engine.
+       Results land in the same volume table and snapshot indexes the synchronous helpers fill,
+       volumes it could not list are fetched synchronously later """
+    pair_sources(inventory, use_async=True)
+    names = inventory_names(inventory)
+    # volumes in the catalog are brought up to date incrementally instead
+    want_snapshots = lambda cluster, uuid: snapshots and (_catalog is None or args.refresh_catalog or not _catalog.has(cluster, uuid))
+    start = time.perf_counter()
+    discovered = ontap_async.discover(names, get_sessions(), concurrency=args.async_concurrency, want_snapshots=want_snapshots)
+    for cluster, (records, indexes) in discovered.items():
+      for record in records:
+        _volumes.add(cluster, record)
+      with _snapshot_indexes_lock:
+        _snapshot_indexes.update(indexes)
+      if _catalog is not None:
+        for (_, volume_uuid), index in indexes.items():
+          _catalog.store(cluster, volume_uuid, index.records)
+      logc.info(f'+ Discovered {len(records)} of {len(names[cluster])} volumes and {sum(len(i) for i in indexes.values())} snapshots on cluster {cluster}')
+    logd.info(f'Async discovery took {time.perf_counter() - start:.3f}s')
+
+@instrumented
+def get_snapshot_index(volume_uuid, cluster: str, refresh: bool = False):
+    """Snapshot index of a volume, fetched once per run unless a refresh is requested """
+    key = (cluster, volume_uuid)
+    with _snapshot_indexes_lock:
+      index = _snapshot_indexes.get(key)
+    if index is not None and not refresh:
+      return index
     try:
-      config.CONNECTION = HostConnection(cluster, args.username, args.password, verify=False)
-      with config.CONNECTION:
-        logc.info(f'Searching relevant snapshots on {config.CONNECTION.origin}')
-        snapshots = Snapshot()
-        for snap in snapshots.get_collection(volume_uuid, fields="create_time,version_uuid,name,volume,svm", order_by="create_time"):
-          if regex.match(snap.name):
-            snaps_list = {}
-            snaps_list[0] = {"version_uuid": snap.version_uuid, "uuid": snap.uuid, "name": snap.name, "create_time": datetime.timestamp(snap.create_time), "ct_human": snap.create_time }
-            idx = 0
-            if args.verbose:
-              print(f'Found relevant snapshot: {snaps_list[0]["name"]}')
-            prefix_snap = True
-          else:
-            idx += 1
-            snaps_list[idx] =  {"version_uuid": snap.version_uuid, "uuid": snap.uuid,  "name": snap.name, "create_time": datetime.timestamp(snap.create_time), "ct_human": snap.create_time  }
+      connection = get_connection(cluster)
+      cached = None
+      if _catalog is not None and not (refresh or args.refresh_catalog):
+        cached = _catalog.load(cluster, volume_uuid)
+      if cached is not None:
+        index = sync_snapshot_index(cached, volume_uuid, cluster, connection)
+      else:
+        snapshots = Snapshot.get_collection(volume_uuid, connection=connection, fields=SNAPSHOT_FIELDS, order_by="create_time")
+        index = SnapshotIndex.from_snapshots(volume_uuid, cluster, snapshots)
+        if _catalog is not None:
+          _catalog.store(cluster, volume_uuid, index.records)
     except NetAppRestError as err:
-        log.error(f'Snapshot not found: {err}')
-    return snaps_list, prefix_snap
+        log.error(f'Snapshots not found: {err}')
+        return None
+    logd.debug(f'Fetched {len(index)} snapshots of volume {volume_uuid} on cluster {cluster}')
+    with _snapshot_indexes_lock:
+      _snapshot_indexes[key] = index
+    return index
+
+def sync_snapshot_index(cached, volume_uuid, cluster: str, connection):
+    """Bring a cached snapshot list up to date. Snapshots created since the newest cached one are
+       fetched in full, and a count of all snapshots checks that nothing else changed. Only if the
+       count does not add up (deleted snapshots, transfers with an older create_time), one listing of
+       all version_uuids and names finds the deleted, renamed and missing snapshots. Renames of older
+       snapshots alone keep the count, the full listing after --catalog_ttl picks them up """
+    known = {r["version_uuid"]: r for r in cached}
+    if known:
+      newest = max(cached, key=lambda r: r["create_time"])
+      new = [snapshot_record(snap) for snap in Snapshot.get_collection(volume_uuid, connection=connection, fields=SNAPSHOT_FIELDS,
+                                                                       create_time=f'>={newest["ct_human"].isoformat()}')]
+      new = [r for r in new if r.version_uuid not in known]
+      if Snapshot.count_collection(volume_uuid, connection=connection) == len(known) + len(new):
+        # the volume stays due for its full listing (synced_at) after --catalog_ttl
+        _catalog.apply_delta(cluster, volume_uuid, new, synced=False)
+        logd.debug(f'Catalog sync of volume {volume_uuid} on cluster {cluster}: {len(new)} new snapshots')
+        return SnapshotIndex(volume_uuid, cluster, list(cached) + new)
+      logd.debug(f'Snapshot count of volume {volume_uuid} on cluster {cluster} does not match the catalog, listing all snapshots')
+    present = {snap.version_uuid: snap.name for snap in Snapshot.get_collection(volume_uuid, connection=connection, fields="version_uuid,name")}
+    deleted = [v for v in known if v not in present]
+    renamed = [SnapshotRecord(r.version_uuid, r.uuid, present[v], r.create_time, r.utcoffset) for v, r in known.items() if v in present and present[v] != r.name]
+    # transferred snapshots keep their source create_time, so new ones are looked up by version_uuid
+    missing = sorted(v for v in present if v not in known)
+    new = []
+    for start in range(0, len(missing), NAME_BATCH):
+      new += [snapshot_record(snap) for snap in Snapshot.get_collection(volume_uuid, connection=connection, fields=SNAPSHOT_FIELDS,
+                                                                        version_uuid="|".join(missing[start:start + NAME_BATCH]))]
+    records = {**known, **{r.version_uuid: r for r in renamed + new}}
+    for version_uuid in deleted:
+      del records[version_uuid]
+    _catalog.apply_delta(cluster, volume_uuid, renamed + new, deleted)
+    logd.debug(f'Catalog sync of volume {volume_uuid} on cluster {cluster}: {len(new)} new, {len(renamed)} renamed, {len(deleted)} deleted snapshots')
+    return SnapshotIndex(volume_uuid, cluster, records.values())
+
+@instrumented
+def stream_last_snap(regex, volume_uuid, cluster: str):
+    """Scan snapshots newest first, page by page, up to the youngest prefix match """
+    snapshots = Snapshot.get_collection(volume_uuid, connection=get_connection(cluster), fields=SNAPSHOT_FIELDS,
+                                        order_by="create_time desc", max_records=args.scan_page_size)
+    return scan_newest_first((snapshot_record(snap) for snap in snapshots), regex)
 
-def find_snapshot_by_uuid(volume_uuid, snap_uuid, cluster: str):
-    """Validate snapshot on volume """
-    snapshot_found = False
+def find_last_snap(prefix, volume_uuid, cluster: str, full_scan: bool = False, fresh: bool = False, index: SnapshotIndex = None):
+    """Find suitable last snapshot on a Volume: a list of the youngest prefix snapshot
+       followed by the snapshots younger than it, oldest first. fresh (restores) always
+       reads the current snapshots from the cluster, never the cached index or catalog.
+       An index the caller just fetched is scanned as it is """
+    regex = re.compile(prefix)
+    logc.info(f'Searching relevant snapshots on {cluster}')
+    if index is None and not fresh:
+      with _snapshot_indexes_lock:
+        index = _snapshot_indexes.get((cluster, volume_uuid))
     try:
-      with HostConnection(cluster, args.username, args.password, verify=False):
-        snap = Snapshot(volume_uuid, uuid = snap_uuid)
-        snap.get()
-        return snap.version_uuid
+      if index is not None or full_scan or (not fresh and _catalog is not None and not args.refresh_catalog and _catalog.has(cluster, volume_uuid)):
+        # the whole list is (or has to be) in memory anyway
+        if index is None:
+          index = get_snapshot_index(volume_uuid, cluster, refresh=fresh)
+        if index is None:
+          return [], False
+        match, younger = index.last_match(regex)
+      else:
+        match, younger = stream_last_snap(regex, volume_uuid, cluster)
+        if args.verify_scan:
+          index = get_snapshot_index(volume_uuid, cluster, refresh=fresh)
+          full_match, full_younger = index.last_match(regex) if index else (None, [])
+          if (full_match, full_younger) != (match, younger):
+            log.error(f'Streaming snapshot scan of volume {volume_uuid} differs from the full scan, using the full scan')
+            match, younger = full_match, full_younger
     except NetAppRestError as err:
         log.error(f'Snapshot not found: {err}')
-        return None
+        return [], False
+
+    if match is None:
+      return younger, False
+    if args.verbose:
+      print(f'Found relevant snapshot: {match["name"]}')
+    return [match] + younger, True
 
 def list_all_snapshots(volume_name, volume_uuid, cluster: str):
     """List all snapshots """
-    try:
-      config.CONNECTION = HostConnection(cluster, args.username, args.password, verify=False)
-      with config.CONNECTION:
-        snapshots = Snapshot()
-
-        if args.verbose:
-          logc.info(f'Listing all snapshots on cluster {config.CONNECTION.origin} in volume {volume_name}:')
-          for snap in snapshots.get_collection(volume_uuid, fields="create_time,version_uuid,name,volume,svm", order_by="create_time"): 
-            logc.info(f'{snap.version_uuid},  {snap.name},  {snap.create_time}')
-        else:
-          logging.info(f'Listing all snapshots on cluster {config.CONNECTION.origin} in volume {volume_name}:')
-          for snap in snapshots.get_collection(volume_uuid, fields="create_time,version_uuid,name,volume,svm", order_by="create_time"):
-            logging.info(f'{snap.version_uuid},  {snap.name},  {snap.create_time}')
-        file_handler.setFormatter(full_formatter)
-        stdout_handler.setFormatter(full_formatter)
+    index = get_snapshot_index(volume_uuid, cluster)
+    if index is None:
+      return None
 
-    except NetAppRestError as err:
-        log.error(f'Snapshot not found: {err}')
-        return None
+    if args.verbose:
+      logc.info(f'Listing all snapshots on cluster {cluster} in volume {volume_name}:')
+      for snap in index.ordered():
+        logc.info(f'{snap["version_uuid"]},  {snap["name"]},  {snap["ct_human"]}')
+    else:
+      logging.info(f'Listing all snapshots on cluster {cluster} in volume {volume_name}:')
+      for snap in index.ordered():
+        logging.info(f'{snap["version_uuid"]},  {snap["name"]},  {snap["ct_human"]}')
 
 def get_prefix_snapshots_list(prefix, volume_name, volume_uuid, cluster: str):
     """List snapshots with a given prefix """
-    regex = re.compile(prefix)
-    snaps_list = {}
-    try:
-      with HostConnection(cluster, args.username, args.password, verify=False):
-        snapshots = Snapshot()
-        for snap in snapshots.get_collection(volume_uuid, fields="create_time,version_uuid,name,volume,svm", order_by="create_time"):
-          if regex.match(snap.name):
-            snaps_list[snap.version_uuid] = snap.name
-    except NetAppRestError as err:
-        log.error(f'Snapshots not found: {err}')
-    return snaps_list
+    index = get_snapshot_index(volume_uuid, cluster)
+    return index.prefix_names(prefix) if index is not None else {}
 
-def print_summary_pre():
+def print_summary_pre(target: dict, last_snapshot_list: list, is_snapshot_on_source, skip_src_validation: bool, timings: dict = None):
   summary: str = ""
   summary += f'''
   Target: 
-     cluster:        {args.cluster}
-     volume:         {args.volume}
+     cluster:        {target["cluster"]}
+     volume:         {target["volume"]}
      rel. snapshot:  {last_snapshot_list[0]["name"]}  *** {last_snapshot_list[0]["version_uuid"]} *** {last_snapshot_list[0]["ct_human"]}
   '''
-  if not args.skip_src_validation:
+  if not skip_src_validation:
     snap_found =  f'Yes, UUID = {is_snapshot_on_source}' if (is_snapshot_on_source != None) and (is_snapshot_on_source == last_snapshot_list[0]["version_uuid"]) else  f'*** NOT FOUND ***'
     summary += f'''
   Source:
-    cluster:         {args.source_cluster}
-    volume:          {args.source_volume}
+    cluster:         {target["source_cluster"]}
+    volume:          {target["source_volume"]}
     rel. snap found: {snap_found}
     '''
   summary += f'''
@@ -188,14 +380,492 @@ def print_summary_pre():
   summary += f'''
   All snapshots after relevant one will be deleted:
   '''
-  for k, v in last_snapshot_list.items():
+  for k, v in enumerate(last_snapshot_list):
     if k > 0:
       summary += f'''
       id: {k} Name: {v["name"]} Create_time: {v["ct_human"]} 
   '''
+  if timings:
+    summary += '''
+  Phase timings:
+  '''
+    for phase, seconds in timings.items():
+      summary += f'''
+      {phase:<16} {seconds * 1000:10.1f} ms
+  '''
   return summary
 
-def parse_args() -> argparse.Namespace:
+def fetch_source_index(target: dict, refresh: bool = False):
+  """Look up the source volume of an entry and fetch its snapshot index """
+  with cluster_slot(target["source_cluster"]):
+    source_volume_uuid = get_volume_uuid(target["source_vserver"], target["source_volume"], target["source_cluster"], refresh=refresh)
+    if source_volume_uuid == None:
+      return None, None
+    logc.info(f'''++ Found volume {target["source_volume"]} UUID = {source_volume_uuid} 
+                      on cluster {target["source_cluster"]}''')
+    return source_volume_uuid, get_snapshot_index(source_volume_uuid, target["source_cluster"], refresh=refresh)
+
+def journal(target: dict, phase: str, durable: bool = False, **data):
+  """Record a phase outcome of a volume in the run journal """
+  if _journal is not None:
+    _journal.record(target["cluster"], target["vserver"], target["volume"], phase, durable, **data)
+
+def get_restore_tracker() -> JobTracker:
+  """Job tracker polling all submitted restores, created on first use """
+  global _restore_tracker
+  with _restore_tracker_lock:
+    if _restore_tracker is None:
+      _restore_tracker = JobTracker(args.max_restores, args.max_restores_per_aggr, poll_interval=args.job_poll_interval)
+    return _restore_tracker
+
+@contextmanager
+def cluster_slot(cluster: str):
+  """Hold one of the per-cluster worker slots while talking to a cluster """
+  with _cluster_slots_lock:
+    if cluster not in _cluster_slots:
+      _cluster_slots[cluster] = threading.BoundedSemaphore(max(1, args.cluster_workers))
+    slot = _cluster_slots[cluster]
+  with slot:
+    yield
+
+def submit_restore(target: dict, result: dict, volume_uuid, snapshot, timings: dict, check=None, on_done=None):
+  """Submit the restore of a volume to the job tracker, the result is updated when its job ends.
+     check() runs right before the PATCH and returns why the restore must not run, or None.
+     on_done(result) runs once the result is final """
+  cluster, vserver, volume = target["cluster"], target["vserver"], target["volume"]
+
+  def submit():
+    if check is not None:
+      reason = check()
+      if reason is not None:
+        raise RestoreSkipped(reason)
+    # journaled right before the PATCH, a restore skipped by its check was never submitted
+    journal(target, RESTORE_SUBMITTED, durable=True, restore_snapshot=result["restore_snapshot"], restore_version_uuid=result["restore_version_uuid"])
+    return volume_restore_by_uuid(volume, volume_uuid, snapshot["uuid"], snapshot["name"], vserver, cluster, False, poll=False)
+
+  def update(**values):
+    # the result may be read (service API) while the poller thread updates it
+    with _results_lock:
+      result.update(values)
+
+  def restore_done(job):
+    update(restore_duration=round(job.duration, 3))
+    if job.state == "success":
+      update(status="restored", message="")
+      journal(target, RESTORED, durable=True, restore_snapshot=result["restore_snapshot"], restore_version_uuid=result["restore_version_uuid"])
+      logc.info(f'Volume {volume} was restored successfully. \n New snapshot list:')
+      get_snapshot_index(volume_uuid, cluster, refresh=True)
+      list_all_snapshots(volume, volume_uuid, cluster)
+    elif job.state == UNKNOWN:
+      # nothing journaled: --resume checks the volume (interrupted_restore) instead of restoring it again
+      update(status="error", message=f"restore outcome unknown, check the volume by hand: {job.message}")
+    elif job.state == "skipped":
+      update(status="skipped", message=f"plan drift: {job.message}")
+      journal(target, "plan drift", durable=True, reason=job.message)
+    else:
+      update(status="error", message=f"volume restore failed: {job.message}")
+      journal(target, "restore failed", durable=True, message=job.message)
+    if on_done is not None:
+      on_done(result)
+
+  # executing restore: submitted here, the job tracker reports when it is done
+  aggregate = (_volumes.by_uuid(cluster, volume_uuid) or {}).get("aggregate")
+  result.update({"status": RESTORE_SUBMITTED, "message": ""})
+  # the completion handler runs on a poller thread, in the context of the submitting job
+  context = contextvars.copy_context()
+  with timed(timings, "restore_submit"):
+    get_restore_tracker().submit(f'volume {volume} on cluster {cluster}', cluster, aggregate, submit, lambda job: context.run(restore_done, job))
+
+def interrupted_restore(target: dict, volume_uuid, result: dict) -> bool:
+  """--resume: check a restore an interrupted run submitted without recording its outcome.
+     It went through if its restore snapshot is now the newest snapshot of the volume, then it
+     is journaled as restored. Otherwise it may still be running, so it is not sent again.
+     Returns False (nothing to check) or True with result updated """
+  cluster, vserver, volume = target["cluster"], target["vserver"], target["volume"]
+  if _journal is None or not args.resume or _journal.latest(cluster, vserver, volume, (RESTORE_SUBMITTED,) + RESTORE_OUTCOMES) != RESTORE_SUBMITTED:
+    return False
+  submitted = _journal.completed(cluster, vserver, volume)[RESTORE_SUBMITTED]
+  index = get_snapshot_index(volume_uuid, cluster, refresh=True)
+  newest = next(index.ordered(newest_first=True), None) if index is not None else None
+  result.update({"restore_snapshot": submitted.get("restore_snapshot"), "restore_version_uuid": submitted.get("restore_version_uuid")})
+  if newest is not None and (newest.version_uuid == submitted.get("restore_version_uuid") or
+                             (not submitted.get("restore_version_uuid") and newest.name == submitted.get("restore_snapshot"))):
+    logc.info(f'Restore of volume {volume} to {newest.name} submitted by an interrupted run went through')
+    result.update({"status": "restored", "restore_version_uuid": newest.version_uuid, "message": "restore of an interrupted run verified"})
+    journal(target, RESTORED, durable=True, restore_snapshot=newest.name, restore_version_uuid=newest.version_uuid)
+  else:
+    logc.error(f'Restore of volume {volume} submitted by an interrupted run has not finished or failed, it is not sent again. '
+               f'Check the volume and its jobs, then run it without --resume.')
+    result.update({"status": "error", "message": "restore of an interrupted run not verified, check the volume"})
+  return True
+
+def plan_drift(entry: dict):
+  """Why an approved plan entry no longer matches the current snapshots, None if it still does """
+  cluster = entry["cluster"]
+  volume_uuid = get_volume_uuid(entry["vserver"], entry["volume"], cluster, refresh=True)
+  if volume_uuid != entry["volume_uuid"]:
+    return "volume not found or recreated"
+  index = get_snapshot_index(volume_uuid, cluster, refresh=True)
+  if index is None:
+    return "snapshots could not be read"
+  relevant, younger = index.last_match(SNAPPREFIX)
+  if relevant is None or relevant.version_uuid != entry["relevant_snapshot_uuid"]:
+    return f'youngest relevant snapshot is now {relevant.name if relevant else None}, not {entry["relevant_snapshot"]}'
+  if not younger or (younger[0].uuid, younger[0].version_uuid) != (entry["restore_snapshot_uuid"], entry["restore_version_uuid"]):
+    return f'restore snapshot {entry["restore_snapshot"]} is no longer the one after {entry["relevant_snapshot"]}'
+  if entry.get("source_version_uuid"):
+    source_cluster = entry["source_cluster"]
+    source_uuid = get_volume_uuid(entry["source_vserver"], entry["source_volume"], source_cluster, refresh=True)
+    source_index = get_snapshot_index(source_uuid, source_cluster, refresh=True) if source_uuid else None
+    if source_index is None:
+      return "source snapshots could not be read"
+    if source_index.get(entry["source_version_uuid"]) is None:
+      return f'relevant snapshot {entry["relevant_snapshot"]} is gone from the source volume'
+  return None
+
+def restore_approved(entry: dict) -> dict:
+  """Restore one entry of an approved plan without asking. The entry is checked against the
+     current snapshots of the target (and source) volume right before its PATCH """
+  target = {key: entry.get(key) for key in INVENTORY_FIELDS}
+  result = dict(target, status="error", restore_snapshot=entry["restore_snapshot"], restore_version_uuid=entry["restore_version_uuid"], message="")
+  cluster, vserver, volume = target["cluster"], target["vserver"], target["volume"]
+  timings = {}
+  done = _journal.completed(cluster, vserver, volume) if _journal is not None and args.resume else {}
+  if RESTORED in done:
+    logc.info(f'Volume {volume} on cluster {cluster} was {RESTORED} in a previous run, skipping')
+    result.update({"status": "skipped", "message": f"{RESTORED} in a previous run (journal)"})
+    return result
+  if interrupted_restore(target, entry["volume_uuid"], result):
+    return result
+
+  def check():
+    with cluster_slot(cluster), timed(timings, "revalidation"):
+      return plan_drift(entry)
+
+  logc.info(f'Restore of volume {volume} to snapshot {entry["restore_snapshot"]} is approved by the plan')
+  submit_restore(target, result, entry["volume_uuid"], {"uuid": entry["restore_snapshot_uuid"], "name": entry["restore_snapshot"]}, timings, check)
+  if args.profile:
+    result["timings"] = timings
+  return result
+
+def optimize_volume(target: dict, dryrun: bool, interactive: bool = True, assume_yes: bool = False, on_restore_done=None):
+  """Run lookup, snapshot scan, source validation and dry-run/restore for one volume.
+     assume_yes restores without asking on the console (service jobs confirm up front).
+     Returns a result record for the run report. A submitted restore updates it when its
+     job ends, then calls on_restore_done(result) """
+  result = {key: target.get(key) for key in INVENTORY_FIELDS}
+  result.update({"status": "error", "restore_snapshot": None, "restore_version_uuid": None, "message": ""})
+  cluster, vserver, volume = target["cluster"], target["vserver"], target["volume"]
+  timings = {}
+
+  # phases a previous run finished (--resume)
+  done = _journal.completed(cluster, vserver, volume) if _journal is not None and args.resume else {}
+  finished = done.get(RESTORED) or (done.get(DRY_RUN_OK) if dryrun else None)
+  if finished is not None:
+    logc.info(f'Volume {volume} on cluster {cluster} was {RESTORED if RESTORED in done else DRY_RUN_OK} in a previous run, skipping')
+    result.update({"status": "skipped", "restore_snapshot": finished.get("restore_snapshot"), "restore_version_uuid": finished.get("restore_version_uuid"),
+                   "message": f'{RESTORED if RESTORED in done else DRY_RUN_OK} in a previous run (journal)'})
+    if RESTORED not in done and finished.get("plan"):
+      result["plan"] = finished["plan"]
+    return result
+  # lookups, scans and validations are only reused by dry-runs, a restore decides on the current state
+  if not dryrun:
+    done = {}
+
+  with cluster_slot(cluster), timed(timings, "lookup"):
+    if "resolved" in done:
+      volume_uuid, volume_type = done["resolved"]["uuid"], done["resolved"]["type"]
+    else:
+      # a restore never trusts a cached uuid or type (recreated volume, broken SnapMirror)
+      volume_uuid = get_volume_uuid(vserver, volume, cluster, refresh=not dryrun)
+    if volume_uuid != None:
+      logc.info(f'''++ Found volume {volume} UUID = {volume_uuid} 
+                      on cluster {cluster}''')
+    else:
+      logc.error(f'No target volume {volume} found on SVM {vserver}.')
+      result["message"] = "target volume not found"
+      return result
+
+    if "resolved" not in done:
+      volume_type = get_volume_type(volume, volume_uuid, cluster)
+      if volume_type != None:
+        journal(target, "resolved", uuid=volume_uuid, type=volume_type)
+    if volume_type == None or volume_type.lower() != "rw":
+      logc.error(f'''\n-- Volume {volume} type is not RW. Restore is not possible.
+      To proceed volume type must be RW (Snapmirror destination?)''')
+      result.update({"status": "skipped", "message": f"volume type is {volume_type}"})
+      return result
+    if not dryrun and interrupted_restore(target, volume_uuid, result):
+      return result
+
+  # a journaled validation is only reused together with the journaled scan it validated
+  validated = done.get("validated") if "scanned" in done else None
+  source_volume_uuid = target_index = None
+  if not args.skip_src_validation and not has_source(target):
+    pair_sources([target])
+    result.update({key: target.get(key) for key in SOURCE_FIELDS})
+  if not args.skip_src_validation and validated is None:
+    if not has_source(target):
+      logc.error(f'Volume {volume} is no SnapMirror destination, source cluster, vserver and volume are required to validate it.')
+      result["message"] = "source volume not specified and no SnapMirror relationship found"
+      return result
+
+    # source validation needs all snapshots of both volumes, fetch them in parallel
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="src") as pool, timed(timings, "snapshot_fetch"):
+      # in the job's context, so service jobs' own options reach the helper thread
+      source_future = pool.submit(contextvars.copy_context().run, fetch_source_index, target, not dryrun)
+      with cluster_slot(cluster):
+        target_index = get_snapshot_index(volume_uuid, cluster, refresh=not dryrun)
+      source_volume_uuid, source_index = source_future.result()
+    if source_volume_uuid == None:
+      result["message"] = "source volume not found"
+      return result
+    if target_index is None or source_index is None:
+      result["message"] = "snapshots could not be read"
+      return result
+
+  # identify the last snapshot to restore to, a newest-first scan unless the index is already there
+  if "scanned" in done:
+    last_snapshot_list, snapshot_found = [SnapshotRecord(*row) for row in done["scanned"]["snapshots"]], True
+  else:
+    with cluster_slot(cluster), timed(timings, "snapshot_scan"):
+      # a restore decides on the current snapshots, cached lists and the catalog only serve dry-runs.
+      # the target list fetched for the source validation is that list, validation and restore agree on it
+      last_snapshot_list, snapshot_found = find_last_snap(SNAPPREFIX, volume_uuid, cluster, fresh=not dryrun, index=target_index)
+    if snapshot_found and len(last_snapshot_list) > 1:
+      journal(target, "scanned", snapshots=[snap.astuple() for snap in last_snapshot_list])
+
+  # if snapshot for restore found on target
+  if len(last_snapshot_list) > 1 and snapshot_found:
+    logc.info(f'''The youngest relevant snapshot is found: 
+                  UUID: {last_snapshot_list[0]["version_uuid"]}
+                  name: {last_snapshot_list[0]["name"]}
+                  Create time: {last_snapshot_list[0]["ct_human"]}''')
+  elif len(last_snapshot_list) == 1 and snapshot_found:
+    logc.info(f'''Relevant snapshot is the last snapshot in the volume:
+              {last_snapshot_list[0]["name"]}
+              -- No snapshots to optimize the volume!
+              ''')
+    result.update({"status": "skipped", "message": "relevant snapshot is the last snapshot in the volume"})
+    return result
+  else:
+    logc.error(f'\nRelevant snapshot for restoration is not found on volume {volume}.')
+    result["message"] = "relevant snapshot not found"
+    return result
+
+  result.update({"restore_snapshot": last_snapshot_list[1]["name"], "restore_version_uuid": last_snapshot_list[1]["version_uuid"]})
+  planned = target.get("planned_version_uuid")
+  if planned is not None and planned != last_snapshot_list[1]["version_uuid"]:
+    logc.error(f'Volume {volume} would now be restored to {last_snapshot_list[1]["name"]}, not to the planned snapshot {planned}.')
+    result.update({"status": "skipped", "message": "snapshots changed since the plan was made"})
+    return result
+  is_snapshot_on_source = None
+
+  if args.skip_src_validation:
+    logc.warning("!! Skipping Source volume snapshots validation as requested...")
+
+  elif validated is not None:
+    logc.info(f'Relevant snapshot was validated on source cluster {target["source_cluster"]} in a previous run')
+    is_snapshot_on_source = validated["source_version_uuid"]
+    if validated.get("snapshot_diff") is not None:
+      result["snapshot_diff"] = validated["snapshot_diff"]
+
+  else: # if we don't skip source validation
+    with timed(timings, "validation"):
+      snap_src_tgt_diff = compare_prefix_snapshots(target_index, source_index, SNAPPREFIX)
+    result["snapshot_diff"] = snap_src_tgt_diff.to_dict()
+    if not snap_src_tgt_diff.in_sync:
+      logc.error(f'''ATTENTION:
+        Affected snapshots on source and destination are not the same. 
+        Missing on source: {snap_src_tgt_diff.missing_on_source}
+        Missing on dest:   {snap_src_tgt_diff.missing_on_target}''')
+
+    logc.info(f'Validating snapshot on source... {target["source_cluster"]}')
+    relevant_on_source = source_index.get(last_snapshot_list[0]["version_uuid"])
+    is_snapshot_on_source = relevant_on_source["version_uuid"] if relevant_on_source else None
+
+    if (is_snapshot_on_source != None) and (is_snapshot_on_source == last_snapshot_list[0]["version_uuid"]):
+      logc.info(f'''
+        Relevant young snapshot exists on source cluster {target["source_cluster"]}
+        Volume can be restored to the next avaiable snapshot: {last_snapshot_list[1]["name"]}
+        ''')
+      journal(target, "validated", source_version_uuid=is_snapshot_on_source, snapshot_diff=result["snapshot_diff"])
+    else: 
+      logc.error(f'Relevant snapshot {last_snapshot_list[0]["name"]} cannot be validated on source cluster {target["source_cluster"]}.')
+      result["message"] = "relevant snapshot not validated on source"
+      return result
+
+  summary = print_summary_pre(target, last_snapshot_list, is_snapshot_on_source, args.skip_src_validation, timings if args.profile else None)
+  if interactive:
+    print("\nPre-execution summary:\n", summary)
+  else:
+    logd.info(f'Pre-execution summary for volume {volume}:\n{summary}')
+
+  # print all snapshots on target volume on target cluster
+  if args.verbose:
+    print(f''' *** DEBUG: Listing all snapshots 
+           Target cluster: {cluster} 
+           Volume:         {volume}''')
+    list_all_snapshots(volume, volume_uuid, cluster)
+
+  if source_volume_uuid != None and args.verbose:
+    # print all snapshots on source volume on source cluster
+    print(f''' *** DEBUG: Listing all snapshots
+             Source cluster: {target["source_cluster"]} 
+             Volume:         {target["source_volume"]}''')
+    list_all_snapshots(target["source_volume"], source_volume_uuid, target["source_cluster"])
+
+  # if execution is not dry-run
+  if not dryrun:
+    # we need console confirmation, one volume at a time
+    if assume_yes:
+      logc.info(f'Restore of volume {volume} to snapshot {last_snapshot_list[1]["name"]} was confirmed with the job')
+      confirmed = True
+    else:
+      with _confirm_lock:
+        confirmed = confirm_restore(last_snapshot_list[1]["name"], last_snapshot_list[1]["version_uuid"])
+    if confirmed:
+      logc.info("Shit gets real...")
+      submit_restore(target, result, volume_uuid, last_snapshot_list[1], timings, on_done=on_restore_done)
+    # restore is not confirmed
+    else: 
+      logc.info(f'Volume restore is cancelled by operator.')
+      result.update({"status": "cancelled", "message": "cancelled by operator"})
+  # dry-run exec
+  else:
+    logc.info("Executing dry-run...")
+    with cluster_slot(cluster), timed(timings, "dry_run"):
+      vol_restore = volume_restore_by_uuid(volume, volume_uuid, last_snapshot_list[1]["uuid"], last_snapshot_list[1]["name"], vserver, cluster, True)
+    if vol_restore:
+      logc.info(f'++ Dry-run did not detect any issues')
+      # what an approved plan (--write_plan) restores and checks again before doing so
+      result.update({"status": "dry-run ok", "message": "", "plan": {
+        "volume_uuid": volume_uuid, "source_version_uuid": is_snapshot_on_source, "reclaimable_bytes": target.get("reclaimable_bytes"),
+        "relevant_snapshot": last_snapshot_list[0]["name"], "relevant_snapshot_uuid": last_snapshot_list[0]["version_uuid"],
+        "restore_snapshot": last_snapshot_list[1]["name"], "restore_snapshot_uuid": last_snapshot_list[1]["uuid"],
+        "restore_version_uuid": last_snapshot_list[1]["version_uuid"]}})
+      journal(target, DRY_RUN_OK, restore_snapshot=result["restore_snapshot"], restore_version_uuid=result["restore_version_uuid"], plan=result["plan"])
+    else: 
+      logc.error(f'-- Dry-run has failed')
+      result["message"] = "dry-run failed"
+  if args.profile:
+    result["timings"] = {phase: round(seconds, 6) for phase, seconds in timings.items()}
+  return result
+
+def plan_space(inventory: list, path: str):
+  """Planning mode: estimate what a restore of every inventory volume would reclaim and write
+     the candidates ranked by reclaimable bytes. Volumes must be resolved (prefetch) before """
+  volumes = []
+  for entry in inventory:
+    record = _volumes.get(entry["cluster"], entry["vserver"], entry["volume"])
+    if record is None:
+      log.error(f'Volume {entry["volume"]} not found on SVM {entry["vserver"]} on cluster {entry["cluster"]}')
+    elif (record["type"] or "").lower() != "rw":
+      logd.info(f'Volume {entry["volume"]} on cluster {entry["cluster"]} is {record["type"]} and cannot be restored, not planned')
+    else:
+      volumes.append((entry, record))
+
+  # snapshot names and sizes of all volumes, grouped by cluster
+  if args.async_discovery:
+    uuids = {}
+    for entry, record in volumes:
+      uuids.setdefault(entry["cluster"], []).append(record["uuid"])
+    sizes = ontap_async.snapshot_sizes(uuids, get_sessions(), args.async_concurrency)
+  else:
+    def fetch(item):
+      entry, record = item
+      with cluster_slot(entry["cluster"]):
+        try:
+          return snapshot_sizes(record["uuid"], get_connection(entry["cluster"]))
+        except NetAppRestError as err:
+          log.error(f'Snapshots of volume {entry["volume"]} on cluster {entry["cluster"]} not listed: {err}')
+          return None
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="plan") as pool:
+      sizes = {(entry["cluster"], record["uuid"]): result for (entry, record), result in zip(volumes, pool.map(fetch, volumes)) if result is not None}
+
+  plan = SpacePlan()
+  for entry, record in volumes:
+    snapshots = sizes.get((entry["cluster"], record["uuid"]))
+    if snapshots is not None and not plan.add({key: entry.get(key) for key in INVENTORY_FIELDS}, record, snapshots, SNAPPREFIX):
+      logd.info(f'Volume {entry["volume"]} on cluster {entry["cluster"]} has no snapshot to restore to, not planned')
+  rows = plan.write(path)
+  for cluster, (count, reclaimable) in sorted(plan.totals().items()):
+    logc.info(f'+ Cluster {cluster}: {count} restores reclaim at least {reclaimable / 1024 ** 3:.1f} GiB')
+  logc.info(f'Plan with {len(rows)} of {len(inventory)} volumes written to {path}, '
+            f'{(rows[-1]["cumulative_bytes"] if rows else 0) / 1024 ** 3:.1f} GiB reclaimable in total')
+  return rows
+
+def plan_inventory(path: str) -> list:
+  """Inventory entries of a plan written by --plan in rank order, limited by --plan_top and --min_reclaim.
+     Each entry remembers the planned restore snapshot """
+  inventory = []
+  for row in load_plan(path):
+    if row["reclaimable_bytes"] < args.min_reclaim * 1024 ** 3:
+      continue
+    entry = {key: row[key] for key in INVENTORY_FIELDS}
+    entry["planned_version_uuid"] = row["restore_version_uuid"]
+    entry["reclaimable_bytes"] = row["reclaimable_bytes"]
+    inventory.append(entry)
+  return inventory[:args.plan_top] if args.plan_top else inventory
+
+def load_inventory(path: str):
+  """Read target/source volume tuples from a CSV or YAML inventory file """
+  inventory = []
+  for n, row in enumerate(read_inventory(path), 1):
+    entry = {key: (str(row[key]).strip() if row.get(key) not in (None, "") else None) for key in INVENTORY_FIELDS}
+    if not (entry["cluster"] and entry["vserver"] and entry["volume"]):
+      log.error(f'Inventory entry {n} has no cluster, vserver or volume and is skipped: {row}')
+      continue
+    inventory.append(entry)
+  return inventory
+
+def run_fleet(inventory: list, dryrun: bool, workers: int, approved: bool = False):
+  """Run the optimize pipeline (or the restores of an approved plan) for every inventory entry
+     on a bounded worker pool """
+  results = []
+  with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="vol") as pool:
+    futures = {(pool.submit(restore_approved, entry) if approved else pool.submit(optimize_volume, entry, dryrun, False)): entry for entry in inventory}
+    for future in as_completed(futures):
+      entry = futures[future]
+      try:
+        result = future.result()
+      except Exception as err:
+        log.error(f'Volume {entry["volume"]} on cluster {entry["cluster"]} failed: {err}')
+        result = {key: entry.get(key) for key in INVENTORY_FIELDS}
+        result.update({"status": "error", "restore_snapshot": None, "restore_version_uuid": None, "message": str(err)})
+      logc.info(f'[{len(results) + 1}/{len(inventory)}] {result["cluster"]}:{result["vserver"]}:{result["volume"]} -> {result["status"]} {result["message"]}')
+      results.append(result)
+  if _restore_tracker is not None and _restore_tracker.in_flight():
+    logc.info(f'Waiting for {_restore_tracker.in_flight()} restore jobs to finish...')
+    _restore_tracker.wait_all()
+  return results
+
+def write_plan(results: list, path: str):
+  """Phase one of an unattended run: write the restores a dry-run validated as a checksummed plan """
+  entries = [dict({key: result.get(key) for key in INVENTORY_FIELDS}, **result["plan"]) for result in results if result.get("plan")]
+  entries.sort(key=lambda entry: (-(entry["reclaimable_bytes"] or 0), entry["cluster"], entry["vserver"], entry["volume"]))
+  checksum = write_restore_plan(path, entries)
+  logc.info(f'Restore plan with {len(entries)} of {len(results)} volumes written to {path}, checksum {checksum}')
+  logc.info(f'Review it and run the restores with: --approved_plan {path} --approve {checksum[:16]}')
+
+def write_report(results: list, path: str):
+  """Write the per-volume result report as CSV or JSON (by file extension) """
+  if path.lower().endswith(".json"):
+    with open(path, "w") as f:
+      json.dump(results, f, indent=2, default=str)
+  else:
+    columns = list(INVENTORY_FIELDS) + ["status", "restore_snapshot", "restore_version_uuid", "restore_duration", "message"]
+    with open(path, "w", newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+      writer.writeheader()
+      writer.writerows(results)
+
+  totals = {}
+  for result in results:
+    totals[result["status"]] = totals.get(result["status"], 0) + 1
+  logc.info(f'Report with {len(results)} volumes written to {path}: ' + ', '.join(f'{k}: {v}' for k, v in sorted(totals.items())))
+
+def parse_args(argv=None) -> argparse.Namespace:
     """Parse the command line arguments from the user"""
 
     parser = argparse.ArgumentParser(
@@ -205,7 +875,7 @@ def parse_args() -> argparse.Namespace:
         "-sc", "--src_cluster", "--source_cluster", dest="source_cluster", required=False, help="Source cluster"
     )
     parser.add_argument(
-        "-c", "--cluster", "--target_cluster", required=True, help="Target cluster"
+        "-c", "--cluster", "--target_cluster", required=False, help="Target cluster"
     )
     parser.add_argument(
         "-sv", "--src_vol", "--source_volume", dest="source_volume", required=False, help="Source Volume to validate against"
@@ -214,10 +884,43 @@ def parse_args() -> argparse.Namespace:
         "-s_svm", "--src_vserver", "--source_vserver", dest="source_vserver", required=False, help="Source vserver with volume to validate against"
     )
     parser.add_argument(
-        "--volume", "-vol", dest="volume", required=True, help="Volume on which restoration is executed"
+        "--volume", "-vol", dest="volume", required=False, help="Volume on which restoration is executed"
+    )
+    parser.add_argument(
+        "-svm", "--vserver", "--target_vserver", required=False, help="SVM on which volume must be restored"
+    )
+    parser.add_argument(
+        "--inventory", dest="inventory", required=False, help="CSV or YAML inventory of target and source volumes (fleet mode), empty source columns are taken from the SnapMirror relationships"
     )
     parser.add_argument(
-        "-svm", "--vserver", "--target_vserver", required=True, help="SVM on which volume must be restored"
+        "--plan", dest="plan", required=False, help="Planning mode: write the restore candidates ranked by reclaimable bytes to this file (.csv or .json), nothing is restored"
+    )
+    parser.add_argument(
+        "--execute_plan", dest="execute_plan", required=False, help="Fleet mode over a plan written by --plan, highest reclaim first"
+    )
+    parser.add_argument(
+        "--plan_top", dest="plan_top", type=int, default=0, required=False, help="With --execute_plan: only the N highest ranked volumes"
+    )
+    parser.add_argument(
+        "--min_reclaim", dest="min_reclaim", type=float, default=0.0, required=False, help="With --execute_plan: only volumes reclaiming at least this many GiB"
+    )
+    parser.add_argument(
+        "--write_plan", dest="write_plan", required=False, help="With --dryrun: write the validated restores as a checksummed plan for --approved_plan"
+    )
+    parser.add_argument(
+        "--approved_plan", dest="approved_plan", required=False, help="Run the restores of a plan written by --write_plan, in parallel and without prompts"
+    )
+    parser.add_argument(
+        "--approve", dest="approve", required=False, help="With --approved_plan: the plan checksum (or its first 12+ characters) as approval"
+    )
+    parser.add_argument(
+        "--workers", dest="workers", type=int, default=8, required=False, help="Fleet mode: number of volumes processed concurrently"
+    )
+    parser.add_argument(
+        "--cluster_workers", dest="cluster_workers", type=int, default=4, required=False, help="Fleet mode: max concurrent volumes per cluster"
+    )
+    parser.add_argument(
+        "--report", dest="report", required=False, help="Fleet mode: per-volume result report file (.csv or .json)"
     )
     parser.add_argument(
         "-debug", "--debug", dest="debug", action='store_true', default=False, required=False, help="Debug output enabled"
@@ -231,12 +934,78 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--skip_src_validation", "--skip_source_validation", "-skip_src_validation", dest="skip_src_validation", required=False, action='store_true', default=False, help="Skip source cluster snapshot validation"
     )
+    parser.add_argument(
+        "--source_cluster_map", dest="source_cluster_map", required=False, help="Addresses of SnapMirror source clusters as name=address[,name=address] (default: the cluster name)"
+    )
     parser.add_argument(
         "--guarantee", dest="guarantee", required=False, help="Dry-run, no restore, only finding right snapshots and validating details"
     )
+    parser.add_argument(
+        "--scan_page_size", dest="scan_page_size", type=int, default=50, required=False, help="Snapshots per page when scanning newest first for the relevant snapshot"
+    )
+    parser.add_argument(
+        "--verify_scan", dest="verify_scan", action='store_true', default=False, required=False, help="Verify the newest-first snapshot scan against a full snapshot listing"
+    )
+    parser.add_argument(
+        "--catalog", dest="catalog", required=False, help="SQLite file caching snapshot lists between runs, only new snapshots are fetched"
+    )
+    parser.add_argument(
+        "--catalog_ttl", dest="catalog_ttl", type=float, default=24, required=False, help="Hours after which cached volumes are evicted from the catalog"
+    )
+    parser.add_argument(
+        "--refresh_catalog", "--refresh-catalog", dest="refresh_catalog", action='store_true', default=False, required=False, help="Ignore cached snapshot lists and refetch them"
+    )
+    parser.add_argument(
+        "--async_discovery", dest="async_discovery", action='store_true', default=False, required=False, help="List volumes and snapshots with the asyncio engine before processing (needs aiohttp)"
+    )
+    parser.add_argument(
+        "--async_concurrency", dest="async_concurrency", type=int, default=ontap_async.DEFAULT_CONCURRENCY, required=False, help="Max requests in flight per cluster during async discovery"
+    )
+    parser.add_argument(
+        "--rate_limit", dest="rate_limit", type=float, default=0.0, required=False, help="Max REST requests per second per cluster (default: unlimited, the concurrency still adapts to throttling)"
+    )
+    parser.add_argument(
+        "--journal", dest="journal", default="vol_snap_optimize.journal", required=False, help="Journal of per volume phase outcomes (default: vol_snap_optimize.journal, 'none' to disable)"
+    )
+    parser.add_argument(
+        "--resume", dest="resume", action='store_true', default=False, required=False, help="Continue from the journal: skip finished volumes, reuse lookups, scans and validations"
+    )
+    parser.add_argument(
+        "--max_restores", dest="max_restores", type=int, default=4, required=False, help="Max restore jobs running at the same time per cluster"
+    )
+    parser.add_argument(
+        "--max_restores_per_aggr", dest="max_restores_per_aggr", type=int, default=2, required=False, help="Max restore jobs running at the same time per aggregate"
+    )
+    parser.add_argument(
+        "--job_poll_interval", dest="job_poll_interval", type=float, default=1.0, required=False, help="Initial seconds between restore job polls, backs off up to 15s"
+    )
+    parser.add_argument(
+        "--profile", dest="profile", action='store_true', default=False, required=False, help="Add a per-phase timing breakdown to the pre-execution summary"
+    )
+    parser.add_argument(
+        "--metrics", dest="metrics", required=False, help="Write the REST call metrics summary to this JSON file"
+    )
+    parser.add_argument(
+        "--prometheus", dest="prometheus", required=False, help="Write the REST call metrics as a Prometheus textfile"
+    )
     parser.add_argument("-u", "--api_user", "--username", dest="username", default="admin", help="API Username")
     parser.add_argument("-p", "--api_pass", "--password", dest="password", help="API Password")
-    parsed_args = parser.parse_args()
+    parsed_args = parser.parse_args(argv)
+
+    if not (parsed_args.inventory or parsed_args.execute_plan or parsed_args.approved_plan) and not (parsed_args.cluster and parsed_args.volume and parsed_args.vserver):
+        parser.error("either --inventory, --execute_plan, --approved_plan or --cluster, --vserver and --volume are required")
+    if parsed_args.plan and parsed_args.execute_plan:
+        parser.error("--plan and --execute_plan exclude each other")
+    if parsed_args.write_plan and not parsed_args.dryrun:
+        parser.error("--write_plan needs --dryrun")
+    if parsed_args.approved_plan and (parsed_args.dryrun or parsed_args.plan or not parsed_args.approve):
+        parser.error("--approved_plan needs --approve and no --dryrun or --plan")
+    if (parsed_args.inventory or parsed_args.execute_plan) and not (parsed_args.dryrun or parsed_args.plan):
+        parser.error("fleet restores run from an approved plan: --dryrun --write_plan FILE first, then --approved_plan FILE --approve CHECKSUM")
+    try:
+        parse_cluster_map(parsed_args.source_cluster_map)
+    except ValueError as err:
+        parser.error(f"--source_cluster_map: {err}")
 
     # collect the password without echo if not already provided
     if not parsed_args.password:
@@ -271,119 +1040,78 @@ if __name__ == "__main__":
   file_handler.setFormatter(full_formatter)
   
 
-  logd = logging.getLogger('snapsDebug')
-  logc = logging.getLogger('snapsInfo')
   logc.addHandler(stdout_handler)
   logd.addHandler(file_handler)
-  
-  
-  volume_uuid = get_volume_uuid(args.vserver, args.volume, args.cluster)
-  if volume_uuid != None:
-    logc.info(f'''++ Found volume {args.volume} UUID = {volume_uuid} 
-                      on cluster {args.cluster}''')
-  else:
-    logc.error('No target volume found on SVM. Exiting.')
-    quit()
+  # workers only enqueue log records, listener threads write them
+  queue_handlers(logging.getLogger(), logc, logd)
 
-  target_prefix_snaps = get_prefix_snapshots_list(SNAPPREFIX, args.volume, volume_uuid, args.cluster)
-  
-  if get_volume_type(args.volume, volume_uuid, args.cluster).lower() != "rw":
-    logc.error(f'''\n-- Volume {args.volume} type is not RW. Restore is not possible.
-      To proceed volume type must be RW (Snapmirror destination?)''')
-    quit()
-  
-  # print all snapshots on target volume on target cluster
-  #list_all_snapshots(args.volume, volume_uuid, args.cluster)
-
-  # identify the last snapshot to restore to
-  last_snapshot_list, snapshot_found = find_last_snap(SNAPPREFIX, volume_uuid, args.cluster)
+  # one keep-alive session per cluster, sized for the worker threads; the throttle adapts the
+  # requests in flight below that (or below --async_concurrency) when the cluster pushes back
+  pool_size = max(args.workers, args.cluster_workers)
+  init_sessions(args.username, args.password, pool_size=pool_size, rate_limit=args.rate_limit,
+                max_concurrency=max(pool_size, args.async_concurrency) if args.async_discovery else pool_size)
 
-  # if snapshot for restore found on target
-  if len(last_snapshot_list) > 1 and snapshot_found:
-    logc.info(f'''The youngest relevant snapshot is found: 
-                  UUID: {last_snapshot_list[0]["version_uuid"]}
-                  name: {last_snapshot_list[0]["name"]}
-                  Create time: {last_snapshot_list[0]["ct_human"]}''')
-  elif len(last_snapshot_list) <= 1:
-    logc.info(f'''Relevant snapshot is the last snapshot in the volume:
-              {last_snapshot_list[0]["name"]}
-              -- No snapshots to optimize the volume!
-              ''')
-    quit()
-  else:
-    logc.error(f'\nRelevant snapshot for restoration is not found. Exiting.')
-    quit()
+  if args.journal.lower() != "none":
+    _journal = RunJournal(args.journal, resume=args.resume)
+  elif args.resume:
+    logc.error('--resume needs a --journal')
+    sys.exit(1)
 
-  if args.skip_src_validation:
-    logc.warning("!! Skipping Source volume snapshots validation as requested...")
-    
-  else: # if we don't skip source validation
-    source_volume_uuid = get_volume_uuid(args.source_vserver, args.source_volume, args.source_cluster)
-    if source_volume_uuid != None:
-      logc.info(f'''++ Found volume {args.source_volume} UUID = {source_volume_uuid} 
-                      on cluster {args.source_cluster}''')
+  if args.catalog:
+    _catalog = SnapshotCatalog(args.catalog, ttl=args.catalog_ttl * 3600)
+    evicted = _catalog.evict()
+    logd.info(f'Snapshot catalog {args.catalog} opened, {evicted} expired volumes evicted')
+  
+  if args.plan:
+    inventory = load_inventory(args.inventory) if args.inventory else [{
+      "cluster": args.cluster, "vserver": args.vserver, "volume": args.volume,
+      "source_cluster": args.source_cluster, "source_vserver": args.source_vserver, "source_volume": args.source_volume
+      }]
+    logc.info(f'Planning mode: {len(inventory)} volumes')
+    if args.async_discovery:
+      prefetch_async(inventory, snapshots=False)
     else:
-      quit()
-    source_prefix_snaps = get_prefix_snapshots_list(SNAPPREFIX, args.source_volume, source_volume_uuid, args.source_cluster)
-    snap_src_tgt_diff = set(target_prefix_snaps)^set(source_prefix_snaps)    
-    if len(snap_src_tgt_diff) > 0:
-      logc.error(f'''ATTENTION:
-        Affected snapshots on source and destination are not the same. 
-        Missing either on source or dest snapshots: 
-        {snap_src_tgt_diff}
-        Exiting.''')
-      #quit()
-
-    logc.info(f'Validating snapshot on source... {args.source_cluster}')
-    is_snapshot_on_source = find_snapshot_by_uuid(source_volume_uuid, last_snapshot_list[0]["version_uuid"], args.source_cluster) 
-
-    if (is_snapshot_on_source != None) and (is_snapshot_on_source == last_snapshot_list[0]["version_uuid"]):
-      logc.info(f'''
-        Relevant young snapshot exists on source cluster {args.source_cluster}
-        Volume can be restored to the next avaiable snapshot: {last_snapshot_list[1]["name"]}
-        ''')
-    else: 
-      logc.error(f'Relevant snapshot {last_snapshot_list[0]["name"]} cannot be validated on source cluster {args.source_cluster}. Exiting.')
-      quit()
-
-print("\nPre-execution summary:\n", print_summary_pre())
-
-# print all snapshots on target volume on target cluster
-if args.verbose:
-  print(f''' *** DEBUG: Listing all snapshots 
-           Target cluster: {args.cluster} 
-           Volume:         {args.volume}''')
-  list_all_snapshots(args.volume, volume_uuid, args.cluster)
-
-if args.source_volume and args.source_cluster and args.source_vserver and args.verbose:
-  # print all snapshots on source volume on source cluster
-  print(f''' *** DEBUG: Listing all snapshots
-             Source cluster: {args.source_cluster} 
-             Volume:         {args.source_volume}''')
-  list_all_snapshots(args.source_volume, source_volume_uuid, args.source_cluster)
-
-
-# if execution is not dry-run
-if not args.dryrun:
-  # we need console confirmation
-  if confirm_restore(last_snapshot_list[1]["name"], last_snapshot_list[1]["version_uuid"]):
-    logc.info("Shit gets real...")
-    # executing restore
-    vol_restore = volume_restore_by_uuid(args.volume, volume_uuid, last_snapshot_list[1]["uuid"], last_snapshot_list[1]["name"], args.vserver, args.cluster, False)
-    if vol_restore:
-      logc.info(f'Volume was restored successfully. \n New snapshot list:')
-      list_all_snapshots(args.volume, volume_uuid, args.cluster)
-      
-  # restore is not confirmed
-  else: 
-    logc.info(f'Volume restore is cancelled by operator. Exiting. ')
-    quit()
-# dry-run exec
-else:
-  logc.info("Executing dry-run...")
-  vol_restore = volume_restore_by_uuid(args.volume, volume_uuid, last_snapshot_list[1]["uuid"], last_snapshot_list[1]["name"], args.vserver, args.cluster, True)
-  if vol_restore:
-    logc.info(f'++ Dry-run did not detect any issues')
-  else: 
-    logc.error(f'-- Dry-run has failed')
+      prefetch_volumes(inventory)
+    plan_space(inventory, args.plan)
+  elif args.approved_plan:
+    try:
+      entries = load_restore_plan(args.approved_plan, args.approve)
+    except PlanError as err:
+      logc.error(f'{err}')
+      sys.exit(1)
+    logc.info(f'Approved plan {args.approved_plan}: {len(entries)} restores, {args.workers} workers, {args.max_restores} restores per cluster')
+    prefetch_volumes(entries, pair=False)
+    results = run_fleet(entries, False, args.workers, approved=True)
+    write_report(results, args.report or "vol_snap_optimize_report_" + today.strftime("%d-%m-%Y") + ".csv")
+  elif args.inventory or args.execute_plan:
+    inventory = load_inventory(args.inventory) if args.inventory else plan_inventory(args.execute_plan)
+    logc.info(f'Fleet mode: {len(inventory)} volumes from {args.inventory or args.execute_plan}, {args.workers} workers, {args.cluster_workers} per cluster')
+    if args.async_discovery:
+      prefetch_async(inventory)
+    else:
+      prefetch_volumes(inventory)
+    results = run_fleet(inventory, args.dryrun, args.workers)
+    write_report(results, args.report or "vol_snap_optimize_report_" + today.strftime("%d-%m-%Y") + ".csv")
+    if args.write_plan:
+      write_plan(results, args.write_plan)
+  else:
+    target = {
+      "cluster": args.cluster, "vserver": args.vserver, "volume": args.volume,
+      "source_cluster": args.source_cluster, "source_vserver": args.source_vserver, "source_volume": args.source_volume
+      }
+    if args.async_discovery:
+      prefetch_async([target])
+    result = optimize_volume(target, args.dryrun)
+    if _restore_tracker is not None:
+      _restore_tracker.wait_all()
+    if args.report:
+      write_report([result], args.report)
+    if args.write_plan:
+      write_plan([result], args.write_plan)
 
+  if _restore_tracker is not None:
+    _restore_tracker.close()
+  if _journal is not None:
+    _journal.close()
+  log_session_stats(logd if not args.verbose else logc)
+  export_metrics(logd if not args.verbose else logc, args.metrics, args.prometheus)
@@ -0,0 +1,143 @@
+################################################################
+# Bulk NetApp ONTAP volume metadata lookup
+# (c)NetApp Professional Services Germany
+#
+# Summary: resolves many (svm, volume) names with one paged
+#          collection query per cluster and keeps uuid, type,
+#          guarantee and space fields in a lookup table that
+#          all later steps read from
+#
+################################################################
+
+import csv
+import threading
+import time
+
+from netapp_ontap.resources import Volume
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+from ontap_metrics import instrumented
+
+VOLUME_FIELDS = "uuid,name,svm.name,type,guarantee.type,aggregates.name,space.size,space.used,space.available"
+# names per query, keeps the query string well below URL length limits
+NAME_BATCH = 100
+PAGE_SIZE = 1000
+
+
+def volume_record(vol) -> dict:
+  """Compact record of the fields the scripts use """
+  space = getattr(vol, "space", None)
+  guarantee = getattr(vol, "guarantee", None)
+  aggregates = getattr(vol, "aggregates", None) or []
+  return {
+    "uuid": vol.uuid,
+    "name": vol.name,
+    "svm": vol.svm.name,
+    "type": getattr(vol, "type", None),
+    "guarantee": getattr(guarantee, "type", None),
+    "aggregate": ",".join(aggr.name for aggr in aggregates) or None,
+    "size": getattr(space, "size", None),
+    "used": getattr(space, "used", None),
+    "available": getattr(space, "available", None),
+  }
+
+
+def volume_json_record(data: dict) -> dict:
+  """Same record built straight from a REST response record, without a Volume resource """
+  space = data.get("space", {})
+  return {
+    "uuid": data["uuid"],
+    "name": data["name"],
+    "svm": data["svm"]["name"],
+    "type": data.get("type"),
+    "guarantee": data.get("guarantee", {}).get("type"),
+    "aggregate": ",".join(aggr["name"] for aggr in data.get("aggregates", [])) or None,
+    "size": space.get("size"),
+    "used": space.get("used"),
+    "available": space.get("available"),
+  }
+
+
+def read_inventory(path: str):
+  """Rows of a CSV inventory (lines starting with # are ignored) or of a YAML
+  list (optionally under a `volumes` key) as dicts """
+  if path.lower().endswith((".yml", ".yaml")):
+    if yaml is None:
+      raise SystemExit("PyYAML is required to read YAML inventories: pip install pyyaml")
+    with open(path) as f:
+      data = yaml.safe_load(f) or []
+    return data.get("volumes", []) if isinstance(data, dict) else data
+  with open(path, newline='') as f:
+    return list(csv.DictReader(line for line in f if not line.lstrip().startswith('#')))
+
+
+class VolumeTable:
+  """Volume records by (cluster, svm, name) and by (cluster, uuid) """
+
+  def __init__(self):
+    self._by_name = {}
+    self._by_uuid = {}
+    self._added = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._by_uuid)
+
+  def add(self, cluster: str, record: dict):
+    with self._lock:
+      self._by_name[(cluster, record["svm"], record["name"])] = record
+      self._by_uuid[(cluster, record["uuid"])] = record
+      self._added[(cluster, record["uuid"])] = time.time()
+
+  def evict(self, max_age: float) -> int:
+    """Drop records added more than max_age seconds ago, returns the number dropped """
+    cutoff = time.time() - max_age
+    with self._lock:
+      expired = [key for key, added in self._added.items() if added < cutoff]
+      for cluster, uuid in expired:
+        record = self._by_uuid.pop((cluster, uuid))
+        del self._added[(cluster, uuid)]
+        name_key = (cluster, record["svm"], record["name"])
+        # the name may point to a newer record of a recreated volume
+        if self._by_name.get(name_key) is record:
+          del self._by_name[name_key]
+    return len(expired)
+
+  def get(self, cluster: str, svm: str, name: str):
+    return self._by_name.get((cluster, svm, name))
+
+  def by_uuid(self, cluster: str, uuid: str):
+    return self._by_uuid.get((cluster, uuid))
+
+  def records(self, cluster: str = None):
+    return [r for (c, _), r in list(self._by_uuid.items()) if cluster is None or c == cluster]
+
+
+def query_volumes(connection, **query):
+  """Page through a volume collection query and yield compact records """
+  for vol in Volume.get_collection(connection=connection, fields=VOLUME_FIELDS, max_records=PAGE_SIZE, **query):
+    yield volume_record(vol)
+
+
+@instrumented
+def resolve_volumes(table: VolumeTable, cluster: str, connection, names):
+  """Resolve (svm, volume) names on a cluster in bulk.
+
+  Names are OR-ed into batched `name=a|b|c` queries per SVM, so wildcards such
+  as `vol_*` work too. Returns the number of records added to the table. """
+  by_svm = {}
+  for svm, name in names:
+    by_svm.setdefault(svm, set()).add(name)
+
+  found = 0
+  for svm, svm_names in by_svm.items():
+    svm_names = sorted(svm_names)
+    for start in range(0, len(svm_names), NAME_BATCH):
+      for record in query_volumes(connection, **{"svm.name": svm, "name": "|".join(svm_names[start:start + NAME_BATCH])}):
+        table.add(cluster, record)
+        found += 1
+  return found